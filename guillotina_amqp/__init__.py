@@ -1,3 +1,6 @@
+from .canvas import chain  # noqa
+from .canvas import chord  # noqa
+from .canvas import group  # noqa
 from .decorators import object_task  # noqa
 from .decorators import task  # noqa
 from .utils import add_object_task  # noqa
@@ -20,6 +23,46 @@ app_settings = {
         "max_running_tasks": 20,
         "state_ttl": 60 * 60 * 24,  # 1 day
         "max_task_retries": 5,
+        # Entries kept in the event log of generator tasks
+        "eventlog_max_size": 1000,
+        # Results are stored under their own key, for result_ttl seconds
+        # (state_ttl by default). Compressed above the threshold, and
+        # given to result_offload above result_max_size, if any
+        "result_ttl": None,
+        "result_compression_threshold": 4096,
+        "result_max_size": None,
+        "result_offload": None,
+        # Seconds duplicates of a task scheduled with a dedupe_key are
+        # skipped for, unless it starts running before
+        "dedupe_window": 60,
+        # Status changes kept for @amqp-tasks/{task_id}/events
+        "status_stream_max_size": 100,
+        # Results of tasks declared with stream_results
+        "results_stream_max_size": 100000,
+        "results_stream_batch_size": 100,
+        "results_tail_size": 10,
+        # Containers whose active layers are kept between jobs
+        "container_cache_size": 500,
+        "container_cache_ttl": 30,
+        # Seconds a stopping worker waits for its running tasks
+        "drain_timeout": 60,
+        # Pools for synchronous task functions (python defaults if None)
+        "thread_pool_size": None,
+        "process_pool_size": None,
+        # Seconds between pings of the event loop monitor of workers, and
+        # lag above which the stack of the blocked loop is logged
+        "loop_monitor_interval": 0.1,
+        "loop_block_threshold": 1.0,
+        # Policy of the labels of task metrics ("container", "function",
+        # "queue"): keep, drop, hash:<buckets> or top:<size>, folding the
+        # less frequent values into "other"
+        "metrics_labels": {},
+        # Calls kept per profiled execution, and executions kept per
+        # function marked with @amqp-profiles
+        "profile_size": 100,
+        "profile_max_executions": 100,
+        # Fraction of task executions whose memory allocations are traced
+        "memory_sample_rate": 0,
     },
     "commands": {"amqp-worker": "guillotina_amqp.commands.worker.WorkerCommand"},
 }
@@ -13,10 +13,13 @@ import backoff
 logger = glogging.getLogger("guillotina_amqp")
 
 
-async def remove_connection(name="default"):
+async def remove_connection(name="default", protocol=None):
     """
     Purpose here is to close out a bad connection.
     Next time get_connection is called, a new connection will be established
+
+    If protocol is given, the connection is only removed while it is
+    still the one registered with name.
     """
     amqp_settings = app_settings["amqp"]
     if "connections" not in amqp_settings:
@@ -24,6 +27,8 @@ async def remove_connection(name="default"):
     connections = amqp_settings["connections"]
     if name not in connections:
         return
+    if protocol is not None and connections[name]["protocol"] is not protocol:
+        return
 
     connection = connections.pop(name)
     try:
@@ -48,7 +53,7 @@ async def handle_connection_closed(name, protocol):
         logger.warning(
             "Disconnect detected with rabbitmq connection, forcing reconnect"
         )
-        await remove_connection(name)
+        await remove_connection(name, protocol)
     except Exception:
         logger.error("Error waiting for connection to close", exc_info=True)
 
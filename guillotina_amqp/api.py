@@ -1,12 +1,24 @@
+from .state import DONE_STATUSES
 from .state import get_state_manager
+from .state import parse_events_cursor
 from .state import TaskState
+from .state import TaskStatus
+from .profiling import get_profile
+from .profiling import mark_profiled
+from .utils import cancel_tasks
 from .utils import get_task_id_prefix
+from aiohttp.web import StreamResponse
 from guillotina import configure
 from guillotina.interfaces import IContainer
 from guillotina.response import HTTPNotFound
+from guillotina.response import HTTPPreconditionFailed
+from guillotina.response import HTTPUnauthorized
 from guillotina.utils import get_security_policy
 from guillotina_amqp.exceptions import TaskNotFoundException
 
+import datetime
+import json
+
 
 def can_debug_amqp(context: IContainer) -> bool:
     security = get_security_policy()
@@ -60,10 +72,101 @@ async def info_task(context, request):
         state = await task.get_state()
         if not can_debug_amqp(context):
             state.pop("job_data", None)
-        return state
     except TaskNotFoundException:
         return HTTPNotFound(content={"reason": "Task not found"})
 
+    if "include_result" in request.query:
+        # Results are kept apart from the state, only read when asked
+        state["result"] = await task.load_result(state)
+
+    if "eventlog_size" in request.query or "eventlog_cursor" in request.query:
+        # Paged event log: use eventlog_cursor to get the next page
+        try:
+            size = int(request.query.get("eventlog_size", 100))
+        except ValueError:
+            return HTTPPreconditionFailed(content={"reason": "Invalid eventlog_size"})
+        entries = await task.get_eventlog(
+            after=request.query.get("eventlog_cursor") or None, count=size
+        )
+        state["eventlog"] = [value for _, value in entries]
+        state["eventlog_cursor"] = entries[-1][0] if len(entries) == size else None
+        state["eventlog_total"] = await task.get_eventlog_length()
+    return state
+
+
+async def task_results(context, request, task):
+    """Reads the results of a task declared with stream_results"""
+    try:
+        size = int(request.query.get("size", 100))
+    except ValueError:
+        return HTTPPreconditionFailed(content={"reason": "Invalid size"})
+    entries = await task.get_results(
+        after=request.query.get("cursor") or None, count=size
+    )
+    return {
+        "items": [value for _, value in entries],
+        # Pass it back to get the next items
+        "cursor": entries[-1][0] if entries else request.query.get("cursor"),
+    }
+
+
+async def task_events(context, request, task):
+    """Streams the status changes, event log and results of a task as
+    server-sent events
+    """
+    try:
+        await task.get_status()
+    except TaskNotFoundException:
+        return HTTPNotFound(content={"reason": "Task not found"})
+    # Browsers send the id of the last event received when reconnecting
+    cursor = request.headers.get("Last-Event-ID") or request.query.get("cursor")
+    try:
+        parse_events_cursor(cursor)
+    except ValueError:
+        return HTTPPreconditionFailed(content={"reason": "Invalid cursor"})
+
+    resp = StreamResponse(
+        headers={
+            "Content-Type": "text/event-stream",
+            "Cache-Control": "no-cache",
+            # Do not let proxies buffer the events
+            "X-Accel-Buffering": "no",
+        }
+    )
+    await resp.prepare(request)
+    async for item in task.events(cursor):
+        if item is None:
+            # Comment, to keep the connection open
+            await resp.write(b": keepalive\n\n")
+            continue
+        event_id, event, value = item
+        await resp.write(
+            f"id: {event_id}\nevent: {event}\ndata: {json.dumps(value)}\n\n".encode()
+        )
+    await resp.write_eof()
+    return resp
+
+
+# Routes can only have one variable part per position, so they share
+# a single service
+_task_views = {"results": task_results, "events": task_events}
+
+
+@configure.service(
+    method="GET",
+    name="@amqp-tasks/{task_id}/{view}",
+    context=IContainer,
+    permission="guillotina.AccessContent",
+    summary="Reads the streamed results (results) or streams the events "
+    "(events) of a task",
+)
+async def task_view(context, request):
+    task_prefix = get_task_id_prefix()
+    view = _task_views.get(request.matchdict["view"])
+    if view is None or not request.matchdict["task_id"].startswith(task_prefix):
+        return HTTPNotFound(content={"reason": "Task not found"})
+    return await view(context, request, TaskState(request.matchdict["task_id"]))
+
 
 @configure.service(
     method="DELETE",
@@ -88,3 +191,145 @@ async def cancel_task(context, request):
         return await task.cancel()
     except TaskNotFoundException:
         return HTTPNotFound(content={"reason": "Task not found"})
+
+
+# Task ids @amqp-tasks/@status accepts at once
+MAX_STATUS_TASKS = 1000
+
+
+def _is_str_list(value):
+    return isinstance(value, list) and all(isinstance(item, str) for item in value)
+
+
+async def tasks_status(context, request):
+    """Body: task_ids, and optionally the fields to return. Tasks not
+    found, or of other containers, are null
+    """
+    data = await request.json()
+    if not isinstance(data, dict):
+        return HTTPPreconditionFailed(content={"reason": "Invalid body"})
+    task_ids = data.get("task_ids")
+    fields = data.get("fields")
+    if not _is_str_list(task_ids) or len(task_ids) > MAX_STATUS_TASKS:
+        return HTTPPreconditionFailed(
+            content={
+                "reason": f"task_ids must be a list of up to {MAX_STATUS_TASKS} strings"
+            }
+        )
+    if fields is not None and not _is_str_list(fields):
+        return HTTPPreconditionFailed(
+            content={"reason": "fields must be a list of strings"}
+        )
+
+    task_prefix = get_task_id_prefix()
+    states = await TaskState.get_states(
+        [task_id for task_id in task_ids if task_id.startswith(task_prefix)],
+        fields=fields,
+    )
+    debug = can_debug_amqp(context)
+    result = {}
+    for task_id in task_ids:
+        state = states.get(task_id)
+        if state is not None and not debug:
+            state.pop("job_data", None)
+        result[task_id] = state
+    return result
+
+
+async def cancel_tasks_view(context, request):
+    """Body filters, all optional: function (dotted name), status
+    (scheduled, running, errored or sleeping) and created_before
+    (timestamp or ISO date, in UTC unless it has an offset)
+    """
+    data = await request.json()
+    if not isinstance(data, dict):
+        return HTTPPreconditionFailed(content={"reason": "Invalid body"})
+    function = data.get("function")
+    if function is not None and not isinstance(function, str):
+        return HTTPPreconditionFailed(content={"reason": "Invalid function"})
+    status = data.get("status")
+    if status is not None and (
+        not isinstance(status, str)
+        or status in DONE_STATUSES
+        or status not in vars(TaskStatus).values()
+    ):
+        return HTTPPreconditionFailed(content={"reason": "Invalid status"})
+    created_before = data.get("created_before")
+    if isinstance(created_before, str):
+        try:
+            created_before = datetime.datetime.fromisoformat(created_before)
+        except ValueError:
+            return HTTPPreconditionFailed(content={"reason": "Invalid created_before"})
+        if created_before.tzinfo is None:
+            created_before = created_before.replace(tzinfo=datetime.timezone.utc)
+        created_before = created_before.timestamp()
+    elif created_before is not None and (
+        isinstance(created_before, bool) or not isinstance(created_before, (int, float))
+    ):
+        return HTTPPreconditionFailed(content={"reason": "Invalid created_before"})
+    canceled = await cancel_tasks(
+        function=function, status=status, created_before=created_before
+    )
+    return {"canceled": canceled}
+
+
+# Like _task_views, actions on many tasks share a service, each with
+# its own permission
+_task_actions = {
+    "@status": (tasks_status, "guillotina.AccessContent"),
+    "@cancel": (cancel_tasks_view, "guillotina.ManageAMQP"),
+}
+
+
+@configure.service(
+    method="POST",
+    name="@amqp-tasks/{action}",
+    context=IContainer,
+    permission="guillotina.AccessContent",
+    summary="Reads the info (@status) or cancels (@cancel) many tasks",
+)
+async def tasks_action(context, request):
+    action = _task_actions.get(request.matchdict["action"])
+    if action is None:
+        return HTTPNotFound(content={"reason": "Action not found"})
+    view, permission = action
+    if not get_security_policy().check_permission(permission, context):
+        return HTTPUnauthorized(content={"reason": "Not allowed"})
+    return await view(context, request)
+
+
+@configure.service(
+    method="GET",
+    name="@amqp-profiles",
+    context=IContainer,
+    permission="guillotina.DebugAMQP",
+    summary="Profile of a task function (function query parameter), "
+    "aggregated over its profiled executions",
+)
+async def get_profile_view(context, request):
+    function = request.query.get("function")
+    if not function:
+        return HTTPPreconditionFailed(content={"reason": "function is required"})
+    return await get_profile(function)
+
+
+@configure.service(
+    method="POST",
+    name="@amqp-profiles",
+    context=IContainer,
+    permission="guillotina.DebugAMQP",
+    summary="Profiles the next executions of a task function",
+)
+async def profile_function(context, request):
+    """Body: function (as in the job metrics) and executions"""
+    data = await request.json()
+    function = data.get("function")
+    executions = data.get("executions", 1)
+    if not function or not isinstance(function, str):
+        return HTTPPreconditionFailed(content={"reason": "function is required"})
+    if not isinstance(executions, int) or executions < 1:
+        return HTTPPreconditionFailed(
+            content={"reason": "executions must be a positive integer"}
+        )
+    remaining = await mark_profiled(function, executions)
+    return {"function": function, "remaining": remaining}
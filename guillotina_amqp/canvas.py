@@ -0,0 +1,349 @@
+"""Groups, chains and chords of tasks.
+
+Tasks never wait for each other: the data of each task carries what to
+schedule once it finishes, and the worker finishing it publishes the
+following tasks. Group members count their completions with an atomic
+counter, and the last one to finish publishes the callback.
+
+When a task fails for good, the tasks that would follow it are errored
+instead, so nothing waits for them forever.
+"""
+
+from guillotina import app_settings
+from guillotina import glogging
+from guillotina.utils import get_content_path
+from guillotina.utils import get_dotted_name
+from guillotina_amqp.state import get_state_manager
+from guillotina_amqp.state import TaskState
+from guillotina_amqp.state import TaskStatus
+from guillotina_amqp.state import update_task_status
+from guillotina_amqp.utils import _run_chunk
+from guillotina_amqp.utils import _run_object_chunk
+from guillotina_amqp.utils import add_task
+from guillotina_amqp.utils import generate_task_id
+from guillotina_amqp.utils import publish_task_data
+
+import asyncio
+import itertools
+import json
+import uuid
+
+
+logger = glogging.getLogger("guillotina_amqp.canvas")
+
+
+def group_key(group_id):
+    """Number of finished members of the group"""
+    return f"group:{group_id}"
+
+
+def group_failed_key(group_id):
+    """Number of members of the group that failed for good"""
+    return f"group:{group_id}:failed"
+
+
+def group_members_key(group_id):
+    return f"group:{group_id}:members"
+
+
+def group_items_key(group_id):
+    """Number of items processed by the finished chunks of a map"""
+    return f"group:{group_id}:items"
+
+
+def group_total_key(group_id):
+    return f"group:{group_id}:total"
+
+
+class Signature:
+    """A task definition with its arguments, to be scheduled later.
+
+    In a chain, and as the callback of a chord, tasks get the result of
+    what ran before as first argument, unless the signature is immutable.
+    """
+
+    def __init__(self, definition, args=(), kwargs=None, immutable=False):
+        self.definition = definition
+        self.args = list(args)
+        self.kwargs = kwargs or {}
+        self.immutable = immutable
+        # Known before scheduling, so the whole canvas can be followed
+        self.task_id = generate_task_id()
+
+    def to_dict(self):
+        return {
+            "func": get_dotted_name(self.definition.func),
+            "args": self.args,
+            "kwargs": self.kwargs,
+            "immutable": self.immutable,
+            "task_id": self.task_id,
+            "dest_queue": self.definition.dest_queue,
+            "retries": self.definition.retries,
+        }
+
+    async def schedule(self, _request=None, _canvas=None):
+        return await add_task(
+            self.definition.func,
+            *self.args,
+            _request=_request,
+            _retries=self.definition.retries,
+            _task_id=self.task_id,
+            _canvas=_canvas,
+            dest_queue=self.definition.dest_queue,
+            **self.kwargs,
+        )
+
+
+class chain:
+    """Runs tasks one after the other"""
+
+    def __init__(self, *signatures):
+        if not signatures:
+            raise ValueError("Empty chain")
+        self.signatures = signatures
+
+    async def schedule(self, _request=None):
+        """Schedules the first task. Returns the states of all of them"""
+        first, *following = self.signatures
+        canvas = None
+        if following:
+            canvas = {"chain": [signature.to_dict() for signature in following]}
+        await first.schedule(_request=_request, _canvas=canvas)
+        return [TaskState(signature.task_id) for signature in self.signatures]
+
+
+class group:
+    """Runs tasks in parallel"""
+
+    def __init__(self, *signatures):
+        if not signatures:
+            raise ValueError("Empty group")
+        self.signatures = signatures
+
+    async def schedule(self, _request=None, _callback=None):
+        group_id = uuid.uuid4().hex
+        task_ids = [signature.task_id for signature in self.signatures]
+        await get_state_manager().set_value(
+            group_members_key(group_id),
+            json.dumps(task_ids).encode("utf8"),
+            ttl=int(app_settings["amqp"]["state_ttl"]),
+        )
+        canvas = {
+            "group": {
+                "id": group_id,
+                "size": len(task_ids),
+                "callback": _callback.to_dict() if _callback else None,
+            }
+        }
+        for signature in self.signatures:
+            await signature.schedule(_request=_request, _canvas=canvas)
+        return GroupResult(group_id)
+
+
+class chord:
+    """Runs a group of tasks in parallel, then a callback with the list
+    of their results
+    """
+
+    def __init__(self, header, callback):
+        if not isinstance(header, group):
+            header = group(*header)
+        self.header = header
+        self.callback = callback
+
+    async def schedule(self, _request=None):
+        """Schedules the group. Returns the state of the callback"""
+        await self.header.schedule(_request=_request, _callback=self.callback)
+        return TaskState(self.callback.task_id)
+
+
+class GroupResult:
+    def __init__(self, group_id):
+        self.group_id = group_id
+
+    async def task_ids(self):
+        data = await get_state_manager().get_value(group_members_key(self.group_id))
+        return json.loads(data) if data else []
+
+    async def completed(self):
+        """Number of members that finished"""
+        return await get_state_manager().get_counter(group_key(self.group_id))
+
+    async def failed(self):
+        """Number of members that failed for good"""
+        return await get_state_manager().get_counter(group_failed_key(self.group_id))
+
+    async def results(self):
+        task_ids = await self.task_ids()
+        return list(
+            await asyncio.gather(
+                *(TaskState(task_id).get_result() for task_id in task_ids)
+            )
+        )
+
+
+class MapResult(GroupResult):
+    """Group of the chunks of a map"""
+
+    async def progress(self):
+        """Finished chunks and processed items, out of the totals.
+        Totals are None until all the chunks are published.
+        """
+        state_manager = get_state_manager()
+        total = await state_manager.get_value(group_total_key(self.group_id))
+        total = json.loads(total) if total else {"chunks": None, "items": None}
+        return {
+            "chunks": total["chunks"],
+            "items": total["items"],
+            "finished_chunks": await self.completed(),
+            "failed_chunks": await self.failed(),
+            "processed_items": await state_manager.get_counter(
+                group_items_key(self.group_id)
+            ),
+        }
+
+    async def results(self):
+        """Results of all the items, in order"""
+        return list(itertools.chain.from_iterable(await super().results()))
+
+
+async def _chunks(iterable, size):
+    """Lists of up to size items, read lazily from a sync or async
+    iterable
+    """
+    if hasattr(iterable, "__aiter__"):
+        chunk = []
+        async for item in iterable:
+            chunk.append(item)
+            if len(chunk) == size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+        return
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+async def map_chunks(definition, iterable, chunk_size, ob=None, _request=None):
+    """Schedules one task per chunk of chunk_size items of iterable.
+    Each one calls the function of definition with every item of its
+    chunk (after ob for object tasks), and returns the list of results.
+
+    Chunks are published as they are read, so the iterable is never
+    held in memory.
+    """
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be positive")
+    if ob is None:
+        func, args = _run_chunk, [get_dotted_name(definition.func)]
+    else:
+        func = _run_object_chunk
+        args = [get_dotted_name(definition.func), get_content_path(ob)]
+    ttl = int(app_settings["amqp"]["state_ttl"])
+    group_id = uuid.uuid4().hex
+    task_ids = []
+    items = 0
+    async for chunk in _chunks(iterable, chunk_size):
+        task_id = generate_task_id()
+        canvas = {
+            "group": {"id": group_id, "size": None, "callback": None},
+            "items": len(chunk),
+        }
+        await add_task(
+            func,
+            *args,
+            chunk,
+            _request=_request,
+            _retries=definition.retries,
+            _task_id=task_id,
+            _canvas=canvas,
+            dest_queue=definition.dest_queue,
+        )
+        task_ids.append(task_id)
+        items += len(chunk)
+    state_manager = get_state_manager()
+    await state_manager.set_value(
+        group_members_key(group_id), json.dumps(task_ids).encode("utf8"), ttl=ttl
+    )
+    await state_manager.set_value(
+        group_total_key(group_id),
+        json.dumps({"chunks": len(task_ids), "items": items}).encode("utf8"),
+        ttl=ttl,
+    )
+    return MapResult(group_id)
+
+
+async def on_task_finished(data, result):
+    """Publishes what follows the finished task of the given job data"""
+    canvas = data.get("canvas")
+    if not canvas:
+        return
+    if "chain" in canvas:
+        following, *rest = canvas["chain"]
+        await _publish(data, following, result, {"chain": rest} if rest else None)
+    if "group" in canvas:
+        info = canvas["group"]
+        ttl = int(app_settings["amqp"]["state_ttl"])
+        finished = await get_state_manager().incr_counter(group_key(info["id"]), ttl)
+        if "items" in canvas:
+            await get_state_manager().incr_counter(
+                group_items_key(info["id"]), ttl, amount=canvas["items"]
+            )
+        if finished == info["size"] and info["callback"] is not None:
+            logger.info(f"Group {info['id']} finished")
+            results = await GroupResult(info["id"]).results()
+            await _publish(data, info["callback"], results, None)
+
+
+async def on_task_failed(data, error):
+    """Errors what follows the task of the given job data, which failed
+    for good: the rest of its chain, and the callback of its group
+    """
+    canvas = data.get("canvas")
+    if not canvas:
+        return
+    reason = f"Task {data['task_id']} failed: {error}"
+    if "chain" in canvas:
+        for signature in canvas["chain"]:
+            await _fail(signature, reason)
+    if "group" in canvas:
+        info = canvas["group"]
+        ttl = int(app_settings["amqp"]["state_ttl"])
+        failed = await get_state_manager().incr_counter(
+            group_failed_key(info["id"]), ttl
+        )
+        if failed == 1 and info["callback"] is not None:
+            logger.warning(f"Group {info['id']} failed. {reason}")
+            await _fail(info["callback"], reason)
+
+
+async def _fail(signature, error):
+    await update_task_status(
+        get_state_manager(), signature["task_id"], TaskStatus.ERRORED, error=error
+    )
+
+
+async def _publish(parent, signature, result, canvas):
+    """Publishes the task of signature with the request of the parent job"""
+    args = list(signature["args"])
+    if not signature["immutable"]:
+        args.insert(0, result)
+    data = {
+        "func": signature["func"],
+        "args": args,
+        "kwargs": signature["kwargs"],
+        "db_id": parent["db_id"],
+        "container_id": parent["container_id"],
+        "req_data": parent["req_data"],
+        "task_id": signature["task_id"],
+    }
+    if canvas is not None:
+        data["canvas"] = canvas
+    await publish_task_data(
+        data, dest_queue=signature["dest_queue"], _retries=signature["retries"]
+    )
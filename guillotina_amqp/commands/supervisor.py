@@ -0,0 +1,291 @@
+from guillotina import glogging
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+
+import asyncio
+import importlib
+import os
+import shutil
+import signal
+import tempfile
+import time
+
+
+try:
+    import prometheus_client
+    from prometheus_client.core import Metric
+    from prometheus_client.parser import text_string_to_metric_families
+except ImportError:
+    prometheus_client = None  # type: ignore
+
+
+logger = glogging.getLogger("guillotina_amqp")
+
+# Types of metrics whose samples only go up. They have a _created
+# sample, exposed as a gauge family of its own in the text format
+_CUMULATIVE_TYPES = ("counter", "histogram", "summary")
+
+
+def _is_timestamp(name, family, cumulative):
+    """Whether the sample holds a point in time instead of an amount: the
+    _created of cumulative metrics, named after one of cumulative, and
+    process start times. They can not be added up, the oldest one is
+    kept instead.
+    """
+    if name.endswith("_start_time_seconds"):
+        return True
+    if not name.endswith("_created"):
+        return False
+    return family.type in _CUMULATIVE_TYPES or name[: -len("_created")] in cumulative
+
+
+def merge_metrics(outputs, types=None):
+    """Merges the prometheus text outputs of several processes into a
+    single one, adding up the values of identical samples. Only the
+    families of the given types are merged, if any.
+    """
+    families = {}
+    parsed = [list(text_string_to_metric_families(output)) for output in outputs]
+    cumulative = {
+        family.name
+        for output in parsed
+        for family in output
+        if family.type in _CUMULATIVE_TYPES
+    }
+    for output in parsed:
+        for family in output:
+            if types is not None and family.type not in types:
+                continue
+            merged = families.get(family.name)
+            if merged is None:
+                merged = families[family.name] = (
+                    Metric(family.name, family.documentation, family.type),
+                    {},
+                )
+            samples = merged[1]
+            for sample in family.samples:
+                key = (sample.name, tuple(sorted(sample.labels.items())))
+                if key not in samples:
+                    samples[key] = sample.value
+                elif _is_timestamp(sample.name, family, cumulative):
+                    samples[key] = min(samples[key], sample.value)
+                else:
+                    samples[key] += sample.value
+
+    metrics = []
+    for metric, samples in families.values():
+        for (name, labels), value in samples.items():
+            metric.add_sample(name, dict(labels), value)
+        metrics.append(metric)
+
+    registry = prometheus_client.CollectorRegistry()
+    registry.register(_StaticCollector(metrics))
+    return prometheus_client.exposition.generate_latest(registry).decode("utf8")
+
+
+class _StaticCollector:
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def collect(self):
+        return self.metrics
+
+
+async def dump_metrics(path, interval=5):
+    """Periodically writes the metrics of the current process to path,
+    so that the supervisor can serve them.
+    """
+    while True:
+        try:
+            output = prometheus_client.exposition.generate_latest()
+            with open(path + ".tmp", "wb") as fi:
+                fi.write(output)
+            os.replace(path + ".tmp", path)
+        except Exception:
+            logger.warning("Error dumping worker metrics", exc_info=True)
+        await asyncio.sleep(interval)
+
+
+class WorkerSupervisor:
+    """Runs several worker processes out of a single command.
+
+    Application modules are imported before forking, so the children
+    share them with the supervisor. Dead children are restarted, and the
+    signals received by the supervisor are forwarded to all of them.
+
+    When a metrics port is given, the supervisor serves the metrics of
+    all children added up. The counters of dead children are kept, so
+    the merged ones don't go backwards when a child is restarted.
+    """
+
+    poll_interval = 0.5
+    restart_delay = 1
+    stop_timeout = 60
+
+    def __init__(self, command, settings, processes, metrics_port=None):
+        self.command = command
+        self.settings = settings
+        self.processes = processes
+        self.metrics_port = metrics_port
+        self.metrics_dir = None
+        # Cumulative metrics of the dead children, added up
+        self.retired_metrics = ""
+        # pid -> process index
+        self.children = {}
+        self._started = {}
+        self._stopping_since = None
+
+    @property
+    def stopping(self):
+        return self._stopping_since is not None
+
+    def preload(self):
+        """Imports the application modules, so children don't have to"""
+        for name in self.settings.get("applications", []):
+            try:
+                importlib.import_module(name)
+            except ImportError:
+                logger.warning(f"Could not preload application {name}", exc_info=True)
+
+    def metrics_path(self, pid):
+        return os.path.join(self.metrics_dir, f"{pid}.prom")
+
+    def spawn(self, index):
+        pid = os.fork()
+        if pid == 0:
+            self._run_child(index)
+        logger.info(f"Started worker process {index}: {pid}")
+        self.children[pid] = index
+        self._started[index] = time.monotonic()
+        return pid
+
+    def _run_child(self, index):
+        code = 0
+        try:
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                signal.signal(signum, signal.SIG_DFL)
+            metrics_path = None
+            if self.metrics_dir is not None:
+                metrics_path = self.metrics_path(os.getpid())
+            self.command.run_child(self.settings, index, metrics_path=metrics_path)
+        except BaseException:
+            logger.error(f"Worker process {index} failed", exc_info=True)
+            code = 1
+        finally:
+            os._exit(code)
+
+    def handle_signal(self, signum, frame):
+        if not self.stopping:
+            logger.warning(f"Stopping worker processes (signal {signum})")
+            self._stopping_since = time.monotonic()
+        self.kill_children(signum)
+
+    def kill_children(self, signum):
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def reap(self):
+        """Collects exited children, and restarts them unless stopping"""
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self.children.clear()
+                return
+            if pid == 0:
+                return
+            index = self.children.pop(pid, None)
+            if self.metrics_dir is not None:
+                self.retire_metrics(pid)
+            if index is None or self.stopping:
+                continue
+            logger.error(
+                f"Worker process {index} ({pid}) exited with status {status}, "
+                "restarting"
+            )
+            if time.monotonic() - self._started.get(index, 0) < self.restart_delay:
+                # Do not restart in a tight loop if children die at startup
+                time.sleep(self.restart_delay)
+            self.spawn(index)
+
+    def retire_metrics(self, pid):
+        """Adds the last cumulative metrics of a dead child to the
+        retired ones, and removes its metrics file
+        """
+        path = self.metrics_path(pid)
+        try:
+            with open(path) as fi:
+                output = fi.read()
+        except FileNotFoundError:
+            return
+        self.retired_metrics = merge_metrics(
+            [self.retired_metrics, output], types=_CUMULATIVE_TYPES
+        )
+        os.remove(path)
+
+    def collect_metrics(self):
+        outputs = [self.retired_metrics]
+        for pid in list(self.children):
+            try:
+                with open(self.metrics_path(pid)) as fi:
+                    outputs.append(fi.read())
+            except FileNotFoundError:
+                continue
+        return merge_metrics(outputs)
+
+    def make_metrics_server(self):
+        supervisor = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                output = supervisor.collect_metrics().encode("utf8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(output)))
+                self.end_headers()
+                self.wfile.write(output)
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        server = HTTPServer(("", self.metrics_port), MetricsHandler)
+        server.timeout = self.poll_interval
+        return server
+
+    def run(self):
+        self.preload()
+        server = None
+        if self.metrics_port and prometheus_client is not None:
+            self.metrics_dir = tempfile.mkdtemp(prefix="amqp-worker-metrics-")
+            server = self.make_metrics_server()
+
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self.handle_signal)
+
+        try:
+            for index in range(self.processes):
+                self.spawn(index)
+
+            while self.children:
+                if server is not None:
+                    server.handle_request()
+                else:
+                    time.sleep(self.poll_interval)
+                self.reap()
+                if (
+                    self.stopping
+                    and time.monotonic() - self._stopping_since > self.stop_timeout
+                ):
+                    logger.error("Worker processes did not stop in time, killing")
+                    self.kill_children(signal.SIGKILL)
+        finally:
+            if server is not None:
+                server.server_close()
+            if self.metrics_dir is not None:
+                shutil.rmtree(self.metrics_dir, ignore_errors=True)
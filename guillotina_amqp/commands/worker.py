@@ -1,19 +1,45 @@
 from aiohttp import web
 from guillotina import glogging
 from guillotina import task_vars
+from guillotina.commands import get_settings
 from guillotina.commands.server import ServerCommand
 from guillotina.tests.utils import get_mocked_request
+from guillotina_amqp.commands.supervisor import dump_metrics
+from guillotina_amqp.commands.supervisor import WorkerSupervisor
+from guillotina_amqp.metrics import label_value
+from guillotina_amqp.metrics import track_label
 from guillotina_amqp.worker import Worker
 
 import asyncio
 import os
+import signal
+import sys
 import threading
+import time
+import traceback
 
 
 try:
+    from prometheus_client.utils import INF
+
     import prometheus_client
+
+    LOOP_LAG = prometheus_client.Histogram(
+        "guillotina_amqp_worker_loop_lag_seconds",
+        "Delay of the event loop in running a callback scheduled by the "
+        "loop monitor",
+        buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0, 10.0, INF),
+    )
+    LOOP_BLOCKED = prometheus_client.Counter(
+        "guillotina_amqp_worker_loop_blocked_total",
+        "Times the event loop was blocked beyond the threshold, by the "
+        "function of the job running",
+        labelnames=["function"],
+    )
+    track_label("function", LOOP_BLOCKED)
 except ImportError:
     prometheus_client = None
+    LOOP_LAG = LOOP_BLOCKED = None  # type: ignore
 
 
 logger = glogging.getLogger("guillotina_amqp")
@@ -26,27 +52,78 @@ async def prometheus_view(request):
     return web.Response(text=output.decode("utf8"))
 
 
-def loop_check(loop, timeout):
-    # Elapsed time since last update
-    diff = loop.time() - getattr(loop, "__ping_time__", 0)
+class LoopMonitor(threading.Thread):
+    """Measures the lag of the event loop from a single thread, pinging
+    it every interval seconds.
 
-    if diff > timeout:
-        logger.error(f"Exiting worker because no activity in {diff} seconds")
-        os._exit(0)
-    else:
-        # Schedule a check again
-        threading.Timer(timeout / 4, loop_check, args=[loop, timeout]).start()
-        logger.debug(f"Last refreshed watchdog was {diff}s. ago")
+    When a ping is not answered in block_threshold seconds, the stack
+    of the loop thread and the job running are logged once. When it is
+    not answered in kill_after seconds, the process exits.
+    """
 
+    def __init__(self, loop, interval=0.1, block_threshold=1.0, kill_after=None):
+        super().__init__(name="amqp-loop-monitor", daemon=True)
+        self.loop = loop
+        self.interval = interval
+        self.block_threshold = block_threshold
+        self.kill_after = kill_after
+        # Last blocked loop report
+        self.blocked = None
+        self._loop_thread = None
+        self._sent = None
+        self._reported = False
+        self._stopped = threading.Event()
 
-async def loop_probe(loop):
-    """This method is used to trigger a context switching in the event
-    loop and measure elapsed time between runs (10s)
-    """
-    while True:
-        # Update the watchdog time
-        loop.__ping_time__ = loop.time()
-        await asyncio.sleep(10)
+    def start(self):
+        """Needs to be called from the thread running the loop"""
+        self._loop_thread = threading.get_ident()
+        super().start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            sent = self._sent
+            if sent is None:
+                self._sent = time.monotonic()
+                self.loop.call_soon_threadsafe(self._pong, self._sent)
+                continue
+            elapsed = time.monotonic() - sent
+            if elapsed > self.block_threshold and not self._reported:
+                self._reported = True
+                self.report(elapsed)
+            if self.kill_after and elapsed > self.kill_after:
+                logger.error(f"Exiting worker because loop blocked for {elapsed}s")
+                os._exit(0)
+
+    def _pong(self, sent):
+        lag = time.monotonic() - sent
+        if LOOP_LAG is not None:
+            LOOP_LAG.observe(lag)
+        if self._reported:
+            logger.warning(f"Event loop unblocked after {lag:.3f}s")
+        self._reported = False
+        self._sent = None
+
+    def report(self, elapsed):
+        frame = sys._current_frames().get(self._loop_thread)
+        stack = "".join(traceback.format_stack(frame)) if frame else ""
+        task = asyncio.current_task(self.loop)
+        job = getattr(task, "_job", None)
+        function = job.function_name if job is not None else "unknown"
+        self.blocked = {
+            "elapsed": elapsed,
+            "task_id": job.data.get("task_id") if job is not None else None,
+            "function": function,
+            "stack": stack,
+        }
+        if LOOP_BLOCKED is not None:
+            LOOP_BLOCKED.labels(function=label_value("function", function)).inc()
+        logger.error(
+            f"Event loop blocked for {elapsed:.3f}s running "
+            f"{self.blocked['task_id']} ({function}):\n{stack}"
+        )
 
 
 class WorkerCommand(ServerCommand):
@@ -54,6 +131,10 @@ class WorkerCommand(ServerCommand):
 
     description = "AMQP worker"
 
+    # Set on the processes forked by the supervisor
+    metrics_path = None
+    child = False
+
     def get_parser(self):
         parser = super().get_parser()
         parser.add_argument(
@@ -68,6 +149,24 @@ class WorkerCommand(ServerCommand):
             type=int,
             default=None,
         )
+        parser.add_argument(
+            "--queues",
+            help="Comma separated queues to consume from, optionally weighted "
+            "as name:weight (e.g. 'default:3,reindex'). Defaults to the configured queue",
+            default=None,
+        )
+        parser.add_argument(
+            "--thread-pool-size",
+            help="Threads to run synchronous task functions in",
+            type=int,
+            default=None,
+        )
+        parser.add_argument(
+            "--process-pool-size",
+            help="Processes to run task functions declared with executor='process' in",
+            type=int,
+            default=None,
+        )
         parser.add_argument(
             "--ignore-lock",
             help="Do not attempt process locking via redis",
@@ -79,18 +178,68 @@ class WorkerCommand(ServerCommand):
             default=False,
             action="store_true",
         )
+        parser.add_argument(
+            "--drain-timeout",
+            help="On SIGTERM, seconds to wait for running tasks before "
+            "requeuing them. Overwrites configuration parameter",
+            type=int,
+            default=None,
+        )
+        parser.add_argument(
+            "--processes",
+            help="Number of worker processes to fork. Metrics of all of them "
+            "are served together by --metrics-server",
+            type=int,
+            default=1,
+        )
         return parser
 
+    def run_command(self, settings=None, loop=None):
+        processes = getattr(self.arguments, "processes", 1) or 1
+        if processes <= 1 or self.child:
+            return super().run_command(settings=settings, loop=loop)
+
+        if settings is None:
+            settings = get_settings(
+                self.arguments.configuration, self.arguments.override
+            )
+        metrics_port = None
+        if self.arguments.metrics_server:
+            metrics_port = self.get_port(self.arguments, settings)
+        supervisor = WorkerSupervisor(
+            self, settings, processes, metrics_port=metrics_port
+        )
+        # Leave the children time to drain before killing them
+        supervisor.stop_timeout = self.get_drain_timeout(settings) + 30
+        supervisor.run()
+
+    def run_child(self, settings, index, metrics_path=None):
+        """Entry point of the processes forked by the supervisor"""
+        self.child = True
+        self.metrics_path = metrics_path
+        # Do not reuse anything from the supervisor loop
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.run_command(settings=settings)
+
+    def get_drain_timeout(self, settings):
+        if self.arguments.drain_timeout is not None:
+            return self.arguments.drain_timeout
+        return int(settings.get("amqp", {}).get("drain_timeout", 60))
+
+    def get_port(self, arguments, settings):
+        port = arguments.port or settings.get("address", settings.get("port"))
+        return port or 8080
+
     def run(self, arguments, settings, app):
         loop = self.get_loop()
-        if arguments.metrics_server:
+        if arguments.metrics_server and not self.child:
             asyncio.ensure_future(
                 self.run_worker(arguments, settings, app, loop=loop), loop=loop
             )
-            port = arguments.port or settings.get("address", settings.get("port"))
             app = web.Application()
             app.router.add_get("/metrics", prometheus_view)
-            web.run_app(app, port=port or 8080, loop=loop)
+            web.run_app(app, port=self.get_port(arguments, settings), loop=loop)
         else:
             loop.run_until_complete(self.run_worker(arguments, settings, app))
 
@@ -113,15 +262,43 @@ class WorkerCommand(ServerCommand):
             loop,
             arguments.max_running_tasks,
             ignore_lock=arguments.ignore_lock,
+            queues=arguments.queues,
+            thread_pool_size=arguments.thread_pool_size,
+            process_pool_size=arguments.process_pool_size,
         )
         await worker.start()
 
+        loop.add_signal_handler(
+            signal.SIGTERM,
+            lambda: asyncio.ensure_future(
+                self.shutdown(worker, self.get_drain_timeout(settings))
+            ),
+        )
+
+        if self.metrics_path is not None and prometheus_client is not None:
+            loop.create_task(dump_metrics(self.metrics_path))
+
         timeout = arguments.auto_kill_timeout
-        if timeout > 0:
-            loop.create_task(loop_probe(loop))
-            # We need to run this outside the main loop and the current thread
-            threading.Timer(timeout / 4, loop_check, args=[loop, timeout]).start()
+        amqp_settings = settings.get("amqp", {})
+        monitor = LoopMonitor(
+            loop,
+            interval=amqp_settings.get("loop_monitor_interval", 0.1),
+            block_threshold=amqp_settings.get("loop_block_threshold", 1.0),
+            kill_after=timeout if timeout > 0 else None,
+        )
+        monitor.start()
 
         while True:
             # make this run forever...
             await asyncio.sleep(999999)
+
+    async def shutdown(self, worker, timeout):
+        """Drains the worker and exits"""
+        if worker._draining:
+            return
+        try:
+            await worker.drain(timeout)
+            await worker.stop()
+        except Exception:
+            logger.error("Error draining worker", exc_info=True)
+        os._exit(0)
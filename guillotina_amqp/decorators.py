@@ -1,20 +1,53 @@
 from functools import partial
 from guillotina.transactions import get_transaction
 from guillotina.utils import get_current_request
+from guillotina.utils import get_dotted_name
+from guillotina_amqp.canvas import map_chunks
+from guillotina_amqp.canvas import Signature
+from guillotina_amqp.executors import EXECUTORS
+from guillotina_amqp.executors import PROCESS
 from guillotina_amqp.interfaces import ITaskDefinition
+from guillotina_amqp.utils import add_debounced_object_task
 from guillotina_amqp.utils import add_object_task
 from guillotina_amqp.utils import add_task
+from guillotina_amqp.utils import get_object_task_call
+from guillotina_amqp.utils import get_task_batch
+from guillotina_amqp.utils import register_task
 from zope.interface import implementer
 
+import inspect
 import uuid
 
 
 @implementer(ITaskDefinition)
 class TaskDefinition:
-    def __init__(self, func, retries=3, dest_queue=None):
+    def __init__(
+        self,
+        func,
+        retries=3,
+        dest_queue=None,
+        executor=None,
+        *,
+        stream_results=False,
+        result_ttl=None,
+    ):
+        if executor is not None:
+            if executor not in EXECUTORS:
+                raise ValueError(f"Unknown executor: {executor}")
+            if inspect.iscoroutinefunction(func) or inspect.isasyncgenfunction(func):
+                raise ValueError("Only synchronous functions can run in an executor")
         self.func = func
         self.retries = retries
         self.dest_queue = dest_queue
+        # Pool plain functions run in. Defaults to threads
+        self.executor = executor
+        # Generator results are appended to a stream instead of being
+        # returned in a list
+        self.stream_results = stream_results
+        # Seconds the result is kept. Defaults to the result_ttl setting
+        self.result_ttl = result_ttl
+        # Tasks are scheduled with the name of the function
+        register_task(self, get_dotted_name(func))
 
     async def __call__(self, *args, _request=None, **kwargs):
         return await add_task(
@@ -23,11 +56,29 @@ class TaskDefinition:
             _retries=self.retries,
             dest_queue=self.dest_queue,
             *args,
-            **kwargs
+            **kwargs,
         )
 
     schedule = __call__
 
+    def s(self, *args, **kwargs):
+        """Signature for chains, groups and chords. In chains it gets the
+        result of the previous task as first argument
+        """
+        return Signature(self, args, kwargs)
+
+    def si(self, *args, **kwargs):
+        """Signature that ignores the result of the previous task"""
+        return Signature(self, args, kwargs, immutable=True)
+
+    async def map(self, iterable, chunk_size=100, _request=None):
+        """Calls the function with each item of iterable, in tasks of
+        chunk_size items. Returns a MapResult
+        """
+        if inspect.isasyncgenfunction(self.func):
+            raise TypeError("Generator tasks can not be mapped")
+        return await map_chunks(self, iterable, chunk_size, _request=_request)
+
     def _get_request(self, request, kwargs):
         if request is None:
             if "request" in kwargs:
@@ -44,44 +95,155 @@ class TaskDefinition:
         request.add_future(_name, partial(self.schedule, *args, **kwargs))
         return _name
 
+    def _get_task_call(self, args):
+        return self.func, args
+
+    def _can_batch(self, kwargs):
+        # Deduplicated tasks need to be published one by one
+        return "dedupe_key" not in kwargs
+
     def after_commit(self, *args, _request=None, **kwargs):
+        """Schedules the task once the transaction commits. All the tasks
+        of the transaction are published together
+        """
         txn = get_transaction()
-        txn.add_after_commit_hook(partial(self.schedule, *args, **kwargs))
+        if not self._can_batch(kwargs):
+            txn.add_after_commit_hook(partial(self.schedule, *args, **kwargs))
+            return
+        func, args = self._get_task_call(args)
+        batch = get_task_batch(txn, request=_request)
+        batch.add(func, args, kwargs, self.dest_queue, self.retries)
 
     def before_commit(self, *args, _request=None, **kwargs):
         txn = get_transaction()
-        txn.add_before_commit_hook(partial(self.schedule, *args, **kwargs))
+        if not self._can_batch(kwargs):
+            txn.add_before_commit_hook(partial(self.schedule, *args, **kwargs))
+            return
+        func, args = self._get_task_call(args)
+        batch = get_task_batch(txn, before_commit=True, request=_request)
+        batch.add(func, args, kwargs, self.dest_queue, self.retries)
 
 
 class ObjectTaskDefinition(TaskDefinition):
+    def __init__(
+        self,
+        func,
+        retries=3,
+        dest_queue=None,
+        executor=None,
+        *,
+        stream_results=False,
+        result_ttl=None,
+        debounce=None,
+    ):
+        if executor == PROCESS:
+            # Content objects can not be sent to another process
+            raise ValueError("Object tasks can not run in a process executor")
+        if debounce and inspect.isasyncgenfunction(func):
+            raise ValueError("Generator tasks can not be debounced")
+        super().__init__(
+            func,
+            retries=retries,
+            dest_queue=dest_queue,
+            executor=executor,
+            stream_results=stream_results,
+            result_ttl=result_ttl,
+        )
+        # Seconds without being scheduled again for the same object
+        # before running, with the last arguments
+        self.debounce = debounce
+
     async def __call__(self, *args, _request=None, **kwargs):
+        if self.debounce:
+            return await add_debounced_object_task(
+                self.func,
+                *args,
+                _debounce=self.debounce,
+                _request=_request,
+                _retries=self.retries,
+                dest_queue=self.dest_queue,
+                **kwargs,
+            )
         return await add_object_task(
             self.func,
             _request=_request,
             _retries=self.retries,
             dest_queue=self.dest_queue,
             *args,
-            **kwargs
+            **kwargs,
         )
 
     schedule = __call__
 
-
-def task(func=None, retries=3, dest_queue=None):
+    def _get_task_call(self, args):
+        ob, *args = args
+        return get_object_task_call(self.func, ob, tuple(args))
+
+    def _can_batch(self, kwargs):
+        # Debounced tasks coalesce by themselves
+        return not self.debounce and super()._can_batch(kwargs)
+
+    def s(self, *args, **kwargs):
+        raise TypeError("Object tasks can not be part of a canvas")
+
+    si = s
+
+    async def map(self, ob, iterable, chunk_size=100, _request=None):
+        """Calls the function with ob and each item of iterable, in tasks
+        of chunk_size items. Returns a MapResult
+        """
+        if inspect.isasyncgenfunction(self.func):
+            raise TypeError("Generator tasks can not be mapped")
+        return await map_chunks(self, iterable, chunk_size, ob=ob, _request=_request)
+
+
+def task(
+    func=None,
+    retries=3,
+    dest_queue=None,
+    executor=None,
+    *,
+    stream_results=False,
+    result_ttl=None,
+):
+    options = dict(
+        retries=retries,
+        dest_queue=dest_queue,
+        executor=executor,
+        stream_results=stream_results,
+        result_ttl=result_ttl,
+    )
     if func is not None:
-        return TaskDefinition(func, retries=retries, dest_queue=dest_queue)
+        return TaskDefinition(func, **options)
 
     def wrapper(f):
-        return TaskDefinition(f, retries=retries, dest_queue=dest_queue)
+        return TaskDefinition(f, **options)
 
     return wrapper
 
 
-def object_task(func=None, retries=3, dest_queue=None):
+def object_task(
+    func=None,
+    retries=3,
+    dest_queue=None,
+    executor=None,
+    *,
+    stream_results=False,
+    result_ttl=None,
+    debounce=None,
+):
+    options = dict(
+        retries=retries,
+        dest_queue=dest_queue,
+        executor=executor,
+        stream_results=stream_results,
+        result_ttl=result_ttl,
+        debounce=debounce,
+    )
     if func is not None:
-        return ObjectTaskDefinition(func, retries=retries, dest_queue=dest_queue)
+        return ObjectTaskDefinition(func, **options)
 
     def wrapper(f):
-        return ObjectTaskDefinition(f, retries=retries, dest_queue=dest_queue)
+        return ObjectTaskDefinition(f, **options)
 
     return wrapper
@@ -27,4 +27,18 @@ class AMQPConfigurationNotFoundError(Exception):
 
 
 class DelayTaskException(Exception):
+    """Sends the task back through the delay queue. delay shortens the
+    time it waits there (in seconds), data updates the job data sent
+    back, and status is the status of the task meanwhile. Tasks sent
+    back as scheduled are not counted as run.
+    """
+
+    def __init__(self, *args, delay=None, data=None, status="sleeping"):
+        super().__init__(*args)
+        self.delay = delay
+        self.data = data
+        self.status = status
+
+
+class ResultTooLargeException(Exception):
     pass
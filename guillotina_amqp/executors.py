@@ -0,0 +1,110 @@
+from concurrent.futures import Executor
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from guillotina import app_settings
+from guillotina import glogging
+from guillotina.utils import resolve_dotted_name
+from guillotina_amqp.interfaces import ITaskDefinition
+from typing import Dict
+
+import asyncio
+import contextvars
+
+
+logger = glogging.getLogger("guillotina_amqp.executors")
+
+THREAD = "thread"
+PROCESS = "process"
+EXECUTORS = (THREAD, PROCESS)
+
+_pools: Dict[str, Executor] = {}
+_sizes: Dict[str, int] = {}
+
+
+def configure_executors(thread_pool_size=None, process_pool_size=None):
+    """Overrides the configured pool sizes. Needs to be called before
+    the pools are used for the first time.
+    """
+    if thread_pool_size is not None:
+        _sizes[THREAD] = thread_pool_size
+    if process_pool_size is not None:
+        _sizes[PROCESS] = process_pool_size
+
+
+def get_executor(kind):
+    """Returns the worker-level pool of the given kind, creating it on
+    first use. Sizes default to the python defaults.
+    """
+    pool = _pools.get(kind)
+    if pool is None:
+        size = _sizes.get(kind) or app_settings["amqp"].get(f"{kind}_pool_size")
+        if kind == THREAD:
+            pool = ThreadPoolExecutor(max_workers=size, thread_name_prefix="amqp-task")
+        elif kind == PROCESS:
+            pool = ProcessPoolExecutor(max_workers=size)
+        else:
+            raise ValueError(f"Unknown executor: {kind}")
+        _pools[kind] = pool
+    return pool
+
+
+def shutdown_executors(wait=False):
+    for kind in list(_pools):
+        pool = _pools.pop(kind)
+        try:
+            pool.shutdown(wait=wait)
+        except Exception:
+            logger.warning(f"Error shutting down {kind} pool", exc_info=True)
+
+
+def _run_dotted(dotted_name, args, kwargs):
+    """Runs in the pool process: functions can not be pickled, so they
+    are resolved again by name.
+    """
+    func = resolve_dotted_name(dotted_name)
+    if ITaskDefinition.providedBy(func):
+        func = func.func
+    return func(*args, **kwargs)
+
+
+def _map(func, items):
+    return [func(item) for item in items]
+
+
+def _map_dotted(dotted_name, items):
+    func = resolve_dotted_name(dotted_name)
+    if ITaskDefinition.providedBy(func):
+        func = func.func
+    return _map(func, items)
+
+
+async def map_in_executor(kind, func, items, dotted_name=None):
+    """Calls a synchronous function with each of the items in a single
+    call to the pool of the given kind. Returns the list of results.
+    """
+    loop = asyncio.get_event_loop()
+    if kind == PROCESS:
+        call = partial(_map_dotted, dotted_name, items)
+    else:
+        context = contextvars.copy_context()
+        call = partial(context.run, _map, func, items)
+    return await loop.run_in_executor(get_executor(kind), call)
+
+
+async def run_in_executor(kind, func, args, kwargs, dotted_name=None):
+    """Runs a synchronous function in the pool of the given kind.
+
+    Threads see a copy of the context variables of the calling task
+    (request, container...). Processes only get the arguments.
+
+    Cancelling the awaiting task does not interrupt a function that is
+    already running: its result is discarded.
+    """
+    loop = asyncio.get_event_loop()
+    if kind == PROCESS:
+        call = partial(_run_dotted, dotted_name, args, kwargs)
+    else:
+        context = contextvars.copy_context()
+        call = partial(context.run, func, *args, **kwargs)
+    return await loop.run_in_executor(get_executor(kind), call)
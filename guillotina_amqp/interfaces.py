@@ -18,6 +18,15 @@ class IStateManagerUtility(Interface):
         """Gets whatever was stored in state manager for task_id"""
         raise NotImplementedError()
 
+    async def update_with_event(
+        self, task_id, data, key, event, channel=None, max_len=None, ttl=None
+    ):
+        """
+        Updates the state of the task and appends event to the stream in
+        key, publishing on channel
+        """
+        raise NotImplementedError()
+
     async def exists(self, task_id):
         """Returns whether a task id exists in the state manager"""
         raise NotImplementedError()
@@ -50,6 +59,13 @@ class IStateManagerUtility(Interface):
         """
         raise NotImplementedError()
 
+    async def release_many(self, task_ids):
+        """
+        Release the locks this worker owns among task_ids. Returns how
+        many were released
+        """
+        raise NotImplementedError()
+
     async def refresh_lock(self, task_id, ttl):
         """
         Update lock TTL
@@ -68,6 +84,155 @@ class IStateManagerUtility(Interface):
         """
         raise NotImplementedError()
 
+    async def update_many(self, task_ids, data, ttl=None):
+        """
+        Updates the state of all the tasks with data
+        """
+        raise NotImplementedError()
+
+    async def get_many(self, task_ids):
+        """
+        States of the tasks, {} for the ones not found
+        """
+        raise NotImplementedError()
+
+    async def cancel_many(self, task_ids):
+        """
+        Adds the task ids to the canceled set of tasks
+        """
+        raise NotImplementedError()
+
+    async def add_to_indexes(self, indexes, ttl=None):
+        """
+        Adds task ids to sorted indexes, given as {key: {task_id: score}}
+        """
+        raise NotImplementedError()
+
+    async def index_range(self, key, max_score=None, offset=0, count=None):
+        """
+        Task ids of the index with a score up to max_score, lowest first
+        """
+        raise NotImplementedError()
+
+    async def add_to_set(self, key, member, ttl=None):
+        """
+        Atomically adds member to the set of strings in key
+        """
+        raise NotImplementedError()
+
+    async def remove_from_set(self, key, members):
+        """
+        Atomically removes members from the set in key
+        """
+        raise NotImplementedError()
+
+    async def set_members(self, key):
+        """
+        Members of the set in key
+        """
+        raise NotImplementedError()
+
+    async def set_value(self, key, value, ttl=None):
+        """
+        Stores bytes under key
+        """
+        raise NotImplementedError()
+
+    async def get_value(self, key):
+        """
+        Bytes stored under key, or None
+        """
+        raise NotImplementedError()
+
+    async def set_if_absent(self, key, value, ttl=None):
+        """
+        Atomically stores value under key unless there is one already.
+        Returns whether it was stored
+        """
+        raise NotImplementedError()
+
+    async def replace_value(self, key, value, ttl=None):
+        """
+        Atomically stores value under key only if there is one already.
+        Returns whether it was stored
+        """
+        raise NotImplementedError()
+
+    async def pop_value(self, key):
+        """
+        Atomically deletes key, returning its value or None
+        """
+        raise NotImplementedError()
+
+    async def delete_value(self, key):
+        raise NotImplementedError()
+
+    async def delete_value_if(self, key, value):
+        """
+        Atomically deletes key only if it stores value. Returns whether
+        it was deleted
+        """
+        raise NotImplementedError()
+
+    async def incr_counter(self, key, ttl=None, amount=1):
+        """
+        Atomically increments the counter in key by amount, and returns
+        its new value
+        """
+        raise NotImplementedError()
+
+    async def get_counter(self, key):
+        """
+        Value of the counter in key, 0 if missing
+        """
+        raise NotImplementedError()
+
+    async def stream_append(
+        self, key, value, max_len=None, ttl=None, reset=False, channel=None
+    ):
+        """
+        Appends a value to the stream in key, keeping its last max_len
+        entries. Returns the id of the new entry
+        """
+        raise NotImplementedError()
+
+    async def stream_extend(
+        self, key, values, max_len=None, ttl=None, reset=False, channel=None
+    ):
+        """
+        Appends several values to a stream at once. Returns the id of the
+        last entry. Subscribers of channel are notified
+        """
+        raise NotImplementedError()
+
+    async def stream_append_many(self, entries, max_len=None, ttl=None):
+        """
+        Appends a value to each of many streams at once. entries are
+        (key, value, channel) tuples
+        """
+        raise NotImplementedError()
+
+    async def stream_range(self, key, after=None, count=None):
+        """
+        Returns up to count (id, value) entries of a stream, oldest first,
+        after the entry with id after
+        """
+        raise NotImplementedError()
+
+    async def stream_length(self, key):
+        """
+        Number of entries in a stream
+        """
+        raise NotImplementedError()
+
+    def subscribe(self, channel):
+        """
+        Async context manager yielding a subscription to channel. Its
+        wait(timeout) method returns True once notified since the last
+        call, or False on timeout
+        """
+        raise NotImplementedError()
+
 
 class ITaskDefinition(Interface):
     func = Attribute("actual function to run")
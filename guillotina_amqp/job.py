@@ -1,6 +1,7 @@
-from aiohttp import test_utils
 from aiohttp.helpers import noop
+from collections import deque
 from datetime import datetime
+from guillotina import app_settings
 from guillotina import glogging
 from guillotina import task_vars as g_task_vars
 from guillotina.auth.users import GuillotinaUser
@@ -15,23 +16,36 @@ from guillotina.transactions import abort
 from guillotina.transactions import commit
 from guillotina.utils import get_dotted_name
 from guillotina.utils import import_class
-from guillotina.utils import resolve_dotted_name
 from guillotina_amqp import task_vars
 from guillotina_amqp.exceptions import ObjectNotFoundException
+from guillotina_amqp.executors import run_in_executor
+from guillotina_amqp.executors import THREAD
 from guillotina_amqp.interfaces import ITaskDefinition
 from guillotina_amqp.interfaces import MessageType
+from guillotina_amqp.metrics import AMQP_TASK_PHASE
+from guillotina_amqp.metrics import CONTAINER_CACHE
 from guillotina_amqp.metrics import watch_job
 from guillotina_amqp.metrics import watch_job_commit
 from guillotina_amqp.metrics import watch_job_request
+from guillotina_amqp.profiling import claim_execution
+from guillotina_amqp.profiling import is_profiled
+from guillotina_amqp.profiling import measure_memory
+from guillotina_amqp.profiling import profile
+from guillotina_amqp.profiling import running_job
+from guillotina_amqp.profiling import sample_memory
+from guillotina_amqp.state import events_channel
+from guillotina_amqp.state import eventlog_key
 from guillotina_amqp.state import get_state_manager
+from guillotina_amqp.state import results_key
 from guillotina_amqp.state import update_task_running
-from guillotina_amqp.utils import _run_object_task
-from guillotina_amqp.utils import _yield_object_task
+from guillotina_amqp.utils import OBJECT_TASK_WRAPPERS
+from guillotina_amqp.utils import resolve_task
+from lru import LRU
 from multidict import CIMultiDict
-from unittest import mock
 from urllib.parse import urlparse
 from zope.interface import alsoProvides
 
+import asyncio
 import inspect
 import time
 import yarl
@@ -68,23 +82,278 @@ class EmptyPayload:
         return True
 
 
-class Job:
-    """Job objects are responsible for running the actual functions that
-    were configured for. They ack/nack rabbitmq when job is finished, and publish
+class _NullTransport:
+    def get_extra_info(self, name, default=None):
+        return default
+
+    def is_closing(self):
+        return False
+
+    def write(self, data):
+        pass
+
+    def close(self):
+        pass
+
+
+class _NullPayloadWriter:
+    """Job requests never send a response: writing is a no-op"""
+
+    buffer_size = 0
+    output_size = 0
+    length = None
+
+    def write(self, *args, **kwargs):
+        return noop()
 
+    def write_headers(self, *args, **kwargs):
+        return noop()
+
+    def write_eof(self, *args, **kwargs):
+        return noop()
+
+    def drain(self):
+        return noop()
+
+    def enable_compression(self, *args, **kwargs):
+        pass
+
+    def enable_chunking(self):
+        pass
+
+
+class _NullProtocol:
+    """What requests read of their aiohttp RequestHandler: jobs have no
+    connection
     """
 
-    def __init__(self, base_request, data, channel, envelope):
+    ssl_context = peername = sockname = None
+
+    def __init__(self, writer):
+        self.transport = _NullTransport()
+        self.writer = writer
+
+
+class RequestFactory:
+    """Builds the requests jobs run with, out of a base request.
+
+    What does not depend on the job is created once, and the parsed
+    urls of recently seen tasks are reused. Headers are not cached, as
+    they hold the credentials of each task.
+    """
+
+    def __init__(self, base_request=None, cache_size=128):
         if base_request is None:
             from guillotina.tests.utils import make_mocked_request
 
             base_request = make_mocked_request("POST", "/db")
         self.base_request = base_request
+        self.payload_writer = _NullPayloadWriter()
+        self.protocol = _NullProtocol(self.payload_writer)
+        self._messages = LRU(cache_size)
+
+    def get_message(self, req_data):
+        url = req_data["url"]
+        headers = req_data["headers"]
+        key = (req_data["method"], url)
+        message = self._messages.get(key)
+        if message is None:
+            message = self.base_request._message._replace(
+                method=req_data["method"],
+                url=yarl.URL(url),
+                path=urlparse(url).path,
+            )
+            self._messages[key] = message
+        # Headers can be modified by the job (see login_user)
+        return message._replace(
+            headers=CIMultiDict(headers),
+            raw_headers=tuple(
+                (k.encode("utf-8"), v.encode("utf-8")) for k, v in headers.items()
+            ),
+        )
+
+    def __call__(self, req_data, task):
+        base_request = self.base_request
+        return base_request.__class__(
+            self.get_message(req_data),
+            EmptyPayload(),
+            self.protocol,
+            self.payload_writer,
+            task,
+            task._loop,
+            client_max_size=base_request._client_max_size,
+            state=base_request._state.copy(),
+        )
+
+
+class ContainerCache:
+    """Active layers of recently used containers, so jobs do not load
+    the container registry every time. The registry itself is then
+    loaded on demand (see guillotina.utils.get_registry).
+
+    Entries are dropped when the container object is modified (its
+    serial changes) and after ttl seconds. The layers are stored in the
+    registry, whose changes do not modify the container, so changes to
+    the layers take up to ttl seconds to apply.
+    """
+
+    def __init__(self, size=None, ttl=None):
+        settings = app_settings["amqp"]
+        if size is None:
+            size = settings.get("container_cache_size", 500)
+        if ttl is None:
+            ttl = settings.get("container_cache_ttl", 30)
+        self.ttl = ttl
+        self._entries = LRU(size) if size > 0 else None
+
+    def get(self, db_id, container):
+        if self._entries is None:
+            return None
+        entry = self._entries.get((db_id, container.id))
+        if (
+            entry is None
+            or entry[0] != container.__serial__
+            or entry[1] < time.monotonic()
+        ):
+            if CONTAINER_CACHE is not None:
+                CONTAINER_CACHE.labels(result="miss").inc()
+            return None
+        if CONTAINER_CACHE is not None:
+            CONTAINER_CACHE.labels(result="hit").inc()
+        return entry[2]
+
+    def set(self, db_id, container, layers):
+        if self._entries is not None:
+            self._entries[(db_id, container.id)] = (
+                container.__serial__,
+                time.monotonic() + self.ttl,
+                layers,
+            )
+
+
+class ResultStream:
+    """Appends the results of a generator task to its results stream,
+    in batches. Only their count and the last ones are kept in memory.
+    """
+
+    flush_interval = 1
+
+    def __init__(self, state_manager, task_id):
+        settings = app_settings["amqp"]
+        self.state_manager = state_manager
+        self.key = results_key(task_id)
+        self.channel = events_channel(task_id)
+        self.max_len = settings.get("results_stream_max_size", 100000)
+        self.batch_size = settings.get("results_stream_batch_size", 100)
+        self.ttl = int(settings["state_ttl"])
+        self.count = 0
+        self.tail: deque = deque(maxlen=settings.get("results_tail_size", 10))
+        self._pending: list = []
+        # Results of a previous run are dropped on the first flush
+        self._reset = True
+        self._flushed = time.monotonic()
+
+    async def append(self, value):
+        self.count += 1
+        self.tail.append(value)
+        self._pending.append(value)
+        if (
+            len(self._pending) >= self.batch_size
+            or time.monotonic() - self._flushed > self.flush_interval
+        ):
+            await self.flush()
+
+    async def flush(self):
+        if not self._pending and not self._reset:
+            return
+        await self.state_manager.stream_extend(
+            self.key,
+            self._pending,
+            max_len=self.max_len,
+            ttl=self.ttl,
+            reset=self._reset,
+            channel=self.channel,
+        )
+        self._pending = []
+        self._reset = False
+        self._flushed = time.monotonic()
+
+    def summary(self):
+        """Stored as the task result"""
+        return {"streamed": True, "count": self.count, "tail": list(self.tail)}
+
+
+class Timeline:
+    """Wall clock times of the lifecycle events of a task, from its
+    publish time. Each event observes the time since the previous one
+    as the phase it ends.
+    """
+
+    # Event -> phase ending with it
+    phases = {
+        "received": "queue",
+        "admitted": "admission",
+        "leased": "lease",
+        "request_built": "request",
+        "started": "start",
+        "committed": "run",
+        "acked": "ack",
+    }
+
+    def __init__(self, published_at=None, queue=None):
+        self.queue = queue or "unknown"
+        self.times = {}
+        if published_at is not None:
+            self.times["published"] = published_at
+        self._last = published_at
+
+    def mark(self, event):
+        now = time.time()
+        self.times[event] = now
+        if self._last is not None and AMQP_TASK_PHASE is not None:
+            # Clocks of publishers and workers can be slightly off
+            AMQP_TASK_PHASE.labels(phase=self.phases[event], queue=self.queue).observe(
+                max(0, now - self._last)
+            )
+        self._last = now
+
+
+class Job:
+    """Job objects are responsible for running the actual functions that
+    were configured for. They ack/nack rabbitmq when job is finished, and publish
+
+    """
+
+    def __init__(
+        self,
+        base_request,
+        data,
+        channel,
+        envelope,
+        queue=None,
+        request_factory=None,
+        container_cache=None,
+        timeline=None,
+    ):
+        if request_factory is None:
+            request_factory = RequestFactory(base_request)
+        self.request_factory = request_factory
+        self.container_cache = container_cache
+        self.base_request = request_factory.base_request
         self.data = data
         self.channel = channel
         self.envelope = envelope
+        # Name of the queue the job was consumed from
+        self.queue = queue
+        if timeline is None:
+            timeline = Timeline(data.get("published_at"), queue)
+        self.timeline = timeline
+        # Memory usage of sampled executions
+        self.memory = None
 
         self.task = None
+        self._target = None
+        self._function_name = None
         self._state_manager = None
         self._started = time.time()
 
@@ -96,39 +365,7 @@ class Job:
 
     async def create_request(self):
         req_data = self.data["req_data"]
-        url = req_data["url"]
-        parsed = urlparse(url)
-        dct = {
-            "method": req_data["method"],
-            "url": yarl.URL(url),
-            "path": parsed.path,
-            "headers": CIMultiDict(req_data["headers"]),
-            "raw_headers": tuple(
-                (k.encode("utf-8"), v.encode("utf-8"))
-                for k, v in req_data["headers"].items()
-            ),
-        }
-
-        message = self.base_request._message._replace(**dct)
-
-        payload_writer = mock.Mock()
-        payload_writer.write_eof.side_effect = noop
-        payload_writer.drain.side_effect = noop
-
-        protocol = mock.Mock()
-        protocol.transport = test_utils._create_transport(None)
-        protocol.writer = payload_writer
-
-        request = self.base_request.__class__(
-            message,
-            EmptyPayload(),
-            protocol,
-            payload_writer,
-            self.task,
-            self.task._loop,
-            client_max_size=self.base_request._client_max_size,
-            state=self.base_request._state.copy(),
-        )
+        request = self.request_factory(req_data, self.task)
         g_task_vars.request.set(request)
         request.annotations = req_data.get("annotations", {})
 
@@ -159,20 +396,39 @@ class Job:
                         f'Could not find container: {self.data["container_id"]}'
                     )
                 g_task_vars.container.set(container)
-                annotations_container = IAnnotations(container)
-                container_settings = await annotations_container.async_get(
-                    REGISTRY_DATA_KEY
-                )
-                layers = container_settings.get(ACTIVE_LAYERS_KEY, [])
+                layers = None
+                if self.container_cache is not None:
+                    layers = self.container_cache.get(self.data["db_id"], container)
+                if layers is None:
+                    layers = await self.load_layers(container)
+                else:
+                    # Loaded on demand
+                    g_task_vars.registry.set(None)
                 for layer in layers:
-                    try:
-                        alsoProvides(request, import_class(layer))
-                    except ModuleNotFoundError:
-                        pass
-                g_task_vars.registry.set(container_settings)
+                    alsoProvides(request, layer)
         return request
 
+    async def load_layers(self, container):
+        """Loads the container registry and resolves its active layers"""
+        annotations_container = IAnnotations(container)
+        container_settings = await annotations_container.async_get(REGISTRY_DATA_KEY)
+        layers = []
+        for layer in container_settings.get(ACTIVE_LAYERS_KEY, []):
+            try:
+                layers.append(import_class(layer))
+            except ModuleNotFoundError:
+                pass
+        g_task_vars.registry.set(container_settings)
+        if self.container_cache is not None:
+            self.container_cache.set(self.data["db_id"], container, tuple(layers))
+        return layers
+
     async def __call__(self):
+        # The whole job allocates memory, not only its function
+        with running_job():
+            return await self._call()
+
+    async def _call(self):
         request = None
         try:
             # Clone request for task. This is inside the try so that a
@@ -181,13 +437,15 @@ class Job:
             # below rather than escaping to the worker's retry path.
             with watch_job_request:
                 request = await self.create_request()
+            self.timeline.mark("request_built")
             with watch_job(self.function_name):
-                result = await self.__run(request)
+                result = await self.run(request)
             try:
                 # Finish and return result
                 with watch_job_commit(self.function_name):
                     await commit()
                     request.execute_futures()
+                self.timeline.mark("committed")
             except Exception:
                 logger.error("Error commiting job", exc_info=True)
                 raise
@@ -204,8 +462,36 @@ class Job:
             except Exception:
                 logger.error("Error aborting job", exc_info=True)
 
+    async def run(self, request):
+        """Runs the task function, profiling it or measuring its memory
+        when asked to
+        """
+        function = self.function_name
+        if is_profiled(function) and await claim_execution(function):
+            return await profile(function, self.data["task_id"], self.__run(request))
+        if sample_memory():
+            with measure_memory(function) as usage:
+                result = await self.__run(request)
+            self.memory = usage or None
+            return result
+        return await self.__run(request)
+
+    def resolve(self):
+        """Resolves the task target once"""
+        if self._target is None:
+            self._target = resolve_task(self.data["func"])
+        return self._target
+
+    def check_function(self):
+        """Raises ImportError or AttributeError if the worker does not
+        know the function to run (for object tasks too)
+        """
+        self.resolve()
+        if self.data["func"] in OBJECT_TASK_WRAPPERS:
+            resolve_task(self.data["args"][0])
+
     def get_function_to_run(self):
-        func = resolve_dotted_name(self.data["func"])
+        func = self.resolve()
         if ITaskDefinition.providedBy(func):
             func = func.func
         if hasattr(func, "__real_func__"):
@@ -213,15 +499,35 @@ class Job:
             func = func.__real_func__
         return func
 
+    def get_task_definition(self):
+        """Task definition of the function the job runs, if it was
+        declared with a decorator
+        """
+        target = self.resolve()
+        if self.data["func"] in OBJECT_TASK_WRAPPERS:
+            target = resolve_task(self.data["args"][0])
+        if ITaskDefinition.providedBy(target):
+            return target
+        return None
+
+    def get_executor(self):
+        """Executor the task was declared with, if any"""
+        return getattr(self.get_task_definition(), "executor", None)
+
     @property
     def function_name(self):
-        """ """
+        """Name the job is reported with (computed once)"""
+        if self._function_name is None:
+            self._function_name = self._get_function_name()
+        return self._function_name
+
+    def _get_function_name(self):
         try:
             func = self.get_function_to_run()
-        except (ModuleNotFoundError, ImportError):
+        except (ImportError, AttributeError):
             return self.data["func"]
         dotted_name = get_dotted_name(func)
-        if func in [_run_object_task, _yield_object_task]:
+        if dotted_name in OBJECT_TASK_WRAPPERS:
             # Remove guillotina_amqp.utils part
             dotted_name = dotted_name.lstrip("guillotina_amqp.utils")
             # Get actuall callable that is passed as the first parameter
@@ -239,6 +545,12 @@ class Job:
 
         # Update status
         await update_task_running(self.state_manager, task_id)
+        if "dedupe_key" in self.data:
+            # Changes made from now on need to schedule the task again.
+            # Once the window expired, the key can belong to a newer task
+            await self.state_manager.delete_value_if(
+                self.data["dedupe_key"], task_id.encode("utf8")
+            )
 
         req_data = self.data["req_data"]
         if "user" in req_data:
@@ -246,6 +558,7 @@ class Job:
 
         # Parse the function to run
         func = self.get_function_to_run()
+        self.timeline.mark("started")
 
         #
         # Run the task coroutine
@@ -268,6 +581,10 @@ class Job:
         task_vars.amqp_job.set(self)
         # Function is an async generator
         if inspect.isasyncgenfunction(func):
+            eventlog_reset = True
+            results = None
+            if getattr(self.get_task_definition(), "stream_results", False):
+                results = ResultStream(self.state_manager, task_id)
             async for status in func(*self.data["args"], **self.data["kwargs"]):
                 if not isinstance(status, tuple) or len(status) != 2:
                     logger.debug(f"Job: invalid generator event: {status}")
@@ -282,11 +599,17 @@ class Job:
                         f"Job {task_id}: function data {self.data}, got msg {content}"
                     )
 
-                    # Update the status with new log
-                    state = await self.state_manager.get(task_id)
-                    state.setdefault("eventlog", [])
-                    state["eventlog"].append([date_now, content])
-                    await self.state_manager.update(task_id, state)
+                    # Append it to the task's event log
+                    await self.state_manager.stream_append(
+                        eventlog_key(task_id),
+                        [date_now, content],
+                        max_len=app_settings["amqp"].get("eventlog_max_size", 1000),
+                        ttl=int(app_settings["amqp"]["state_ttl"]),
+                        # Start over if the task is retried
+                        reset=eventlog_reset,
+                        channel=events_channel(task_id),
+                    )
+                    eventlog_reset = False
 
                 elif msg_type == MessageType.RESULT:
                     # RESULT value yielded: accumulate all the
@@ -294,7 +617,9 @@ class Job:
                     logger.debug(
                         f"Job {task_id}: function data {self.data}, got result {content}"
                     )
-                    if result is None:
+                    if results is not None:
+                        await results.append(content)
+                    elif result is None:
                         result = [content]
                     elif isinstance(result, list):
                         result.append(content)
@@ -304,9 +629,24 @@ class Job:
                         f"Job {task_id}: invalid generator event code {msg_type}"
                     )
                     continue
-        else:
+            if results is not None:
+                await results.flush()
+                result = results.summary()
+        elif asyncio.iscoroutinefunction(func):
             # Regular coroutine
             result = await func(*self.data["args"], **self.data["kwargs"])
+        else:
+            # Plain function: run it in a pool, so it does not block the
+            # loop. Threads by default
+            result = await run_in_executor(
+                self.get_executor() or THREAD,
+                func,
+                self.data["args"],
+                self.data["kwargs"],
+                dotted_name=dotted_name,
+            )
+            if inspect.isawaitable(result):
+                result = await result
         task_vars.amqp_job.set(None)
 
         return result
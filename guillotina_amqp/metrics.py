@@ -1,5 +1,130 @@
+from collections import Counter
+from guillotina import app_settings
 from guillotina import metrics
 from guillotina_amqp.exceptions import ObjectNotFoundException
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import threading
+import zlib
+
+
+OTHER = "other"
+
+
+class TopLabels:
+    """Keeps the size most frequent values of a label, folding the rest
+    into "other". Values are counted in a table of at most 10 times
+    size entries, and the top ones are ranked again every size values.
+
+    on_change is called with the new top values when values leave it, to
+    remove their series from the metrics. It is thread safe, as the loop
+    monitor labels metrics from its own thread.
+    """
+
+    def __init__(self, size, on_change: Optional[Callable[[set], None]] = None):
+        self.size = size
+        self.on_change = on_change
+        self._counts: Counter = Counter()
+        self._top: set = set()
+        self._seen = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, value):
+        with self._lock:
+            self._counts[value] += 1
+            self._seen += 1
+            if len(self._counts) > self.size * 10:
+                # Forget the least frequent values, keeping memory bounded
+                self._counts = Counter(dict(self._counts.most_common(self.size * 5)))
+            if len(self._top) < self.size:
+                self._top.add(value)
+            elif self._seen % self.size == 0:
+                top = {value for value, _ in self._counts.most_common(self.size)}
+                evicted = self._top - top
+                self._top = top
+                if evicted and self.on_change is not None:
+                    self.on_change(top)
+            return value if value in self._top else OTHER
+
+
+def _hash_labels(buckets):
+    def policy(value):
+        # Stable across processes, unlike hash()
+        return f"hash-{zlib.crc32(value.encode('utf8')) % buckets}"
+
+    return policy
+
+
+def parse_label_policy(spec) -> Callable[[str], str]:
+    """Label policy from its setting: keep, drop, hash:<buckets> or
+    top:<size>
+    """
+    name, _, size = str(spec).partition(":")
+    if name == "keep":
+        return str
+    if name == "drop":
+        return lambda value: ""
+    if name in ("hash", "top") and size.isdigit() and int(size) > 0:
+        if name == "hash":
+            return _hash_labels(int(size))
+        return TopLabels(int(size))
+    raise ValueError(f"Invalid metrics label policy: {spec}")
+
+
+_label_policies: Dict[str, Callable[[str], str]] = {}
+_policies_lock = threading.Lock()
+# Metrics labelled by each policy, with the name of the label
+_labelled_metrics: Dict[str, List[Tuple[Any, str]]] = {}
+
+
+def track_label(name, metric, labelname=None):
+    """Registers a metric whose labelname label (name by default) is
+    valued with label_value(name, ...)
+    """
+    _labelled_metrics.setdefault(name, []).append((metric, labelname or name))
+
+
+def remove_label_series(name, keep):
+    """Removes the series of the metrics tracked for name whose label
+    value is not in keep, nor "other"
+    """
+    for metric, labelname in _labelled_metrics.get(name, []):
+        index = metric._labelnames.index(labelname)
+        for labels in list(metric._metrics):
+            if labels[index] not in keep and labels[index] != OTHER:
+                metric.remove(*labels)
+
+
+def label_value(name, value):
+    """Value of the label of a task metric, after the policy configured
+    for it in metrics_labels
+    """
+    policy = _label_policies.get(name)
+    if policy is None:
+        with _policies_lock:
+            policy = _label_policies.get(name)
+            if policy is None:
+                settings = app_settings.get("amqp", {})
+                spec = settings.get("metrics_labels", {}).get(name, "keep")
+                policy = parse_label_policy(spec)
+                if isinstance(policy, TopLabels):
+                    policy.on_change = lambda top: remove_label_series(name, top)
+                _label_policies[name] = policy
+    return policy(str(value))
+
+
+def task_labels(**labels):
+    return {name: label_value(name, value) for name, value in labels.items()}
+
+
+def reset_label_policies():
+    """Applies changes of the metrics_labels setting"""
+    _label_policies.clear()
 
 
 try:
@@ -68,7 +193,7 @@ try:
             super().__init__(
                 counter=JOB,
                 histogram=JOB_PROCESSING_TIME,
-                labels={"type": operation},
+                labels={"type": label_value("function", operation)},
                 error_mappings={"notfound": ObjectNotFoundException},
             )
 
@@ -82,7 +207,7 @@ try:
             super().__init__(
                 counter=JOB_COMMIT,
                 histogram=JOB_COMMIT_TIME,
-                labels={"type": operation},
+                labels={"type": label_value("function", operation)},
             )
 
     AMQP_TASK_DISPATCHED = prometheus_client.Counter(
@@ -102,6 +227,61 @@ try:
         buckets=(0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 600.0, INF),
     )
 
+    AMQP_TASK_PHASE = prometheus_client.Histogram(
+        "guillotina_amqp_task_phase_seconds",
+        "Time spent by tasks in each phase of their lifecycle, from "
+        "publishing (queue) to the ack of the worker",
+        labelnames=["phase", "queue"],
+        buckets=(
+            0.005,
+            0.01,
+            0.05,
+            0.1,
+            0.5,
+            1.0,
+            5.0,
+            10.0,
+            30.0,
+            60.0,
+            300.0,
+            600.0,
+            1800.0,
+            INF,
+        ),
+    )
+
+    _memory_buckets = tuple(2**power for power in range(16, 32, 2)) + (INF,)
+    AMQP_TASK_MEMORY_PEAK = prometheus_client.Histogram(
+        "guillotina_amqp_task_memory_peak_bytes",
+        "Peak of the memory allocated by sampled task executions",
+        labelnames=["function"],
+        buckets=_memory_buckets,
+    )
+    AMQP_TASK_MEMORY_NET = prometheus_client.Histogram(
+        "guillotina_amqp_task_memory_net_bytes",
+        "Memory allocated by sampled task executions and still in use "
+        "when they finish",
+        labelnames=["function"],
+        buckets=_memory_buckets,
+    )
+
+    CONTAINER_CACHE = prometheus_client.Counter(
+        "guillotina_amqp_container_cache_ops_total",
+        "Container layers lookups of jobs, by result (hit or miss)",
+        labelnames=["result"],
+    )
+
+    for _metric in (JOB, JOB_PROCESSING_TIME, JOB_COMMIT, JOB_COMMIT_TIME):
+        track_label("function", _metric, "type")
+    for _metric in (AMQP_TASK_DISPATCHED, AMQP_TASK_COMPLETED, AMQP_TASK_DURATION):
+        for _name in ("container", "function", "queue"):
+            track_label(_name, _metric)
+    track_label("function", AMQP_TASK_MEMORY_PEAK)
+    track_label("function", AMQP_TASK_MEMORY_NET)
+
 except ImportError:
     AMQP_TASK_DISPATCHED = AMQP_TASK_COMPLETED = AMQP_TASK_DURATION = None  # type: ignore
+    AMQP_TASK_PHASE = None  # type: ignore
+    AMQP_TASK_MEMORY_PEAK = AMQP_TASK_MEMORY_NET = None  # type: ignore
+    CONTAINER_CACHE = None  # type: ignore
     watch_job = watch_amqp = watch_job_request = watch_job_commit = metrics.dummy_watch  # type: ignore
@@ -0,0 +1,261 @@
+"""On demand profiling and sampled memory accounting of task functions.
+
+Functions are marked for profiling for a number of executions, shared
+by all the workers. Workers refresh the marked functions periodically,
+so jobs of functions not marked only pay for a set lookup. Each profiled
+execution appends its heaviest calls to a stream of the function, and
+profiles are read aggregated over them.
+"""
+
+from contextlib import contextmanager
+from guillotina import app_settings
+from guillotina import glogging
+from guillotina_amqp.metrics import AMQP_TASK_MEMORY_NET
+from guillotina_amqp.metrics import AMQP_TASK_MEMORY_PEAK
+from guillotina_amqp.metrics import label_value
+from guillotina_amqp.state import get_state_manager
+from typing import Set
+
+import cProfile
+import pstats
+import random
+import time
+import tracemalloc
+
+
+logger = glogging.getLogger("guillotina_amqp.profiling")
+
+PROFILED_FUNCTIONS_KEY = "profile:functions"
+
+# Functions marked for profiling, as last read by this worker
+_profiled: Set[str] = set()
+
+
+def profile_key(function):
+    """Number of executions of the function left to profile"""
+    return f"profile:{function}:remaining"
+
+
+def profile_results_key(function):
+    return f"profile:{function}:results"
+
+
+def is_profiled(function):
+    return function in _profiled
+
+
+async def get_profiled_functions(state_manager=None):
+    state_manager = state_manager or get_state_manager()
+    return await state_manager.set_members(PROFILED_FUNCTIONS_KEY)
+
+
+async def refresh_profiled_functions():
+    """Reads the functions marked for profiling with executions left.
+    Functions without executions left are unmarked
+    """
+    global _profiled
+    state_manager = get_state_manager()
+    profiled, exhausted = set(), []
+    for function in await get_profiled_functions(state_manager):
+        if await state_manager.get_counter(profile_key(function)) > 0:
+            profiled.add(function)
+        else:
+            exhausted.append(function)
+    if exhausted:
+        await _unmark_profiled(state_manager, exhausted)
+    _profiled = profiled
+
+
+async def _unmark_profiled(state_manager, functions):
+    """Removes functions from the profiled ones. Functions marked again
+    meanwhile are added back: mark_profiled increments their counter
+    before adding them
+    """
+    await state_manager.remove_from_set(PROFILED_FUNCTIONS_KEY, functions)
+    for function in functions:
+        if await state_manager.get_counter(profile_key(function)) > 0:
+            await state_manager.add_to_set(
+                PROFILED_FUNCTIONS_KEY,
+                function,
+                ttl=int(app_settings["amqp"]["state_ttl"]),
+            )
+
+
+async def mark_profiled(function, executions):
+    """Profiles the next executions of function, on any worker. Previous
+    results of the function are kept until they expire.
+    """
+    state_manager = get_state_manager()
+    ttl = int(app_settings["amqp"]["state_ttl"])
+    remaining = await state_manager.incr_counter(
+        profile_key(function), ttl, amount=executions
+    )
+    await state_manager.add_to_set(PROFILED_FUNCTIONS_KEY, function, ttl=ttl)
+    return remaining
+
+
+async def claim_execution(function):
+    """Whether this execution of function has to be profiled"""
+    state_manager = get_state_manager()
+    remaining = await state_manager.incr_counter(profile_key(function), amount=-1)
+    if remaining >= 0:
+        return True
+    # Nothing left: give it back, and stop checking the function
+    await state_manager.incr_counter(profile_key(function), amount=1)
+    _profiled.discard(function)
+    return False
+
+
+class _ProfiledCoroutine:
+    """Runs a coroutine with the profiler enabled only while it runs, so
+    other tasks of the loop are not profiled with it.
+    """
+
+    def __init__(self, coro, profiler):
+        self.coro = coro
+        self.profiler = profiler
+
+    def __await__(self):
+        value, error = None, None
+        while True:
+            self.profiler.enable()
+            try:
+                if error is None:
+                    future = self.coro.send(value)
+                else:
+                    future = self.coro.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            finally:
+                self.profiler.disable()
+            try:
+                value, error = (yield future), None
+            except BaseException as exc:
+                value, error = None, exc
+
+
+def _entries(profiler, size):
+    """Heaviest calls of the profile, by cumulative time"""
+    stats = pstats.Stats(profiler)
+    entries = []
+    for (filename, line, name), (_, ncalls, tottime, cumtime, _) in stats.stats.items():
+        entries.append([f"{filename}:{line}({name})", ncalls, tottime, cumtime])
+    entries.sort(key=lambda entry: entry[3], reverse=True)
+    return entries[:size]
+
+
+async def profile(function, task_id, coro):
+    """Awaits the coroutine of a task, profiling it, and stores the
+    profile with the results of the function
+    """
+    settings = app_settings["amqp"]
+    profiler = cProfile.Profile()
+    start = time.time()
+    try:
+        return await _ProfiledCoroutine(coro, profiler)
+    finally:
+        try:
+            await get_state_manager().stream_append(
+                profile_results_key(function),
+                {
+                    "task_id": task_id,
+                    "duration": time.time() - start,
+                    "entries": _entries(profiler, settings.get("profile_size", 100)),
+                },
+                max_len=settings.get("profile_max_executions", 100),
+                ttl=int(settings["state_ttl"]),
+            )
+        except Exception:
+            logger.error(f"Error storing the profile of {task_id}", exc_info=True)
+
+
+async def get_profile(function):
+    """Profile of the function, aggregated over its profiled executions"""
+    state_manager = get_state_manager()
+    executions = await state_manager.stream_range(profile_results_key(function))
+    calls = {}
+    for _, execution in executions:
+        for name, ncalls, tottime, cumtime in execution["entries"]:
+            total = calls.setdefault(name, [name, 0, 0.0, 0.0])
+            total[1] += ncalls
+            total[2] += tottime
+            total[3] += cumtime
+    return {
+        "function": function,
+        "remaining": max(0, await state_manager.get_counter(profile_key(function))),
+        "executions": [
+            {"task_id": execution["task_id"], "duration": execution["duration"]}
+            for _, execution in executions
+        ],
+        "calls": [
+            {"call": name, "ncalls": ncalls, "tottime": tottime, "cumtime": cumtime}
+            for name, ncalls, tottime, cumtime in sorted(
+                calls.values(), key=lambda call: call[3], reverse=True
+            )
+        ],
+    }
+
+
+# Jobs of this worker running, whether one of them is measuring its
+# memory and whether others ran meanwhile
+_running = 0
+_measuring = False
+_overlapped = False
+
+
+@contextmanager
+def running_job():
+    """Counts the block as a job running, from building its request to
+    its commit, spoiling the memory measure of the job measured
+    meanwhile, if any
+    """
+    global _running, _overlapped
+    _running += 1
+    if _measuring:
+        _overlapped = True
+    try:
+        yield
+    finally:
+        _running -= 1
+
+
+def sample_memory():
+    """Whether to measure the memory of the job starting, one in
+    1 / memory_sample_rate of the jobs running alone in the worker: busy
+    workers seldom sample. Not while tracemalloc is already tracing.
+    """
+    rate = app_settings["amqp"].get("memory_sample_rate") or 0
+    return (
+        rate > 0
+        and _running <= 1
+        and not _measuring
+        and random.random() < rate
+        and not tracemalloc.is_tracing()
+    )
+
+
+@contextmanager
+def measure_memory(function):
+    """Traces the allocations of the block. Fills the dict it yields
+    with their peak and what is still allocated at the end (net), in
+    bytes. tracemalloc traces the whole process, so the dict is left
+    empty when other jobs started meanwhile; allocations of the worker
+    itself are still counted.
+    """
+    global _measuring, _overlapped
+    usage = {}
+    _measuring = True
+    _overlapped = False
+    tracemalloc.start()
+    try:
+        yield usage
+    finally:
+        net, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        _measuring = False
+        if not _overlapped:
+            usage["net"], usage["peak"] = net, peak
+        if usage and AMQP_TASK_MEMORY_PEAK is not None:
+            labels = {"function": label_value("function", function)}
+            AMQP_TASK_MEMORY_PEAK.labels(**labels).observe(usage["peak"])
+            AMQP_TASK_MEMORY_NET.labels(**labels).observe(usage["net"])
@@ -2,17 +2,23 @@ from guillotina import app_settings
 from guillotina import configure
 from guillotina import glogging
 from guillotina.component import get_utility
+from guillotina.utils import resolve_dotted_name
+from guillotina_amqp.exceptions import ResultTooLargeException
 from guillotina_amqp.exceptions import TaskAccessUnauthorized
 from guillotina_amqp.exceptions import TaskAlreadyAcquired
 from guillotina_amqp.exceptions import TaskNotFinishedException
 from guillotina_amqp.exceptions import TaskNotFoundException
 from guillotina_amqp.interfaces import IStateManagerUtility
+from collections import deque
+from contextlib import asynccontextmanager
 from lru import LRU
 
 import asyncio
 import backoff
 import json
+import time
 import uuid
+import zlib
 
 
 try:
@@ -66,6 +72,37 @@ class TaskStatus:
     SLEEPING = "sleeping"
 
 
+# The task will not change until it is scheduled again
+FINAL_STATUSES = (
+    TaskStatus.FINISHED,
+    TaskStatus.ERRORED,
+    TaskStatus.CANCELED,
+    TaskStatus.SLEEPING,
+)
+
+# The task will not run again. Errored and sleeping tasks can still be
+# retried or come back from the delay queue
+DONE_STATUSES = (TaskStatus.FINISHED, TaskStatus.CANCELED)
+
+
+class Subscription:
+    """Notifications received on a channel, for a single subscriber"""
+
+    def __init__(self):
+        self._notified = asyncio.Event()
+
+    def notify(self):
+        self._notified.set()
+
+    async def wait(self, timeout=None):
+        try:
+            await asyncio.wait_for(self._notified.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        self._notified.clear()
+        return True
+
+
 @configure.utility(provides=IStateManagerUtility, name="memory")
 class MemoryStateManager:
     """
@@ -77,6 +114,17 @@ class MemoryStateManager:
         self._data = LRU(self.size)
         self._locks = {}
         self._canceled = set()
+        # key -> [entries, last entry number]
+        self._streams = {}
+        # channel -> subscriptions
+        self._subscriptions = {}
+        self._values = {}
+        # key -> time its value expires at
+        self._expires = {}
+        self._counters = {}
+        # key -> {task_id: score}
+        self._indexes = {}
+        self._sets = {}
         self.worker_id = uuid.uuid4().hex
 
     def set_loop(self, loop=None):
@@ -88,6 +136,19 @@ class MemoryStateManager:
         existing.update(data)
         self._data[task_id] = existing
 
+    async def update_many(self, task_ids, data, ttl=None):
+        for task_id in task_ids:
+            await self.update(task_id, dict(data), ttl=ttl)
+
+    async def update_with_event(
+        self, task_id, data, key, event, channel=None, max_len=None, ttl=None
+    ):
+        await self.update(task_id, data, ttl=ttl)
+        await self.stream_append(key, event, max_len, ttl, channel=channel)
+
+    async def get_many(self, task_ids):
+        return [dict(await self.get(task_id)) for task_id in task_ids]
+
     async def get(self, task_id):
         return self._data.get(task_id, {})
 
@@ -129,6 +190,14 @@ class MemoryStateManager:
         self._locks[task_id].release()
         self._locks.pop(task_id, None)
 
+    async def release_many(self, task_ids):
+        released = 0
+        for task_id in task_ids:
+            if await self.is_locked(task_id) and await self.is_mine(task_id):
+                await self.release(task_id)
+                released += 1
+        return released
+
     async def refresh_lock(self, task_id, ttl):
         if task_id not in self._locks:
             raise TaskNotFoundException(task_id)
@@ -147,6 +216,32 @@ class MemoryStateManager:
         self._canceled.update({task_id})
         return True
 
+    async def cancel_many(self, task_ids):
+        self._canceled.update(task_ids)
+
+    async def add_to_indexes(self, indexes, ttl=None):
+        for key, members in indexes.items():
+            self._indexes.setdefault(key, {}).update(members)
+
+    async def index_range(self, key, max_score=None, offset=0, count=None):
+        members = sorted(self._indexes.get(key, {}).items(), key=lambda i: i[1])
+        task_ids = [
+            task_id
+            for task_id, score in members
+            if max_score is None or score <= max_score
+        ]
+        end = None if count is None else offset + count
+        return task_ids[offset:end]
+
+    async def add_to_set(self, key, member, ttl=None):
+        self._sets.setdefault(key, set()).add(member)
+
+    async def remove_from_set(self, key, members):
+        self._sets.get(key, set()).difference_update(members)
+
+    async def set_members(self, key):
+        return set(self._sets.get(key, ()))
+
     async def clean_canceled(self, task_id):
         try:
             self._canceled.remove(task_id)
@@ -158,14 +253,125 @@ class MemoryStateManager:
     async def is_canceled(self, task_id):
         return task_id in self._canceled
 
+    async def set_value(self, key, value, ttl=None):
+        self._values[key] = value
+        if ttl:
+            self._expires[key] = time.time() + ttl
+        else:
+            self._expires.pop(key, None)
+
+    async def get_value(self, key):
+        if self._expires.get(key, float("inf")) < time.time():
+            await self.delete_value(key)
+        return self._values.get(key)
+
+    async def set_if_absent(self, key, value, ttl=None):
+        if await self.get_value(key) is not None:
+            return False
+        await self.set_value(key, value, ttl)
+        return True
+
+    async def replace_value(self, key, value, ttl=None):
+        if await self.get_value(key) is None:
+            return False
+        await self.set_value(key, value, ttl)
+        return True
+
+    async def pop_value(self, key):
+        value = await self.get_value(key)
+        await self.delete_value(key)
+        return value
+
+    async def delete_value(self, key):
+        # Like redis, any kind of value
+        self._values.pop(key, None)
+        self._expires.pop(key, None)
+        self._counters.pop(key, None)
+        self._streams.pop(key, None)
+        self._sets.pop(key, None)
+
+    async def delete_value_if(self, key, value):
+        if await self.get_value(key) != value:
+            return False
+        await self.delete_value(key)
+        return True
+
+    async def incr_counter(self, key, ttl=None, amount=1):
+        self._counters[key] = self._counters.get(key, 0) + amount
+        return self._counters[key]
+
+    async def get_counter(self, key):
+        return self._counters.get(key, 0)
+
+    async def stream_append(
+        self, key, value, max_len=None, ttl=None, reset=False, channel=None
+    ):
+        return await self.stream_extend(key, [value], max_len, ttl, reset, channel)
+
+    async def stream_extend(
+        self, key, values, max_len=None, ttl=None, reset=False, channel=None
+    ):
+        if channel is not None:
+            for subscription in self._subscriptions.get(channel, ()):
+                subscription.notify()
+        if reset or key not in self._streams:
+            self._streams[key] = [deque(maxlen=max_len), 0]
+        stream = self._streams[key]
+        entry_id = None
+        for value in values:
+            stream[1] += 1
+            entry_id = f"{stream[1]}-0"
+            stream[0].append((entry_id, value))
+        return entry_id
+
+    async def stream_append_many(self, entries, max_len=None, ttl=None):
+        for key, value, channel in entries:
+            await self.stream_append(key, value, max_len, ttl, channel=channel)
+
+    async def stream_range(self, key, after=None, count=None):
+        entries = list(self._streams.get(key, [[]])[0])
+        if after is not None:
+            after_number = int(after.split("-")[0])
+            entries = [e for e in entries if int(e[0].split("-")[0]) > after_number]
+        return entries[:count] if count else entries
+
+    async def stream_length(self, key):
+        return len(self._streams.get(key, [[]])[0])
+
+    @asynccontextmanager
+    async def subscribe(self, channel):
+        subscription = Subscription()
+        subscriptions = self._subscriptions.setdefault(channel, set())
+        subscriptions.add(subscription)
+        try:
+            yield subscription
+        finally:
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self._subscriptions.pop(channel, None)
+
     async def _clean(self):
         self._data = LRU(self.size)
         self._locks = {}
         self._canceled = set()
+        self._streams = {}
+        self._values = {}
+        self._expires = {}
+        self._counters = {}
+        self._indexes = {}
+        self._sets = {}
 
 
 _EMPTY = object()
 
+# Deletes KEYS[1] if its value is ARGV[1]
+_DELETE_IF_EQUAL = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
 
 def get_state_manager(loop=None) -> IStateManagerUtility:
     """Factory that gets the configured state manager.
@@ -188,6 +394,10 @@ class RedisStateManager:
         self._cache_prefix = app_settings.get("redis_prefix_key", "amqpjobs-")
         self.loop = loop
         self._cache = None
+        # channel -> subscriptions of this process, sharing a single
+        # redis subscription
+        self._subscriptions = {}
+        self._listeners = {}
         self.worker_id = uuid.uuid4().hex
 
     def lock_prefix(self, task_id):
@@ -233,11 +443,63 @@ class RedisStateManager:
                 value = json.loads(existing)
                 value.update(data)
             with watch_redis("set"):
-                await cache.set(self._cache_prefix + task_id, json.dumps(value))
-            if ttl:
-                with watch_redis("expire"):
-                    resp = await cache.expire(self._cache_prefix + task_id, ttl)
-                return resp > 0
+                # The ttl is set along with the value, saving a round trip
+                return await cache.set(
+                    self._cache_prefix + task_id, json.dumps(value), expire=ttl or 0
+                )
+
+    async def update_with_event(
+        self, task_id, data, key, event, channel=None, max_len=None, ttl=None
+    ):
+        """Updates the state of the task and appends event to a capped
+        stream, in two round trips: the state is read, then written along
+        with the event
+        """
+        cache = await self.get_cache()
+        if not cache:
+            return
+        with watch_redis("get"):
+            existing = await cache.get(self._cache_prefix + task_id)
+        value = dict(json.loads(existing), **data) if existing else data
+        key = self._cache_prefix + key
+        pipe = cache.pipeline()
+        pipe.set(self._cache_prefix + task_id, json.dumps(value), expire=ttl or 0)
+        pipe.xadd(key, {"v": json.dumps(event)}, max_len=max_len)
+        if ttl:
+            pipe.expire(key, ttl)
+        if channel is not None:
+            pipe.publish(self._cache_prefix + channel, "")
+        with watch_redis("set"):
+            await pipe.execute()
+
+    async def update_many(self, task_ids, data, ttl=None):
+        """Updates the state of many tasks with the same data, in two
+        round trips
+        """
+        cache = await self.get_cache()
+        if not cache or not task_ids:
+            return
+        keys = [self._cache_prefix + task_id for task_id in task_ids]
+        with watch_redis("mget"):
+            existing = await cache.mget(*keys)
+        pipe = cache.pipeline()
+        for key, value in zip(keys, existing):
+            value = json.loads(value) if value else {}
+            value.update(data)
+            pipe.set(key, json.dumps(value), expire=ttl or 0)
+        with watch_redis("set"):
+            await pipe.execute()
+
+    async def get_many(self, task_ids):
+        """States of the tasks, in a single round trip"""
+        cache = await self.get_cache()
+        if not cache or not task_ids:
+            return [{} for _ in task_ids]
+        with watch_redis("mget"):
+            values = await cache.mget(
+                *(self._cache_prefix + task_id for task_id in task_ids)
+            )
+        return [json.loads(value) if value else {} for value in values]
 
     async def get(self, task_id):
         cache = await self.get_cache()
@@ -300,6 +562,24 @@ class RedisStateManager:
             resp = await cache.delete(self.lock_prefix(task_id))
         return resp > 0
 
+    async def release_many(self, task_ids):
+        """Releases the locks this worker owns, in two round trips"""
+        if not task_ids:
+            return 0
+        cache = await self.get_cache()
+        keys = [self.lock_prefix(task_id) for task_id in task_ids]
+        with watch_redis("mget"):
+            owners = await cache.mget(*keys)
+        mine = [
+            key
+            for key, owner in zip(keys, owners)
+            if owner is not None and owner.decode() == self.worker_id
+        ]
+        if not mine:
+            return 0
+        with watch_redis("delete"):
+            return await cache.delete(*mine)
+
     async def refresh_lock(self, task_id, ttl):
         if not await self.is_locked(task_id):
             # There is no lock, nothing to do
@@ -320,6 +600,66 @@ class RedisStateManager:
             await cache.set(self.cancel_prefix + task_id, "true", expire=60 * 60)
         return True
 
+    async def cancel_many(self, task_ids):
+        """Cancels the tasks, in a single round trip"""
+        cache = await self.get_cache()
+        pipe = cache.pipeline()
+        for task_id in task_ids:
+            pipe.set(self.cancel_prefix + task_id, "true", expire=60 * 60)
+        with watch_redis("set"):
+            await pipe.execute()
+
+    async def add_to_indexes(self, indexes, ttl=None):
+        """Adds task ids to sorted sets, as {key: {task_id: score}}, in
+        a single round trip. Entries older than ttl are dropped
+        """
+        cache = await self.get_cache()
+        pipe = cache.pipeline()
+        for key, members in indexes.items():
+            pairs = []
+            for task_id, score in members.items():
+                pairs.extend((score, task_id))
+            pipe.zadd(self._cache_prefix + key, *pairs)
+            if ttl:
+                pipe.zremrangebyscore(self._cache_prefix + key, max=time.time() - ttl)
+                pipe.expire(self._cache_prefix + key, ttl)
+        with watch_redis("zadd"):
+            await pipe.execute()
+
+    async def index_range(self, key, max_score=None, offset=0, count=None):
+        cache = await self.get_cache()
+        with watch_redis("zrangebyscore"):
+            task_ids = await cache.zrangebyscore(
+                self._cache_prefix + key,
+                max=float("inf") if max_score is None else max_score,
+                offset=offset if count is not None else None,
+                count=count,
+            )
+        return [task_id.decode() for task_id in task_ids]
+
+    async def add_to_set(self, key, member, ttl=None):
+        """Adds member to the set, in a single round trip"""
+        cache = await self.get_cache()
+        pipe = cache.pipeline()
+        pipe.sadd(self._cache_prefix + key, member)
+        if ttl:
+            pipe.expire(self._cache_prefix + key, ttl)
+        with watch_redis("sadd"):
+            await pipe.execute()
+
+    async def remove_from_set(self, key, members):
+        if not members:
+            return
+        cache = await self.get_cache()
+        with watch_redis("srem"):
+            await cache.srem(self._cache_prefix + key, *members)
+
+    async def set_members(self, key):
+        cache = await self.get_cache()
+        with watch_redis("smembers"):
+            members = await cache.smembers(self._cache_prefix + key)
+        return {member.decode() for member in members}
+
     async def clean_canceled(self, task_id):
         cache = await self.get_cache()
         with watch_redis("delete"):
@@ -331,12 +671,235 @@ class RedisStateManager:
             val = await cache.get(self.cancel_prefix + task_id)
         return val == b"true"
 
+    async def set_value(self, key, value, ttl=None):
+        cache = await self.get_cache()
+        with watch_redis("set"):
+            await cache.set(self._cache_prefix + key, value, expire=ttl or 0)
+
+    async def get_value(self, key):
+        cache = await self.get_cache()
+        with watch_redis("get"):
+            return await cache.get(self._cache_prefix + key)
+
+    async def set_if_absent(self, key, value, ttl=None):
+        cache = await self.get_cache()
+        with watch_redis("setnx"):
+            return await cache.set(
+                self._cache_prefix + key,
+                value,
+                expire=ttl or 0,
+                exist=cache.SET_IF_NOT_EXIST,
+            )
+
+    async def replace_value(self, key, value, ttl=None):
+        cache = await self.get_cache()
+        with watch_redis("set"):
+            return await cache.set(
+                self._cache_prefix + key,
+                value,
+                expire=ttl or 0,
+                exist=cache.SET_IF_EXIST,
+            )
+
+    async def pop_value(self, key):
+        """Atomically gets and deletes the value of key"""
+        cache = await self.get_cache()
+        transaction = cache.multi_exec()
+        value = transaction.get(self._cache_prefix + key)
+        transaction.delete(self._cache_prefix + key)
+        with watch_redis("pop"):
+            await transaction.execute()
+        return await value
+
+    async def delete_value(self, key):
+        cache = await self.get_cache()
+        with watch_redis("delete"):
+            await cache.delete(self._cache_prefix + key)
+
+    async def delete_value_if(self, key, value):
+        """Atomically deletes key if it stores value, in a single round
+        trip
+        """
+        cache = await self.get_cache()
+        with watch_redis("delete_if"):
+            deleted = await cache.eval(
+                _DELETE_IF_EQUAL, keys=[self._cache_prefix + key], args=[value]
+            )
+        return bool(deleted)
+
+    async def incr_counter(self, key, ttl=None, amount=1):
+        """Atomically increments a counter, in a single round trip"""
+        cache = await self.get_cache()
+        pipe = cache.pipeline()
+        value = pipe.incrby(self._cache_prefix + key, amount)
+        if ttl:
+            pipe.expire(self._cache_prefix + key, ttl)
+        with watch_redis("incr"):
+            await pipe.execute()
+        return await value
+
+    async def get_counter(self, key):
+        cache = await self.get_cache()
+        with watch_redis("get"):
+            value = await cache.get(self._cache_prefix + key)
+        return int(value or 0)
+
+    async def stream_append(
+        self, key, value, max_len=None, ttl=None, reset=False, channel=None
+    ):
+        """Appends value to a capped stream, in a single round trip"""
+        return await self.stream_extend(key, [value], max_len, ttl, reset, channel)
+
+    async def stream_extend(
+        self, key, values, max_len=None, ttl=None, reset=False, channel=None
+    ):
+        """Appends values to a capped stream, in a single round trip.
+        Returns the id of the last one, and publishes on channel
+        """
+        cache = await self.get_cache()
+        key = self._cache_prefix + key
+        pipe = cache.pipeline()
+        if reset:
+            pipe.delete(key)
+        entry_id = None
+        for value in values:
+            entry_id = pipe.xadd(key, {"v": json.dumps(value)}, max_len=max_len)
+        if ttl:
+            pipe.expire(key, ttl)
+        if channel is not None:
+            pipe.publish(self._cache_prefix + channel, "")
+        with watch_redis("xadd"):
+            await pipe.execute()
+        return None if entry_id is None else (await entry_id).decode()
+
+    async def stream_append_many(self, entries, max_len=None, ttl=None):
+        """Appends a value to each of many streams, in a single round trip.
+        entries are (key, value, channel) tuples
+        """
+        if not entries:
+            return
+        cache = await self.get_cache()
+        pipe = cache.pipeline()
+        for key, value, channel in entries:
+            key = self._cache_prefix + key
+            pipe.xadd(key, {"v": json.dumps(value)}, max_len=max_len)
+            if ttl:
+                pipe.expire(key, ttl)
+            if channel is not None:
+                pipe.publish(self._cache_prefix + channel, "")
+        with watch_redis("xadd"):
+            await pipe.execute()
+
+    async def stream_range(self, key, after=None, count=None):
+        """Returns up to count (id, value) entries of a stream, after the
+        entry with id after
+        """
+        cache = await self.get_cache()
+        fetch = count + 1 if count and after else count
+        with watch_redis("xrange"):
+            entries = await cache.xrange(
+                self._cache_prefix + key, start=after or "-", count=fetch
+            )
+        result = []
+        for entry_id, fields in entries:
+            entry_id = entry_id.decode()
+            if entry_id != after:
+                result.append((entry_id, json.loads(fields[b"v"])))
+        return result[:count] if count else result
+
+    async def stream_length(self, key):
+        cache = await self.get_cache()
+        with watch_redis("xlen"):
+            return await cache.xlen(self._cache_prefix + key)
+
+    @asynccontextmanager
+    async def subscribe(self, channel):
+        channel = self._cache_prefix + channel
+        subscriptions = self._subscriptions.get(channel)
+        if subscriptions is None:
+            subscriptions = self._subscriptions[channel] = set()
+            driver = await redis.get_driver()
+            with watch_redis("subscribe"):
+                listener = await driver.subscribe(channel)
+            self._listeners[channel] = asyncio.ensure_future(
+                self._listen(channel, listener)
+            )
+        subscription = Subscription()
+        subscriptions.add(subscription)
+        try:
+            yield subscription
+        finally:
+            subscriptions.discard(subscription)
+            if not subscriptions and self._subscriptions.get(channel) is subscriptions:
+                del self._subscriptions[channel]
+                self._listeners.pop(channel).cancel()
+                try:
+                    driver = await redis.get_driver()
+                    with watch_redis("unsubscribe"):
+                        await driver.unsubscribe(channel)
+                except Exception:
+                    logger.warning(f"Error unsubscribing {channel}", exc_info=True)
+
+    async def _listen(self, channel, listener):
+        async for _ in listener:
+            for subscription in self._subscriptions.get(channel, ()):
+                subscription.notify()
+
     async def _clean(self):
         cache = await self.get_cache()
         with watch_redis("flush"):
             await cache.flushall()
 
 
+def eventlog_key(task_id):
+    return f"eventlog:{task_id}"
+
+
+def results_key(task_id):
+    return f"results:{task_id}"
+
+
+def result_key(task_id):
+    """Return value of the task, see store_result"""
+    return f"result:{task_id}"
+
+
+def task_index_key(db_id, container_id, function=None):
+    """Tasks of a container (or of one of its functions) by the time
+    they were scheduled
+    """
+    if function is None:
+        return f"index:{db_id}-{container_id}"
+    return f"index:{db_id}-{container_id}:{function}"
+
+
+def status_key(task_id):
+    return f"status:{task_id}"
+
+
+def events_channel(task_id):
+    """Notified when any of the streams of the task changes"""
+    return f"events:{task_id}"
+
+
+# Streams sent by TaskState.events(), in the order they are read
+EVENT_STREAMS = (
+    ("status", status_key),
+    ("eventlog", eventlog_key),
+    ("result", results_key),
+)
+
+
+def parse_events_cursor(cursor):
+    """Position in each of the event streams, from an event id"""
+    positions = (cursor or "").split(";")
+    if cursor and len(positions) != len(EVENT_STREAMS):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return [position or None for position in positions] + [None] * (
+        len(EVENT_STREAMS) - len(positions)
+    )
+
+
 class TaskState:
     """Wrapper around state_manager implementation so we can use it by
     just having a task_id
@@ -352,22 +915,92 @@ class TaskState:
             if not data:
                 logger.info(f"Attempted join on missing task: {self.task_id}")
                 raise TaskNotFoundException(self.task_id)
-            if data.get("status") in (
-                TaskStatus.FINISHED,
-                TaskStatus.ERRORED,
-                TaskStatus.CANCELED,
-                TaskStatus.SLEEPING,
-            ):
+            if data.get("status") in FINAL_STATUSES:
+                if "result_info" in data:
+                    data["result"] = await self.load_result(data)
                 return data
             await asyncio.sleep(wait)
 
+    @classmethod
+    async def get_states(cls, task_ids, fields=None):
+        """States of many tasks, in a single round trip and without their
+        event log. Only fields are returned, if given. Tasks not found are
+        None
+        """
+        task_ids = list(dict.fromkeys(task_ids))
+        states = await get_state_manager().get_many(task_ids)
+        result = {}
+        for task_id, state in zip(task_ids, states):
+            if state and fields is not None:
+                state = {name: state[name] for name in fields if name in state}
+            result[task_id] = state or None
+        return result
+
     async def get_state(self):
         util = get_state_manager()
         data = await util.get(self.task_id)
         if not data:
             raise TaskNotFoundException(self.task_id)
+        eventlog = await self.get_eventlog()
+        if eventlog:
+            data["eventlog"] = [value for _, value in eventlog]
         return data
 
+    async def get_eventlog(self, after=None, count=None):
+        """Returns (id, [date, message]) entries of the event log, after
+        the entry with id after
+        """
+        util = get_state_manager()
+        return await util.stream_range(eventlog_key(self.task_id), after, count)
+
+    async def get_eventlog_length(self):
+        util = get_state_manager()
+        return await util.stream_length(eventlog_key(self.task_id))
+
+    async def get_results(self, after=None, count=None):
+        """Returns (id, value) entries of the results of a task declared
+        with stream_results, after the entry with id after. They can be
+        read while the task runs.
+        """
+        util = get_state_manager()
+        return await util.stream_range(results_key(self.task_id), after, count)
+
+    async def events(self, cursor=None, keepalive=15, batch_size=100):
+        """Yields (event id, event, value) for the status changes, event
+        log entries and results of the task, as they happen, until it
+        reaches a final status. Yields None every keepalive seconds
+        without events.
+
+        Pass the id of the last event received as cursor to resume.
+        """
+        util = get_state_manager()
+        positions = parse_events_cursor(cursor)
+        status = None
+        if positions[0] is not None:
+            # Status changes already sent are not read again
+            status = (await util.get(self.task_id)).get("status")
+        # Subscribe before reading, so no change is missed
+        async with util.subscribe(events_channel(self.task_id)) as subscription:
+            while True:
+                for index, (event, key) in enumerate(EVENT_STREAMS):
+                    while True:
+                        entries = await util.stream_range(
+                            key(self.task_id), positions[index], batch_size
+                        )
+                        for entry_id, value in entries:
+                            positions[index] = entry_id
+                            if event == "status":
+                                status = value["status"]
+                            yield ";".join(p or "" for p in positions), event, value
+                        if len(entries) < batch_size:
+                            break
+                # Status changes are written last: once the task is in a
+                # final one, the other streams are complete
+                if status in FINAL_STATUSES:
+                    return
+                if not await subscription.wait(keepalive):
+                    yield None
+
     async def get_status(self):
         """
         possible statuses:
@@ -390,7 +1023,16 @@ class TaskState:
             raise TaskNotFoundException(self.task_id)
         if data.get("status") not in (TaskStatus.FINISHED, TaskStatus.ERRORED):
             raise TaskNotFinishedException(self.task_id)
-        return data.get("result")
+        return await self.load_result(data)
+
+    async def load_result(self, data):
+        """Result of the task with the given state. Only tasks finished
+        before results had their own key keep it in the state.
+        """
+        if "result_info" not in data:
+            return data.get("result")
+        util = get_state_manager()
+        return decode_result(await util.get_value(result_key(self.task_id)))
 
     async def cancel(self):
         util = get_state_manager()
@@ -428,8 +1070,59 @@ class TaskState:
         return await util.is_canceled(self.task_id)
 
 
+def encode_result(result):
+    """Serializes a result, compressing it above the configured size"""
+    data = json.dumps(result).encode("utf8")
+    threshold = app_settings["amqp"].get("result_compression_threshold")
+    if threshold is not None and len(data) > threshold:
+        return b"z" + zlib.compress(data)
+    return b"j" + data
+
+
+def decode_result(data):
+    if data is None:
+        return None
+    if data[:1] == b"z":
+        return json.loads(zlib.decompress(data[1:]))
+    return json.loads(data[1:])
+
+
+async def store_result(state_manager, task_id, result, ttl=None):
+    """Stores a result under its own key, so reading the state of the
+    task does not pay for it. Returns the info kept in the task state.
+
+    Results bigger than result_max_size once encoded are given to the
+    result_offload function, which returns a reference to store
+    instead. Without it, they are not stored and ResultTooLargeException
+    is raised.
+    """
+    settings = app_settings["amqp"]
+    data = encode_result(result)
+    info = {"size": len(data), "compressed": data[:1] == b"z"}
+    max_size = settings.get("result_max_size")
+    if max_size and len(data) > max_size:
+        if not settings.get("result_offload"):
+            raise ResultTooLargeException(
+                f"Result of {len(data)} bytes is bigger than result_max_size "
+                f"({max_size}) and there is no result_offload"
+            )
+        offload = resolve_dotted_name(settings["result_offload"])
+        reference = await offload(task_id, json.dumps(result).encode("utf8"))
+        data = encode_result(reference)
+        info["offloaded"] = True
+    await state_manager.set_value(result_key(task_id), data, ttl=ttl)
+    return info
+
+
 async def update_task_status(
-    state_manager, task_id, status, task=None, ttl=None, result=None, **kwargs
+    state_manager,
+    task_id,
+    status,
+    task=None,
+    ttl=None,
+    result=None,
+    result_ttl=None,
+    **kwargs,
 ):
     if ttl is None:
         ttl = int(app_settings["amqp"]["state_ttl"])
@@ -437,11 +1130,25 @@ async def update_task_status(
     task_data = {"status": status}
 
     if result:
-        task_data["result"] = result
+        result_ttl = result_ttl or app_settings["amqp"].get("result_ttl") or ttl
+        task_data["result_info"] = await store_result(
+            state_manager, task_id, result, ttl=int(result_ttl)
+        )
 
     task_data.update(**kwargs)
 
-    await state_manager.update(task_id, task_data, ttl=ttl)
+    event = {"status": status}
+    if kwargs.get("error"):
+        event["error"] = kwargs["error"]
+    await state_manager.update_with_event(
+        task_id,
+        task_data,
+        status_key(task_id),
+        event,
+        channel=events_channel(task_id),
+        max_len=app_settings["amqp"].get("status_stream_max_size", 100),
+        ttl=ttl,
+    )
 
 
 async def update_task_errored(
@@ -487,6 +1194,27 @@ async def update_task_scheduled(
     )
 
 
+async def update_tasks_scheduled(state_manager, task_ids, ttl=None, **kwargs):
+    """Marks many tasks as scheduled, in three round trips"""
+    if ttl is None:
+        ttl = int(app_settings["amqp"]["state_ttl"])
+    data = {"status": TaskStatus.SCHEDULED}
+    data.update(**kwargs)
+    await state_manager.update_many(task_ids, data, ttl=ttl)
+    await state_manager.stream_append_many(
+        [
+            (
+                status_key(task_id),
+                {"status": TaskStatus.SCHEDULED},
+                events_channel(task_id),
+            )
+            for task_id in task_ids
+        ],
+        max_len=app_settings["amqp"].get("status_stream_max_size", 100),
+        ttl=ttl,
+    )
+
+
 async def update_task_canceled(
     state_manager, task_id, task=None, ttl=None, result=None, **kwargs
 ):
@@ -525,6 +1253,7 @@ class RetriableRedis(aioredis.Redis):
 
         if name in (
             "get",
+            "mget",
             "set",
             "expire",
             "setnx",
@@ -537,6 +1266,14 @@ class RetriableRedis(aioredis.Redis):
 
         return original
 
+    def pipeline(self):
+        # Pipelined commands have to be queued synchronously, so they are
+        # not wrapped. The whole pipeline is sent at once on execute
+        return aioredis.commands.Pipeline(self._pool_or_conn, aioredis.Redis)
+
+    def multi_exec(self):
+        return aioredis.commands.MultiExec(self._pool_or_conn, aioredis.Redis)
+
 
 def retriable_func(func):
     @backoff.on_exception(backoff.expo, REDIS_RETRIABLE_EXCEPTIONS, max_tries=4)
@@ -1,8 +1,11 @@
 from guillotina import app_settings
 from guillotina import testing
 from guillotina_amqp import amqp
+from guillotina_amqp.state import get_state_manager
+from guillotina_amqp.tests.mocks import RecordingRedis
 from guillotina_amqp.worker import Worker
 from pytest_docker_fixtures.containers.rabbitmq import rabbitmq_image
+from unittest import mock
 
 import pytest
 import uuid
@@ -80,9 +83,9 @@ def amqp_worker(loop):
     yield _worker
 
     # Tear down worker
+    _worker.cancel()
     for conn in [v for v in app_settings["amqp"].get("connections", []).values()]:
         loop.run_until_complete(conn["protocol"].close())
-    _worker.cancel()
     app_settings["amqp"]["connections"] = {}
 
 
@@ -129,6 +132,20 @@ def redis_state_manager(redisx, dummy_request, loop):
     yield redisx
 
 
+@pytest.fixture(scope="function")
+async def recording_redis(redis_state_manager):
+    """Counts the round trips of the redis state manager"""
+    state_manager = get_state_manager()
+    cache = await state_manager.get_cache()
+    recorder = RecordingRedis(cache._pool_or_conn)
+
+    async def get_cache():
+        return recorder
+
+    with mock.patch.object(state_manager, "get_cache", get_cache):
+        yield recorder
+
+
 @pytest.fixture(scope="function")
 async def amqp_channel():
     channel, transport, protocol = await amqp.get_connection()
@@ -1,4 +1,9 @@
+from collections import Counter
+from guillotina_amqp.state import RetriableRedis
+
+import aioredis
 import asyncio
+import time
 import uuid
 
 
@@ -7,10 +12,17 @@ class MockChannel:
         self.published = []
         self.acked = []
         self.nacked = []
+        self.declared = []
 
     async def publish(self, *args, **kwargs):
         self.published.append({"args": args, "kwargs": kwargs})
 
+    async def queue_declare(self, *args, **kwargs):
+        self.declared.append({"args": args, "kwargs": kwargs})
+
+    async def queue_bind(self, *args, **kwargs):
+        pass
+
     async def basic_client_ack(self, *args, **kwargs):
         self.acked.append({"args": args, "kwargs": kwargs})
 
@@ -45,6 +57,8 @@ class MockAMQPChannel:
                 self.protocol.dead_mapping[queue_name] = arguments[
                     "x-dead-letter-routing-key"
                 ]
+            if "x-message-ttl" in arguments:
+                self.protocol.ttls[queue_name] = arguments["x-message-ttl"]
 
     async def queue_bind(self, *args, **kwargs):
         pass
@@ -86,20 +100,45 @@ class MockAMQPChannel:
         self.consumers.append(
             asyncio.ensure_future(self._basic_consume(handler, queue_name))
         )
+        return {"consumer_tag": str(len(self.consumers) - 1)}
+
+    async def basic_cancel(self, consumer_tag):
+        self.consumers[int(consumer_tag)].cancel()
 
     async def publish(
         self, message, exchange_name=None, routing_key=None, properties={}
     ):
         if routing_key not in self.protocol.queues:
             self.protocol.queues[routing_key] = []
-        self.protocol.queues[routing_key].append(
-            {
-                "id": str(uuid.uuid4()),
-                "message": message,
-                "properties": properties,
-                "queue": routing_key,
-            }
-        )
+        entry = {
+            "id": str(uuid.uuid4()),
+            "message": message,
+            "properties": properties,
+            "queue": routing_key,
+        }
+        ttls = [properties.get("expiration"), self.protocol.ttls.get(routing_key)]
+        ttls = [int(ttl) for ttl in ttls if ttl is not None]
+        if ttls and routing_key in self.protocol.dead_mapping:
+            entry["expires"] = time.time() + min(ttls) / 1000
+            asyncio.get_event_loop().call_later(
+                min(ttls) / 1000, self._expire, routing_key
+            )
+        self.protocol.queues[routing_key].append(entry)
+
+    def _expire(self, queue_name):
+        """Dead letters the expired messages at the head of the queue, as
+        RabbitMQ does: messages behind one that has not expired wait
+        """
+        queue = self.protocol.queues.get(queue_name, [])
+        while queue and queue[0].get("expires", float("inf")) <= time.time():
+            entry = queue.pop(0)
+            del entry["expires"]
+            entry["queue"] = self.protocol.dead_mapping[queue_name]
+            self.protocol.queues.setdefault(entry["queue"], []).append(entry)
+        if queue and "expires" in queue[0]:
+            asyncio.get_event_loop().call_later(
+                max(queue[0]["expires"] - time.time(), 0), self._expire, queue_name
+            )
 
     async def close(self):
         self.closed = True
@@ -118,6 +157,7 @@ class MockAMQPProtocol:
     def __init__(self):
         self.queues = {}
         self.dead_mapping = {}
+        self.ttls = {}
         self.closed = False
         self.channels = []
 
@@ -142,3 +182,80 @@ class MockAMQPProtocol:
 
 async def amqp_connection_factory(*args, **kwargs):
     return MockAMQPTransport(), MockAMQPProtocol()
+
+
+def _size(value):
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    return len(str(value).encode("utf8"))
+
+
+class RecordingRedis(RetriableRedis):
+    """Redis client for the state manager that counts round trips and
+    bytes sent by command. Pipelines count as a single round trip, named
+    after their commands. latency is added to every round trip.
+    """
+
+    def __init__(self, pool_or_conn, latency=0):
+        super().__init__(pool_or_conn)
+        self.latency = latency
+        self.reset()
+
+    def reset(self):
+        self.round_trips = Counter()
+        self.bytes_sent = Counter()
+
+    @property
+    def total_round_trips(self):
+        return sum(self.round_trips.values())
+
+    @property
+    def total_bytes_sent(self):
+        return sum(self.bytes_sent.values())
+
+    def record(self, name, args):
+        self.round_trips[name] += 1
+        self.bytes_sent[name] += sum(_size(arg) for arg in args)
+
+    def execute(self, command, *args, **kwargs):
+        self.record(_command_name(command), (command,) + args)
+        result = super().execute(command, *args, **kwargs)
+        if not self.latency:
+            return result
+        return self._delayed(result)
+
+    async def _delayed(self, result):
+        await asyncio.sleep(self.latency)
+        return await result
+
+    def pipeline(self):
+        return RecordingPipeline(self, aioredis.commands.Pipeline)
+
+    def multi_exec(self):
+        return RecordingPipeline(self, aioredis.commands.MultiExec)
+
+
+def _command_name(command):
+    if isinstance(command, bytes):
+        command = command.decode()
+    return command.upper()
+
+
+class RecordingPipeline:
+    def __init__(self, recorder, pipeline_class):
+        self._recorder = recorder
+        self._pipe = pipeline_class(recorder._pool_or_conn, aioredis.Redis)
+
+    def __getattr__(self, name):
+        return getattr(self._pipe, name)
+
+    async def execute(self, **kwargs):
+        commands = self._pipe._pipeline
+        # Named after its distinct commands, so batches of any size match
+        names = dict.fromkeys(_command_name(cmd) for _, cmd, _, _ in commands)
+        name = "+".join(names)
+        args = [arg for _, cmd, cmd_args, _ in commands for arg in (cmd,) + cmd_args]
+        self._recorder.record(f"pipeline:{name}", args)
+        if self._recorder.latency:
+            await asyncio.sleep(self._recorder.latency)
+        return await self._pipe.execute(**kwargs)
@@ -1,13 +1,34 @@
 from guillotina import configure
+from guillotina_amqp.decorators import task
 from guillotina_amqp.interfaces import MessageType
 from guillotina_amqp.utils import add_object_task
 from guillotina_amqp.utils import add_task
 
+import os
+import threading
+
 
 async def task_foobar_yo(one, two, three="blah"):
     return one + two
 
 
+def task_sync_thread(one, two):
+    # Plain functions run in the thread pool
+    return [one + two, threading.get_ident()]
+
+
+@task(executor="process")
+def task_sync_process(one, two):
+    return [one + two, os.getpid()]
+
+
+@task(stream_results=True)
+async def task_stream_results(start, stop):
+    for value in range(start, stop):
+        # Appended to the results stream instead of the 'result' key
+        yield (MessageType.RESULT, value)
+
+
 async def task_object_write(ob, value):
     ob.title = value
     ob.register()
@@ -4,9 +4,12 @@ from guillotina_amqp.decorators import ObjectTaskDefinition
 from guillotina_amqp.decorators import TaskDefinition
 from guillotina_amqp.decorators import object_task
 from guillotina_amqp.decorators import task
+from guillotina_amqp.exceptions import DelayTaskException
 from guillotina_amqp.job import Job
+from guillotina_amqp.state import get_state_manager
 from guillotina_amqp.state import TaskState
 from guillotina_amqp.state import TaskStatus
+from guillotina_amqp.tests.utils import _debounced_object_task
 from guillotina_amqp.tests.utils import _decorator_test_func
 from guillotina_amqp.tests.utils import _decorator_test_func_custom_queue
 from guillotina_amqp.tests.utils import _object_task_custom_queue
@@ -17,13 +20,17 @@ from guillotina_amqp.tests.utils import _test_delay_queue
 from guillotina_amqp.tests.utils import _test_failing_func
 from guillotina_amqp.tests.utils import _test_func
 from guillotina_amqp.tests.utils import _test_long_func
+from guillotina_amqp.utils import _run_debounced_object_task
 from guillotina_amqp.utils import _run_object_task
 from guillotina_amqp.utils import _yield_object_task
 from guillotina_amqp.utils import add_task
 from guillotina_amqp.utils import cancel_task
+from unittest import mock
 
 import asyncio
+import guillotina_amqp.task_vars
 import json
+import pytest
 import time
 
 
@@ -71,6 +78,21 @@ def test_object_task_decorator_with_args():
     assert my_func.dest_queue == "other"
 
 
+def test_task_decorators_take_their_options_positionally():
+    async def my_func():
+        pass
+
+    definition = task(None, 2, "q")(my_func)
+    assert (definition.retries, definition.dest_queue) == (2, "q")
+    definition = object_task(None, 4, "other")(my_func)
+    assert (definition.retries, definition.dest_queue) == (4, "other")
+
+    with pytest.raises(TypeError):
+        task(retry=5)
+    with pytest.raises(TypeError):
+        object_task(debounc=1)
+
+
 async def test_add_task(
     dummy_request,
     rabbitmq_container,
@@ -89,6 +111,158 @@ async def test_add_task(
     task_vars.request.set(None)
 
 
+async def test_add_task_skips_duplicates(
+    dummy_request, amqp_worker, configured_state_manager
+):
+    task_vars.request.set(dummy_request)
+    first = await add_task(_test_func, 1, 2, dedupe_key="sum")
+    second = await add_task(_test_func, 1, 2, dedupe_key="sum")
+    assert second.task_id == first.task_id
+
+    await first.join(0.1)
+    assert amqp_worker.total_run == 1
+
+    # Once the task runs, it can be scheduled again
+    third = await add_task(_test_func, 1, 2, dedupe_key="sum")
+    assert third.task_id != first.task_id
+    await third.join(0.1)
+    assert amqp_worker.total_run == 2
+
+    task_vars.request.set(None)
+
+
+async def test_tasks_are_scheduled_before_being_published(
+    dummy_request, amqp_worker, configured_state_manager
+):
+    task_vars.request.set(dummy_request)
+    state_manager = get_state_manager()
+    statuses = []
+
+    async def publish(channel, data, dest_queue):
+        statuses.append((await state_manager.get(data["task_id"])).get("status"))
+
+    with mock.patch("guillotina_amqp.utils._publish", side_effect=publish):
+        await add_task(_test_func, 1, 2)
+    assert statuses == [TaskStatus.SCHEDULED]
+
+    # Tasks that could not be published are errored
+    with mock.patch("guillotina_amqp.utils._publish", side_effect=ValueError):
+        with pytest.raises(ValueError):
+            await add_task(_test_func, 1, 2, _task_id="unpublished")
+    state = await state_manager.get("unpublished")
+    assert state["status"] == TaskStatus.ERRORED
+    task_vars.request.set(None)
+
+
+async def test_debounced_object_task_runs_once_with_last_arguments(
+    dummy_request, amqp_worker, configured_state_manager
+):
+    task_vars.request.set(dummy_request)
+    ob = object()
+    with mock.patch("guillotina_amqp.utils.get_content_path", return_value="/ob"):
+        with mock.patch(
+            "guillotina_amqp.utils._prepare_func",
+            return_value=(ob, _debounced_object_task.func),
+        ):
+            states = [await _debounced_object_task(ob, value) for value in range(3)]
+            assert len({state.task_id for state in states}) == 1
+
+            assert (await states[0].join(0.1))["result"] == 2
+            # Waited for the window in a delay queue, then ran once
+            assert amqp_worker.total_run == 1
+
+            # Once it runs, it is scheduled again
+            state = await _debounced_object_task(ob, 3)
+            assert state.task_id != states[0].task_id
+            assert (await state.join(0.1))["result"] == 3
+
+    task_vars.request.set(None)
+
+
+async def test_debounced_object_task_runs_with_the_last_request(dummy_request):
+    last = {"url": "http://localhost/db", "user": {"id": "last"}}
+    value = {"task_id": "foo", "args": [1], "kwargs": {}, "req_data": last}
+    value["updated"] = time.time() - 1
+    await get_state_manager().set_value("debounce", json.dumps(value).encode(), 60)
+
+    job = mock.MagicMock(data={"req_data": {"user": {"id": "first"}}})
+    token = guillotina_amqp.task_vars.amqp_job.set(job)
+    try:
+        # Sent back to run with the request of the last caller
+        with pytest.raises(DelayTaskException) as exc:
+            await _run_debounced_object_task("func", "/ob", "debounce", 0.2)
+        assert exc.value.delay == 0
+        assert exc.value.data == {"req_data": last}
+        assert exc.value.status == TaskStatus.SCHEDULED
+
+        job.data = exc.value.data
+        with mock.patch(
+            "guillotina_amqp.utils._run_object_task", return_value=2
+        ) as run:
+            assert await _run_debounced_object_task("func", "/ob", "debounce", 0.2) == 2
+        run.assert_called_with("func", "/ob", 1)
+    finally:
+        guillotina_amqp.task_vars.amqp_job.reset(token)
+
+
+async def test_task_lifecycle_timeline(
+    dummy_request, amqp_worker, configured_state_manager, metrics_registry
+):
+    task_vars.request.set(dummy_request)
+    state = await add_task(_test_func, 1, 2)
+    data = await state.join(0.1)
+    timeline = data["timeline"]
+    assert list(timeline) == [
+        "published",
+        "received",
+        "admitted",
+        "leased",
+        "request_built",
+        "started",
+        "committed",
+        "acked",
+    ]
+    assert list(timeline.values()) == sorted(timeline.values())
+
+    for phase in ("queue", "admission", "lease", "request", "start", "run", "ack"):
+        assert metrics_registry.get_sample_value(
+            "guillotina_amqp_task_phase_seconds_count",
+            {"phase": phase, "queue": "guillotina"},
+        )
+    task_vars.request.set(None)
+
+
+class _Transaction:
+    def __init__(self):
+        self.hooks = []
+
+    def add_after_commit_hook(self, hook):
+        self.hooks.append(hook)
+
+
+async def test_after_commit_tasks_are_published_together(
+    dummy_request, amqp_worker, configured_state_manager
+):
+    task_vars.request.set(dummy_request)
+    txn = _Transaction()
+    with mock.patch("guillotina_amqp.decorators.get_transaction", return_value=txn):
+        _decorator_test_func.after_commit(1, 2)
+        _decorator_test_func.after_commit(1, 2)
+        _decorator_test_func.after_commit(2, 3)
+    assert len(txn.hooks) == 1
+
+    states = await txn.hooks[0](True)
+    assert len(states) == 2
+    assert [(await state.join(0.1))["result"] for state in states] == [3, 5]
+    assert amqp_worker.total_run == 2
+
+    # Aborted transactions do not publish anything
+    with mock.patch("guillotina_amqp.decorators.get_transaction", return_value=txn):
+        _decorator_test_func.after_commit(1, 2)
+    assert await txn.hooks[1](False) == []
+    task_vars.request.set(None)
+
+
 async def test_add_task_to_specific_queue(
     dummy_request,
     rabbitmq_container,
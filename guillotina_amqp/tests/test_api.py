@@ -1,11 +1,22 @@
 from guillotina import task_vars
 from guillotina.tests.utils import get_container
+from guillotina.utils import get_dotted_name
+from guillotina_amqp.state import eventlog_key
 from guillotina_amqp.state import get_state_manager
+from guillotina_amqp.state import results_key
+from guillotina_amqp.state import TaskStatus
+from guillotina_amqp.state import update_task_errored
+from guillotina_amqp.state import update_task_finished
+from guillotina_amqp.state import update_task_status
+from guillotina_amqp.tests.utils import _decorator_test_func
 from guillotina_amqp.tests.utils import _test_func
 from guillotina_amqp.utils import add_task
 
 from unittest.mock import patch
 
+import datetime
+import json
+
 
 async def test_list_tasks_returns_all_tasks(container_requester, dummy_request):
     async with container_requester as requester:
@@ -113,3 +124,290 @@ async def test_info_task_filtered_response(
         )
         assert status == 200
         assert "job_data" not in resp
+
+
+async def test_info_task_pages_the_eventlog(container_requester, dummy_request):
+    async with container_requester as requester:
+        task_vars.request.set(dummy_request)
+        task_vars.db.set(requester.db)
+        await get_container(requester=requester)
+
+        t1 = await add_task(_test_func, 1, 2)
+        for idx in range(5):
+            await get_state_manager().stream_append(
+                eventlog_key(t1.task_id), ["date", f"message {idx}"]
+            )
+
+        url = f"/db/guillotina/@amqp-tasks/{t1.task_id}"
+        resp, status = await requester("GET", url)
+        assert status == 200
+        assert len(resp["eventlog"]) == 5
+
+        resp, status = await requester("GET", url + "?eventlog_size=2")
+        assert resp["eventlog"] == [["date", "message 0"], ["date", "message 1"]]
+        assert resp["eventlog_total"] == 5
+
+        resp, status = await requester(
+            "GET", url + f"?eventlog_size=3&eventlog_cursor={resp['eventlog_cursor']}"
+        )
+        assert [m for _, m in resp["eventlog"]] == [
+            "message 2",
+            "message 3",
+            "message 4",
+        ]
+
+        resp, status = await requester(
+            "GET", url + f"?eventlog_size=3&eventlog_cursor={resp['eventlog_cursor']}"
+        )
+        assert resp["eventlog"] == []
+        assert resp["eventlog_cursor"] is None
+
+
+async def test_task_results_are_read_from_a_cursor(container_requester, dummy_request):
+    async with container_requester as requester:
+        task_vars.request.set(dummy_request)
+        task_vars.db.set(requester.db)
+        await get_container(requester=requester)
+
+        t1 = await add_task(_test_func, 1, 2)
+        await get_state_manager().stream_extend(results_key(t1.task_id), [1, 2, 3])
+
+        url = f"/db/guillotina/@amqp-tasks/{t1.task_id}/results"
+        resp, status = await requester("GET", url + "?size=2")
+        assert status == 200
+        assert resp["items"] == [1, 2]
+
+        resp, status = await requester("GET", url + f"?cursor={resp['cursor']}")
+        assert resp["items"] == [3]
+        cursor = resp["cursor"]
+
+        # Nothing new yet: keep polling from the same cursor
+        resp, status = await requester("GET", url + f"?cursor={cursor}")
+        assert resp["items"] == []
+        assert resp["cursor"] == cursor
+
+        resp, status = await requester("GET", "/db/guillotina/@amqp-tasks/foo/results")
+        assert status == 404
+
+
+async def test_task_events_are_streamed(container_requester, dummy_request):
+    async with container_requester as requester:
+        task_vars.request.set(dummy_request)
+        task_vars.db.set(requester.db)
+        await get_container(requester=requester)
+
+        t1 = await add_task(_test_func, 1, 2)
+        state_manager = get_state_manager()
+        await state_manager.stream_append(eventlog_key(t1.task_id), ["date", "started"])
+        await update_task_finished(state_manager, t1.task_id, result=3)
+
+        url = f"/db/guillotina/@amqp-tasks/{t1.task_id}/events"
+        resp, status, headers = await requester.make_request("GET", url, accept=None)
+        assert status == 200
+        assert headers["Content-Type"] == "text/event-stream"
+        events = [
+            dict(line.split(": ", 1) for line in event.split("\n"))
+            for event in resp.decode().strip().split("\n\n")
+        ]
+        assert [(e["event"], e["data"]) for e in events] == [
+            ("status", '{"status": "scheduled"}'),
+            ("status", '{"status": "finished"}'),
+            ("eventlog", '["date", "started"]'),
+        ]
+
+        # Resume after the last event received
+        resp, status, _ = await requester.make_request(
+            "GET", url, accept=None, headers={"Last-Event-ID": events[1]["id"]}
+        )
+        assert resp.decode().split("\n")[1] == "event: eventlog"
+
+        resp, status = await requester("GET", url + "?cursor=foo")
+        assert status == 412
+
+
+async def test_info_task_only_includes_the_result_when_asked(
+    container_requester, dummy_request
+):
+    async with container_requester as requester:
+        task_vars.request.set(dummy_request)
+        task_vars.db.set(requester.db)
+        await get_container(requester=requester)
+
+        t1 = await add_task(_test_func, 1, 2)
+        await update_task_finished(get_state_manager(), t1.task_id, result=3)
+
+        url = f"/db/guillotina/@amqp-tasks/{t1.task_id}"
+        resp, status = await requester("GET", url)
+        assert "result" not in resp
+        resp, status = await requester("GET", url + "?include_result=1")
+        assert resp["result"] == 3
+
+
+async def test_cancel_tasks_by_function_and_status(container_requester, dummy_request):
+    async with container_requester as requester:
+        task_vars.request.set(dummy_request)
+        task_vars.db.set(requester.db)
+        await get_container(requester=requester)
+        state_manager = get_state_manager()
+
+        t1 = await add_task(_test_func, 1, 2)
+        t2 = await add_task(_test_func, 3, 4)
+        finished = await add_task(_test_func, 5, 6)
+        await update_task_finished(state_manager, finished.task_id)
+        other = await add_task(_decorator_test_func, 1, 2)
+
+        resp, status = await requester(
+            "POST",
+            "/db/guillotina/@amqp-tasks/@cancel",
+            data=json.dumps(
+                {"function": get_dotted_name(_test_func), "status": "scheduled"}
+            ),
+        )
+        assert status == 200
+        assert resp == {"canceled": 2}
+        assert await t1.is_canceled()
+        assert await t2.is_canceled()
+        assert not await finished.is_canceled()
+        assert not await other.is_canceled()
+
+        resp, status = await requester(
+            "POST",
+            "/db/guillotina/@amqp-tasks/@cancel",
+            data=json.dumps({"created_before": "2000-01-01T00:00:00"}),
+        )
+        assert resp == {"canceled": 0}
+
+        resp, status = await requester(
+            "POST",
+            "/db/guillotina/@amqp-tasks/@cancel",
+            data=json.dumps({"status": "finished"}),
+        )
+        assert status == 412
+
+        # Waiting to be retried, or back from the delay queue
+        errored = await add_task(_test_func, 7, 8)
+        await update_task_errored(state_manager, errored.task_id, job_retries=1)
+        sleeping = await add_task(_test_func, 9, 10)
+        await update_task_status(state_manager, sleeping.task_id, TaskStatus.SLEEPING)
+        resp, status = await requester(
+            "POST",
+            "/db/guillotina/@amqp-tasks/@cancel",
+            data=json.dumps({"status": "errored"}),
+        )
+        assert resp == {"canceled": 1}
+        resp, status = await requester(
+            "POST",
+            "/db/guillotina/@amqp-tasks/@cancel",
+            data=json.dumps({"status": "sleeping"}),
+        )
+        assert resp == {"canceled": 1}
+        assert await errored.is_canceled()
+        assert await sleeping.is_canceled()
+        assert not await finished.is_canceled()
+
+
+async def test_cancel_tasks_validates_the_body(container_requester, dummy_request):
+    async with container_requester as requester:
+        task_vars.request.set(dummy_request)
+        task_vars.db.set(requester.db)
+        await get_container(requester=requester)
+
+        for body in (
+            [],
+            {"function": 1},
+            {"status": ["scheduled"]},
+            {"created_before": [1]},
+            {"created_before": True},
+            {"created_before": "yesterday"},
+        ):
+            resp, status = await requester(
+                "POST", "/db/guillotina/@amqp-tasks/@cancel", data=json.dumps(body)
+            )
+            assert status == 412
+
+        # Dates without offset are in UTC
+        task = await add_task(_test_func, 1, 2)
+        created_before = datetime.datetime.utcnow() + datetime.timedelta(minutes=1)
+        resp, status = await requester(
+            "POST",
+            "/db/guillotina/@amqp-tasks/@cancel",
+            data=json.dumps({"created_before": created_before.isoformat()}),
+        )
+        assert resp == {"canceled": 1}
+        assert await task.is_canceled()
+
+
+async def test_tasks_status_reads_many_tasks(container_requester, dummy_request):
+    async with container_requester as requester:
+        task_vars.request.set(dummy_request)
+        task_vars.db.set(requester.db)
+        await get_container(requester=requester)
+
+        t1 = await add_task(_test_func, 1, 2)
+        t2 = await add_task(_test_func, 3, 4)
+        await update_task_finished(get_state_manager(), t2.task_id)
+        other_container = "task:db-other-foobar"
+
+        resp, status = await requester(
+            "POST",
+            "/db/guillotina/@amqp-tasks/@status",
+            data=json.dumps(
+                {
+                    "task_ids": [t1.task_id, t2.task_id, other_container],
+                    "fields": ["status"],
+                }
+            ),
+        )
+        assert status == 200
+        assert resp == {
+            t1.task_id: {"status": "scheduled"},
+            t2.task_id: {"status": "finished"},
+            other_container: None,
+        }
+
+        resp, status = await requester(
+            "POST",
+            "/db/guillotina/@amqp-tasks/@status",
+            data=json.dumps({"task_ids": "foobar"}),
+        )
+        assert status == 412
+
+        for body in (
+            {"task_ids": [["foo"], {"bar": 1}]},
+            {"task_ids": [t1.task_id], "fields": [["status"]]},
+            ["foo"],
+        ):
+            resp, status = await requester(
+                "POST", "/db/guillotina/@amqp-tasks/@status", data=json.dumps(body)
+            )
+            assert status == 412
+
+
+async def test_profile_task_functions(container_requester):
+    async with container_requester as requester:
+        function = get_dotted_name(_test_func)
+        resp, status = await requester(
+            "POST",
+            "/db/guillotina/@amqp-profiles",
+            data=json.dumps({"function": function, "executions": 2}),
+        )
+        assert status == 200
+        assert resp == {"function": function, "remaining": 2}
+
+        resp, status = await requester(
+            "GET", f"/db/guillotina/@amqp-profiles?function={function}"
+        )
+        assert status == 200
+        assert resp == {
+            "function": function,
+            "remaining": 2,
+            "executions": [],
+            "calls": [],
+        }
+
+        resp, status = await requester(
+            "POST",
+            "/db/guillotina/@amqp-profiles",
+            data=json.dumps({"function": function, "executions": 0}),
+        )
+        assert status == 412
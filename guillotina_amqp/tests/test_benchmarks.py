@@ -0,0 +1,219 @@
+"""Benchmarks of the hot paths of the worker.
+
+They only run when AMQP_BENCHMARK is set. Worker runs are driven
+through the mocked AMQP connection, for each state manager, task
+profile and concurrency level, and their latencies are read from the
+timeline of each task. Set AMQP_BENCHMARK_TASKS to change the number of
+tasks per run (50), AMQP_BENCHMARK_OUTPUT to append the results to a
+file as JSON lines, and AMQP_BENCHMARK_THRESHOLDS to a JSON file of
+{"<run name>": {"min_tasks_per_second": ..., "max_p99_ms": ...}} to
+fail on regressions.
+"""
+
+from aiohttp import test_utils
+from aiohttp.helpers import noop
+from guillotina import app_settings
+from guillotina import task_vars
+from guillotina_amqp.interfaces import MessageType
+from guillotina_amqp.job import EmptyPayload
+from guillotina_amqp.job import RequestFactory
+from guillotina_amqp.utils import build_task_data
+from guillotina_amqp.utils import get_request_data
+from guillotina_amqp.utils import publish_tasks_data
+from guillotina_amqp.worker import Worker
+from multidict import CIMultiDict
+from typing import Dict
+from unittest import mock
+from urllib.parse import urlparse
+
+import asyncio
+import json
+import os
+import pytest
+import time
+import yarl
+
+
+benchmark = pytest.mark.skipif(
+    not os.environ.get("AMQP_BENCHMARK"), reason="AMQP_BENCHMARK is not set"
+)
+
+req_data = {
+    "url": "http://localhost:8080/db/guillotina/folder",
+    "method": "POST",
+    "headers": {
+        "Authorization": "Bearer foobar",
+        "Content-Type": "application/json",
+        "X-Forwarded-For": "127.0.0.1",
+    },
+}
+
+
+def _mock_request(base_request, task):
+    """How jobs used to build their request"""
+    url = req_data["url"]
+    message = base_request._message._replace(
+        method=req_data["method"],
+        url=yarl.URL(url),
+        path=urlparse(url).path,
+        headers=CIMultiDict(req_data["headers"]),
+        raw_headers=tuple(
+            (k.encode("utf-8"), v.encode("utf-8"))
+            for k, v in req_data["headers"].items()
+        ),
+    )
+    payload_writer = mock.Mock()
+    payload_writer.write_eof.side_effect = noop
+    payload_writer.drain.side_effect = noop
+    protocol = mock.Mock()
+    protocol.transport = test_utils._create_transport(None)
+    protocol.writer = payload_writer
+    return base_request.__class__(
+        message,
+        EmptyPayload(),
+        protocol,
+        payload_writer,
+        task,
+        task._loop,
+        client_max_size=base_request._client_max_size,
+        state=base_request._state.copy(),
+    )
+
+
+def _timeit(func, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - start) / iterations
+
+
+@benchmark
+async def test_benchmark_job_request_construction(dummy_request):
+    iterations = 2000
+    task = asyncio.current_task()
+    factory = RequestFactory(dummy_request)
+
+    mocked = _timeit(lambda: _mock_request(dummy_request, task), iterations)
+    factored = _timeit(lambda: factory(req_data, task), iterations)
+    _write_output(
+        "request-construction",
+        {"mock_us": mocked * 1e6, "factory_us": factored * 1e6},
+    )
+    assert factored < mocked
+
+
+async def test_factory_requests_do_not_share_headers(dummy_request):
+    task = asyncio.current_task()
+    factory = RequestFactory(dummy_request)
+    first = factory(req_data, task)
+    first.headers["Authorization"] = "Bearer changed"
+    second = factory(req_data, task)
+
+    assert second.headers["Authorization"] == "Bearer foobar"
+    assert second.method == "POST"
+    assert second.path == "/db/guillotina/folder"
+    assert second.transport.get_extra_info("sslcontext") is None
+
+
+async def _bench_noop(index):
+    return index
+
+
+async def _bench_io(index):
+    await asyncio.sleep(0.01)
+
+
+async def _bench_generator(index):
+    for value in range(10):
+        yield (MessageType.RESULT, value)
+
+
+PROFILES = {"noop": _bench_noop, "io": _bench_io, "generator": _bench_generator}
+
+
+def _percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def _write_output(name, results):
+    output = os.environ.get("AMQP_BENCHMARK_OUTPUT")
+    if output:
+        with open(output, "a") as fi:
+            fi.write(json.dumps(dict(results, name=name)) + "\n")
+
+
+def _report(name, results):
+    _write_output(name, results)
+    thresholds = os.environ.get("AMQP_BENCHMARK_THRESHOLDS")
+    if thresholds:
+        with open(thresholds) as fi:
+            limits = json.load(fi).get(name, {})
+        if "min_tasks_per_second" in limits:
+            assert results["tasks_per_second"] >= limits["min_tasks_per_second"]
+        if "max_p99_ms" in limits:
+            assert results["lifecycle_p99_ms"] <= limits["max_p99_ms"]
+
+
+async def _run_worker(loop, func, tasks, concurrency):
+    """Publishes the tasks at once and measures how the worker runs
+    them
+    """
+    worker = Worker(loop=loop, max_size=concurrency, check_activity=False)
+    await worker.start()
+    # Timelines of the finished tasks, by task id
+    timelines: Dict[str, Dict[str, float]] = {}
+    handle_successful = worker._handle_successful
+
+    async def _record_finished(task):
+        await handle_successful(task)
+        timelines[task._job.data["task_id"]] = task._job.timeline.times
+
+    with mock.patch.object(worker, "_handle_successful", _record_finished):
+        try:
+            req_data = get_request_data()
+            jobs = [
+                (build_task_data(func, (index,), {}, req_data), None)
+                for index in range(tasks)
+            ]
+            task_ids = {data["task_id"] for data, _ in jobs}
+            await publish_tasks_data(jobs)
+            while not task_ids.issubset(timelines):
+                await asyncio.sleep(0.005)
+        finally:
+            for conn in list(app_settings["amqp"].get("connections", {}).values()):
+                await conn["protocol"].close()
+            worker.cancel()
+            app_settings["amqp"]["connections"] = {}
+
+    # Messages left by other tests may have run too
+    times = [timelines[task_id] for task_id in task_ids]
+    admission = [(t["admitted"] - t["published"]) * 1000 for t in times]
+    lifecycle = [(t["acked"] - t["published"]) * 1000 for t in times]
+    started = min(t["published"] for t in times)
+    return {
+        "tasks": tasks,
+        "concurrency": concurrency,
+        "tasks_per_second": tasks / (max(t["acked"] for t in times) - started),
+        "admission_p50_ms": _percentile(admission, 50),
+        "admission_p99_ms": _percentile(admission, 99),
+        "lifecycle_p50_ms": _percentile(lifecycle, 50),
+        "lifecycle_p99_ms": _percentile(lifecycle, 99),
+    }
+
+
+@benchmark
+@pytest.mark.parametrize("concurrency", [10, 50])
+@pytest.mark.parametrize("profile", sorted(PROFILES))
+async def test_benchmark_worker_throughput(
+    dummy_request, configured_state_manager, loop, profile, concurrency
+):
+    task_vars.request.set(dummy_request)
+    tasks = int(os.environ.get("AMQP_BENCHMARK_TASKS", 50))
+    results = await _run_worker(loop, PROFILES[profile], tasks, concurrency)
+    manager = app_settings["amqp"]["persistent_manager"]
+    results["state_manager"] = manager
+    results["profile"] = profile
+
+    _report(f"worker-{manager}-{profile}-c{concurrency}", results)
+    task_vars.request.set(None)
@@ -0,0 +1,155 @@
+from guillotina import task_vars
+from guillotina_amqp.canvas import chain
+from guillotina_amqp.canvas import chord
+from guillotina_amqp.canvas import group
+from guillotina_amqp.canvas import GroupResult
+from guillotina_amqp.canvas import on_task_failed
+from guillotina_amqp.exceptions import TaskNotFoundException
+from guillotina_amqp.job import Job
+from guillotina_amqp.state import get_state_manager
+from guillotina_amqp.state import TaskState
+from guillotina_amqp.state import TaskStatus
+from guillotina_amqp.tests.mocks import MockChannel
+from guillotina_amqp.tests.mocks import MockEnvelope
+from guillotina_amqp.tests.utils import _decorator_test_func
+from guillotina_amqp.tests.utils import _object_task_custom_queue
+from guillotina_amqp.tests.utils import _test_square
+from guillotina_amqp.tests.utils import _test_sum
+from guillotina_amqp.utils import _run_object_chunk
+from guillotina_amqp.worker import Worker
+from unittest import mock
+
+import asyncio
+import pytest
+
+
+async def _join(state, timeout=5):
+    """Joins a task that may not be scheduled yet"""
+    for _ in range(int(timeout / 0.01)):
+        try:
+            return await state.join(0.01)
+        except TaskNotFoundException:
+            await asyncio.sleep(0.01)
+    raise TimeoutError(state.task_id)
+
+
+async def test_chain_passes_results_along(dummy_request, amqp_worker):
+    task_vars.request.set(dummy_request)
+    states = await chain(
+        _decorator_test_func.s(1, 2),
+        _decorator_test_func.s(10),
+        _decorator_test_func.si(5, 5),
+    ).schedule()
+
+    assert [(await _join(state))["result"] for state in states] == [3, 13, 10]
+    task_vars.request.set(None)
+
+
+async def test_chord_callback_gets_the_results_of_the_group(dummy_request, amqp_worker):
+    task_vars.request.set(dummy_request)
+    header = group(*(_decorator_test_func.s(idx, idx) for idx in range(1, 4)))
+    state = await chord(header, _test_sum.s(extra=100)).schedule()
+
+    assert (await _join(state))["result"] == 112
+    # Members are not waited for: the last one to finish publishes the
+    # callback
+    assert amqp_worker.total_run == 4
+    task_vars.request.set(None)
+
+
+async def test_chord_callback_is_errored_when_a_member_fails(dummy_request):
+    callback = _test_sum.s(extra=100)
+    data = {
+        "task_id": "member",
+        "func": "guillotina_amqp.tests.package.missing",
+        "canvas": {"group": {"id": "foo", "size": 2, "callback": callback.to_dict()}},
+    }
+    await get_state_manager().acquire("member", 900)
+    job = Job(None, data, MockChannel(), MockEnvelope("footag"))
+    await Worker()._handle_unknown_function(job)
+
+    state = await TaskState(callback.task_id).join(0.01)
+    assert state["status"] == TaskStatus.ERRORED
+    assert "Task member failed" in state["error"]
+    assert await GroupResult("foo").failed() == 1
+
+
+async def test_chain_tasks_after_a_failed_one_are_errored(dummy_request):
+    following = [_decorator_test_func.s(10), _decorator_test_func.s(5)]
+    data = {
+        "task_id": "first",
+        "canvas": {"chain": [signature.to_dict() for signature in following]},
+    }
+    await on_task_failed(data, "canceled")
+
+    for signature in following:
+        state = await TaskState(signature.task_id).join(0.01)
+        assert state["status"] == TaskStatus.ERRORED
+        assert state["error"] == "Task first failed: canceled"
+
+
+async def test_group_counts_finished_members(dummy_request, amqp_worker):
+    task_vars.request.set(dummy_request)
+    result = await group(
+        _decorator_test_func.s(1, 1), _decorator_test_func.s(2, 2)
+    ).schedule()
+    for task_id in await result.task_ids():
+        await _join(TaskState(task_id))
+    await asyncio.sleep(0.1)  # counted right after finishing
+
+    assert await result.completed() == 2
+    assert await result.results() == [2, 4]
+    task_vars.request.set(None)
+
+
+def test_object_tasks_can_not_be_part_of_a_canvas():
+    with pytest.raises(TypeError):
+        _object_task_custom_queue.s(1, 2)
+
+
+async def test_map_runs_items_in_chunks(dummy_request, amqp_worker):
+    task_vars.request.set(dummy_request)
+    # Generators are read lazily
+    result = await _test_square.map((idx for idx in range(10)), chunk_size=3)
+    for task_id in await result.task_ids():
+        await _join(TaskState(task_id))
+    await asyncio.sleep(0.1)  # counted right after finishing
+
+    assert amqp_worker.total_run == 4
+    assert await result.progress() == {
+        "chunks": 4,
+        "items": 10,
+        "finished_chunks": 4,
+        "failed_chunks": 0,
+        "processed_items": 10,
+    }
+    assert await result.results() == [idx * idx for idx in range(10)]
+    task_vars.request.set(None)
+
+
+async def test_map_reads_async_iterables(dummy_request, amqp_worker):
+    task_vars.request.set(dummy_request)
+
+    async def values():
+        for idx in range(3):
+            yield [idx, idx]
+
+    result = await _test_sum.map(values(), chunk_size=2)
+    for task_id in await result.task_ids():
+        await _join(TaskState(task_id))
+
+    assert await result.results() == [0, 2, 4]
+    task_vars.request.set(None)
+
+
+async def test_map_object_chunks_call_the_function_with_the_object():
+    async def func(ob, item):
+        return ob + item
+
+    with mock.patch("guillotina_amqp.utils._prepare_func", return_value=(10, func)):
+        assert await _run_object_chunk("func", "/ob", [1, 2]) == [11, 12]
+
+
+async def test_map_needs_positive_chunk_size(dummy_request):
+    with pytest.raises(ValueError):
+        await _test_square.map([1], chunk_size=0)
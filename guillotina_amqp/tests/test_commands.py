@@ -0,0 +1,161 @@
+from guillotina_amqp.commands.supervisor import merge_metrics
+from guillotina_amqp.commands.supervisor import WorkerSupervisor
+from guillotina_amqp.commands.worker import LoopMonitor
+from guillotina_amqp.job import Job
+from prometheus_client.parser import text_string_to_metric_families
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+import asyncio
+import os
+import signal
+import time
+
+
+child_a = """# HELP jobs_total Jobs
+# TYPE jobs_total counter
+jobs_total{type="foo"} 2.0
+jobs_total{type="bar"} 1.0
+# HELP jobs_created Jobs
+# TYPE jobs_created gauge
+jobs_created{type="foo"} 20.0
+# HELP running Running jobs
+# TYPE running gauge
+running 3.0
+"""
+
+child_b = """# HELP jobs_total Jobs
+# TYPE jobs_total counter
+jobs_total{type="foo"} 5.0
+# HELP jobs_created Jobs
+# TYPE jobs_created gauge
+jobs_created{type="foo"} 10.0
+# HELP running Running jobs
+# TYPE running gauge
+running 1.0
+"""
+
+
+def _samples(output):
+    return {
+        (sample.name, tuple(sorted(sample.labels.items()))): sample.value
+        for family in text_string_to_metric_families(output)
+        for sample in family.samples
+    }
+
+
+def test_merge_metrics_adds_up_children():
+    samples = _samples(merge_metrics([child_a, child_b]))
+    assert samples[("jobs_total", (("type", "foo"),))] == 7.0
+    assert samples[("jobs_total", (("type", "bar"),))] == 1.0
+    assert samples[("running", ())] == 4.0
+    # Timestamps are not added up
+    assert samples[("jobs_created", (("type", "foo"),))] == 10.0
+
+
+def test_merge_metrics_adds_up_gauges_named_like_timestamps():
+    output = """# HELP files_created Files
+# TYPE files_created gauge
+files_created 3.0
+"""
+    samples = _samples(merge_metrics([output, output]))
+    assert samples[("files_created", ())] == 6.0
+
+
+def test_merge_metrics_without_children():
+    assert merge_metrics([]) == ""
+
+
+def test_supervisor_restarts_dead_children():
+    supervisor = WorkerSupervisor(MagicMock(), {}, 2)
+    supervisor.restart_delay = 0
+    with patch("os.fork", side_effect=[10, 11, 12]):
+        supervisor.spawn(0)
+        supervisor.spawn(1)
+        with patch("os.waitpid", side_effect=[(10, 256), (0, 0)]):
+            supervisor.reap()
+
+    assert supervisor.children == {11: 1, 12: 0}
+
+
+def test_supervisor_keeps_counters_of_dead_children(tmp_path):
+    supervisor = WorkerSupervisor(MagicMock(), {}, 2)
+    supervisor.restart_delay = 0
+    supervisor.metrics_dir = str(tmp_path)
+    with patch("os.fork", side_effect=[10, 11, 12]):
+        supervisor.spawn(0)
+        supervisor.spawn(1)
+        for pid, output in ((10, child_a), (11, child_b)):
+            with open(supervisor.metrics_path(pid), "w") as fi:
+                fi.write(output)
+        with patch("os.waitpid", side_effect=[(10, 256), (0, 0)]):
+            supervisor.reap()
+
+    samples = _samples(supervisor.collect_metrics())
+    assert samples[("jobs_total", (("type", "foo"),))] == 7.0
+    assert samples[("jobs_total", (("type", "bar"),))] == 1.0
+    # Gauges of dead children are dropped
+    assert samples[("running", ())] == 1.0
+    assert not os.path.exists(supervisor.metrics_path(10))
+
+
+def test_supervisor_forwards_signals_and_stops_restarting():
+    supervisor = WorkerSupervisor(MagicMock(), {}, 2)
+    with patch("os.fork", side_effect=[10, 11]):
+        supervisor.spawn(0)
+        supervisor.spawn(1)
+
+    with patch("os.kill") as kill:
+        supervisor.handle_signal(signal.SIGTERM, None)
+    assert sorted(call[0] for call in kill.call_args_list) == [
+        (10, signal.SIGTERM),
+        (11, signal.SIGTERM),
+    ]
+    assert supervisor.stopping
+
+    with patch("os.fork") as fork:
+        with patch("os.waitpid", side_effect=[(10, 0), (11, 0)]):
+            supervisor.reap()
+    fork.assert_not_called()
+    assert supervisor.children == {}
+
+
+def _block_loop(seconds):
+    time.sleep(seconds)
+
+
+async def test_loop_monitor_reports_blocking_jobs(loop, metrics_registry):
+    monitor = LoopMonitor(loop, interval=0.01, block_threshold=0.1)
+    monitor.start()
+    job = Job(None, {"task_id": "foo", "func": "foo.bar"}, None, None)
+
+    async def run_job():
+        await asyncio.sleep(0.05)
+        _block_loop(0.3)
+
+    task = loop.create_task(run_job())
+    task._job = job
+    await task
+    await asyncio.sleep(0.05)
+    monitor.stop()
+
+    assert monitor.blocked["task_id"] == "foo"
+    assert monitor.blocked["function"] == "foo.bar"
+    assert "_block_loop" in monitor.blocked["stack"]
+    assert metrics_registry.get_sample_value(
+        "guillotina_amqp_worker_loop_blocked_total", {"function": "foo.bar"}
+    )
+    assert metrics_registry.get_sample_value(
+        "guillotina_amqp_worker_loop_lag_seconds_count"
+    )
+
+
+async def test_loop_monitor_kills_blocked_workers(loop):
+    monitor = LoopMonitor(loop, interval=0.01, block_threshold=0.05, kill_after=0.1)
+    with patch("os._exit") as exit:
+        monitor.start()
+        await asyncio.sleep(0.05)
+        _block_loop(0.3)
+        await asyncio.sleep(0.05)
+        monitor.stop()
+    exit.assert_called_with(0)
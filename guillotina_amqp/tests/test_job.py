@@ -1,12 +1,25 @@
+from guillotina.interfaces import ACTIVE_LAYERS_KEY
+from guillotina.interfaces import IDefaultLayer
+from guillotina.utils import resolve_dotted_name
+from guillotina_amqp.decorators import object_task
+from guillotina_amqp.decorators import task
 from guillotina_amqp.exceptions import ObjectNotFoundException
+from guillotina_amqp.executors import shutdown_executors
+from guillotina_amqp.job import ContainerCache
 from guillotina_amqp.job import Job
+from guillotina_amqp.job import RequestFactory
+from guillotina_amqp.state import TaskState
+from guillotina_amqp.tests.package import task_foobar_yo
 from guillotina_amqp.tests.mocks import MockChannel
 from guillotina_amqp.tests.mocks import MockEnvelope
 from unittest.mock import AsyncMock
 from unittest.mock import MagicMock
 from unittest.mock import patch
 
+import asyncio
+import os
 import pytest
+import threading
 
 
 func_name = "guillotina_amqp.tests.package.task_foobar_yo"
@@ -91,3 +104,134 @@ async def test_call_still_propagates_unexpected_errors_from_create_request(
     ):
         with pytest.raises(RuntimeError):
             await job()
+
+
+async def test_factory_builds_requests_with_the_installed_aiohttp(dummy_request):
+    request = RequestFactory(dummy_request)(
+        request_data["req_data"], asyncio.current_task()
+    )
+    assert request.method == "POST"
+    assert request.path == "/foo"
+    assert request.headers["Authorization"] == "Bearer bar"
+    assert request.scheme == "http"
+    assert request.remote is None
+
+
+async def test_factory_does_not_cache_credentials(dummy_request):
+    factory = RequestFactory(dummy_request)
+    task = asyncio.current_task()
+    for token in ("foo", "bar"):
+        req_data = dict(request_data["req_data"], headers={"Authorization": token})
+        assert factory(req_data, task).headers["Authorization"] == token
+    assert list(factory._messages.keys()) == [("POST", "http://localhost:9090/foo")]
+
+
+async def _run_job(func, args=(1, 2)):
+    data = dict(request_data, func=func, args=list(args))
+    job = Job(None, data, MockChannel(), MockEnvelope("uid"))
+    with patch("guillotina_amqp.job.update_task_running", new_callable=AsyncMock):
+        return await job._Job__run(MagicMock())
+
+
+async def test_plain_functions_run_in_the_thread_pool(dummy_request):
+    result, thread_id = await _run_job("guillotina_amqp.tests.package.task_sync_thread")
+    assert result == 3
+    assert thread_id != threading.get_ident()
+
+
+async def test_process_executor_runs_in_another_process(dummy_request):
+    try:
+        result, pid = await _run_job("guillotina_amqp.tests.package.task_sync_process")
+    finally:
+        shutdown_executors(wait=True)
+    assert result == 3
+    assert pid != os.getpid()
+
+
+def test_executor_is_validated():
+    with pytest.raises(ValueError):
+        task(executor="gpu")(lambda: None)
+    with pytest.raises(ValueError):
+        task(executor="thread")(task_foobar_yo)
+    with pytest.raises(ValueError):
+        object_task(executor="process")(lambda ob: None)
+
+
+async def test_container_layers_are_cached_between_jobs(dummy_request):
+    cache = ContainerCache(size=10, ttl=60)
+    container = MagicMock(id="container", __serial__=1)
+    context = MagicMock()
+    context.async_get = AsyncMock(return_value=container)
+    tm = MagicMock()
+    tm.begin = AsyncMock()
+    tm.get_root = AsyncMock(return_value=context)
+    db = MagicMock()
+    db.get_transaction_manager.return_value = tm
+    root = MagicMock()
+    root.async_get = AsyncMock(return_value=db)
+    annotations = MagicMock()
+    annotations.async_get = AsyncMock(
+        return_value={ACTIVE_LAYERS_KEY: ["guillotina.interfaces.IDefaultLayer"]}
+    )
+
+    async def create_request():
+        data = dict(request_data, container_id="container")
+        job = Job(
+            dummy_request,
+            data,
+            MockChannel(),
+            MockEnvelope("uid"),
+            container_cache=cache,
+        )
+        job.task = MagicMock()
+        with patch("guillotina_amqp.job.get_utility", return_value=root):
+            with patch("guillotina_amqp.job.IAnnotations", return_value=annotations):
+                return await job.create_request()
+
+    assert IDefaultLayer.providedBy(await create_request())
+    assert IDefaultLayer.providedBy(await create_request())
+    assert annotations.async_get.await_count == 1
+
+    # Modified containers are loaded again
+    container.__serial__ = 2
+    assert IDefaultLayer.providedBy(await create_request())
+    assert annotations.async_get.await_count == 2
+
+
+def test_job_resolves_its_function_once():
+    data = dict(request_data, func="guillotina_amqp.tests.package.task_sync_process")
+    job = Job(None, data, MockChannel(), MockEnvelope("uid"))
+    with patch("guillotina_amqp.utils.resolve_dotted_name", side_effect=AssertionError):
+        # Registered by the task decorator: nothing to import
+        assert job.function_name == "guillotina_amqp.tests.package.task_sync_process"
+        assert job.get_executor() == "process"
+
+    job = Job(None, request_data, MockChannel(), MockEnvelope("uid"))
+    with patch(
+        "guillotina_amqp.utils.resolve_dotted_name", wraps=resolve_dotted_name
+    ) as resolve:
+        for _ in range(3):
+            assert job.function_name == func_name
+            job.get_function_to_run()
+    assert resolve.call_count <= 1
+
+
+async def test_streamed_results_are_not_kept_by_the_worker(dummy_request):
+    result = await _run_job(
+        "guillotina_amqp.tests.package.task_stream_results", args=(0, 250)
+    )
+    assert result == {
+        "streamed": True,
+        "count": 250,
+        "tail": list(range(240, 250)),
+    }
+
+    state = TaskState(request_data["task_id"])
+    entries = await state.get_results(count=200)
+    assert [value for _, value in entries] == list(range(200))
+    entries = await state.get_results(after=entries[-1][0])
+    assert [value for _, value in entries] == list(range(200, 250))
+
+    # Running it again replaces the previous results
+    await _run_job("guillotina_amqp.tests.package.task_stream_results", args=(0, 3))
+    assert [value for _, value in await state.get_results()] == [0, 1, 2]
@@ -1,4 +1,10 @@
+from guillotina import app_settings
 from guillotina_amqp.job import Job
+from guillotina_amqp.metrics import AMQP_TASK_COMPLETED
+from guillotina_amqp.metrics import parse_label_policy
+from guillotina_amqp.metrics import reset_label_policies
+from guillotina_amqp.metrics import task_labels
+from guillotina_amqp.metrics import TopLabels
 from guillotina_amqp.tests.mocks import MockChannel
 from guillotina_amqp.tests.mocks import MockEnvelope
 from unittest.mock import MagicMock
@@ -6,6 +12,7 @@ from unittest.mock import MagicMock
 from unittest.mock import AsyncMock
 from unittest.mock import patch
 import pytest
+import threading
 
 
 func_name = "guillotina_amqp.tests.package.task_foobar_yo"
@@ -79,3 +86,71 @@ class TestJobMetrics:
             )
             > 0
         )
+
+
+def test_label_policies():
+    assert parse_label_policy("keep")("foo") == "foo"
+    assert parse_label_policy("drop")("foo") == ""
+    hashed = parse_label_policy("hash:10")
+    assert hashed("foo") == hashed("foo")
+    assert len({hashed(str(value)) for value in range(1000)}) == 10
+    for spec in ("top", "top:0", "hash:foo", "foo"):
+        with pytest.raises(ValueError):
+            parse_label_policy(spec)
+
+
+def test_top_labels_fold_less_frequent_values():
+    top = TopLabels(2)
+    for value in ["a", "b", "c", "c", "c", "a"]:
+        top(value)
+    assert [top(value) for value in ["a", "b", "c"]] == ["a", "other", "c"]
+    # Memory is bounded
+    for value in range(1000):
+        top(str(value))
+    assert len(top._counts) <= 20
+
+
+async def test_task_labels_follow_configured_policies(dummy_request):
+    policies = {"container": "drop", "function": "top:1"}
+    with patch.dict(app_settings["amqp"], {"metrics_labels": policies}):
+        reset_label_policies()
+        try:
+            assert task_labels(container="foo", function="bar", queue="q") == {
+                "container": "",
+                "function": "bar",
+                "queue": "q",
+            }
+            assert task_labels(function="baz") == {"function": "other"}
+        finally:
+            reset_label_policies()
+
+
+def test_top_labels_are_thread_safe():
+    top = TopLabels(5)
+
+    def label():
+        for value in range(2000):
+            top(str(value % 50))
+
+    threads = [threading.Thread(target=label) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sum(top._counts.values()) <= 8000
+    assert len(top._top) == 5
+
+
+async def test_series_of_evicted_labels_are_removed(dummy_request):
+    with patch.dict(app_settings["amqp"], {"metrics_labels": {"function": "top:1"}}):
+        reset_label_policies()
+        try:
+            for function in ["a", "b", "b"]:
+                labels = task_labels(container="c", function=function, queue="q")
+                AMQP_TASK_COMPLETED.labels(status="finished", **labels).inc()
+        finally:
+            reset_label_policies()
+
+    functions = {labels[1] for labels in AMQP_TASK_COMPLETED._metrics}
+    assert "a" not in functions
+    assert {"b", "other"} <= functions
@@ -0,0 +1,130 @@
+from guillotina import app_settings
+from guillotina import task_vars
+from guillotina.utils import get_dotted_name
+from guillotina_amqp import profiling
+from guillotina_amqp.exceptions import ObjectNotFoundException
+from guillotina_amqp.job import Job
+from guillotina_amqp.profiling import claim_execution
+from guillotina_amqp.profiling import get_profile
+from guillotina_amqp.profiling import get_profiled_functions
+from guillotina_amqp.profiling import is_profiled
+from guillotina_amqp.profiling import mark_profiled
+from guillotina_amqp.profiling import measure_memory
+from guillotina_amqp.profiling import profile_key
+from guillotina_amqp.profiling import profile_results_key
+from guillotina_amqp.profiling import refresh_profiled_functions
+from guillotina_amqp.profiling import running_job
+from guillotina_amqp.profiling import sample_memory
+from guillotina_amqp.state import get_state_manager
+from guillotina_amqp.tests.utils import _test_allocate
+from guillotina_amqp.tests.utils import _test_func
+from guillotina_amqp.utils import add_task
+from unittest import mock
+
+import asyncio
+
+
+async def test_profile_next_executions(
+    dummy_request, amqp_worker, configured_state_manager
+):
+    task_vars.request.set(dummy_request)
+    function = get_dotted_name(_test_func)
+    # Left by previous runs
+    await get_state_manager().delete_value(profile_key(function))
+    await get_state_manager().delete_value(profile_results_key(function))
+    await refresh_profiled_functions()
+    assert not is_profiled(function)
+
+    await mark_profiled(function, 2)
+    await refresh_profiled_functions()
+    assert is_profiled(function)
+
+    states = [await add_task(_test_func, 1, 2) for _ in range(3)]
+    # Keep all the calls of the profiles
+    with mock.patch.dict(app_settings["amqp"], {"profile_size": 10000}):
+        for state in states:
+            assert (await state.join(0.1))["result"] == 3
+
+    profile = await get_profile(function)
+    assert profile["remaining"] == 0
+    assert len(profile["executions"]) == 2
+    assert {execution["task_id"] for execution in profile["executions"]} < {
+        state.task_id for state in states
+    }
+    assert any("(_test_func)" in call["call"] for call in profile["calls"])
+    # Workers stop checking functions with no executions left
+    assert not is_profiled(function)
+    task_vars.request.set(None)
+
+
+async def test_sampled_memory_usage(
+    dummy_request, amqp_worker, configured_state_manager, metrics_registry
+):
+    task_vars.request.set(dummy_request)
+    size = 10 * 1024 * 1024
+    with mock.patch.dict(app_settings["amqp"], {"memory_sample_rate": 1}):
+        state = await add_task(_test_allocate, size)
+        data = await state.join(0.1)
+    assert data["result"] == size
+    assert data["memory"]["peak"] >= size
+    assert data["memory"]["net"] < size
+
+    function = get_dotted_name(_test_allocate)
+    assert metrics_registry.get_sample_value(
+        "guillotina_amqp_task_memory_peak_bytes_count", {"function": function}
+    )
+
+    # Not sampled by default
+    state = await add_task(_test_allocate, size)
+    assert "memory" not in await state.join(0.1)
+    task_vars.request.set(None)
+
+
+async def test_memory_is_measured_for_jobs_running_alone(dummy_request):
+    with mock.patch.dict(app_settings["amqp"], {"memory_sample_rate": 1}):
+        with running_job():
+            assert sample_memory()
+            with running_job():
+                assert not sample_memory()
+
+        # A job starting meanwhile spoils the measure
+        with running_job():
+            with measure_memory("foo") as usage:
+                with running_job():
+                    pass
+        assert usage == {}
+
+        with running_job():
+            with measure_memory("foo") as usage:
+                pass
+        assert set(usage) == {"net", "peak"}
+
+
+async def test_jobs_count_as_running_while_building_their_request(dummy_request):
+    job = Job(None, {"task_id": "foo", "func": "foo.bar"}, None, None)
+    running = []
+
+    async def create_request():
+        running.append(profiling._running)
+        raise ObjectNotFoundException()
+
+    with mock.patch.object(job, "create_request", create_request):
+        assert await job() is None
+    assert running == [1]
+    assert profiling._running == 0
+
+
+async def test_functions_without_executions_left_are_unmarked(
+    dummy_request, configured_state_manager
+):
+    await asyncio.gather(mark_profiled("foo", 1), mark_profiled("bar", 1))
+    assert {"foo", "bar"} <= await get_profiled_functions()
+
+    assert await claim_execution("foo")
+    await refresh_profiled_functions()
+    functions = await get_profiled_functions()
+    assert "bar" in functions and "foo" not in functions
+    assert is_profiled("bar") and not is_profiled("foo")
+    for function in ("foo", "bar"):
+        await get_state_manager().delete_value(profile_key(function))
+    await refresh_profiled_functions()
@@ -0,0 +1,93 @@
+"""Redis round trip budgets of the state manager.
+
+Each test resets the recorder right before the operation it measures,
+so setup costs are not counted.
+"""
+
+from guillotina import app_settings
+from guillotina_amqp.state import get_state_manager
+from guillotina_amqp.state import TaskState
+from guillotina_amqp.state import TaskStatus
+from guillotina_amqp.state import update_task_finished
+from guillotina_amqp.state import update_task_running
+from guillotina_amqp.state import update_task_scheduled
+from guillotina_amqp.state import update_tasks_scheduled
+
+import json
+import time
+
+
+async def test_task_lifecycle_round_trips(recording_redis):
+    state_manager = get_state_manager()
+    recording_redis.reset()
+    await update_task_scheduled(state_manager, "foo", eventlog=[])
+    # Read, then write along with the status event
+    assert dict(recording_redis.round_trips) == {
+        "GET": 1,
+        "pipeline:SET+XADD+EXPIRE+PUBLISH": 1,
+    }
+
+    recording_redis.reset()
+    await update_task_running(state_manager, "foo")
+    assert recording_redis.total_round_trips == 2
+
+    recording_redis.reset()
+    await update_task_finished(state_manager, "foo", result={"foo": "bar"})
+    # Plus storing the result
+    assert recording_redis.total_round_trips == 3
+    assert recording_redis.round_trips["pipeline:SET+XADD+EXPIRE+PUBLISH"] == 1
+
+
+async def test_scheduling_many_tasks_round_trips(recording_redis):
+    state_manager = get_state_manager()
+    task_ids = [f"task-{index}" for index in range(50)]
+    recording_redis.reset()
+    await update_tasks_scheduled(state_manager, task_ids)
+    assert dict(recording_redis.round_trips) == {
+        "MGET": 1,
+        "pipeline:SET": 1,
+        "pipeline:XADD+EXPIRE+PUBLISH": 1,
+    }
+
+    states = await TaskState.get_states(task_ids)
+    assert {state["status"] for state in states.values()} == {TaskStatus.SCHEDULED}
+    assert len(await TaskState("task-0").get_eventlog()) == 0
+
+
+async def test_batch_status_lookup_round_trips(recording_redis):
+    state_manager = get_state_manager()
+    task_ids = [f"task-{index}" for index in range(50)]
+    await update_tasks_scheduled(state_manager, task_ids)
+    recording_redis.reset()
+    await TaskState.get_states(task_ids + ["missing"])
+    assert dict(recording_redis.round_trips) == {"MGET": 1}
+
+
+async def test_result_bytes_sent(recording_redis):
+    state_manager = get_state_manager()
+    result = [str(index) for index in range(2000)]
+    await update_task_running(state_manager, "foo")
+    recording_redis.reset()
+    await update_task_finished(state_manager, "foo", result=result)
+    # Compressed above result_compression_threshold
+    compressed = recording_redis.bytes_sent["SET"]
+    assert compressed < len(json.dumps(result)) / 2
+
+    threshold = app_settings["amqp"]["result_compression_threshold"]
+    app_settings["amqp"]["result_compression_threshold"] = None
+    try:
+        recording_redis.reset()
+        await update_task_finished(state_manager, "foo", result=result)
+    finally:
+        app_settings["amqp"]["result_compression_threshold"] = threshold
+    assert recording_redis.bytes_sent["SET"] > len(json.dumps(result))
+    assert (await TaskState("foo").get_result()) == result
+
+
+async def test_injected_latency(recording_redis):
+    state_manager = get_state_manager()
+    recording_redis.latency = 0.05
+    start = time.monotonic()
+    await update_task_running(state_manager, "foo")
+    assert time.monotonic() - start >= 0.1
+    assert (await TaskState("foo").get_status()) == TaskStatus.RUNNING
@@ -1,10 +1,21 @@
+from guillotina import app_settings
+from guillotina_amqp.exceptions import ResultTooLargeException
 from guillotina_amqp.exceptions import TaskAccessUnauthorized
 from guillotina_amqp.exceptions import TaskAlreadyAcquired
+from guillotina_amqp.state import events_channel
+from guillotina_amqp.state import eventlog_key
 from guillotina_amqp.state import get_state_manager
+from guillotina_amqp.state import results_key
+from guillotina_amqp.state import TaskState
+from guillotina_amqp.state import update_task_finished
+from guillotina_amqp.state import update_task_scheduled
+from typing import Dict
+from unittest.mock import patch
 
 import asyncio
-from unittest.mock import patch
+import json
 import pytest
+import time
 
 
 async def clear_cache(sm):
@@ -90,6 +101,21 @@ async def test_release_should_raise_if_task_is_not_yours(
     await clear_cache(state_manager)
 
 
+async def test_release_many_only_releases_own_locks(configured_state_manager, loop):
+    state_manager = get_state_manager(loop)
+    state_manager.worker_id = "another_person"
+    await state_manager.acquire("other", ttl=120)
+    state_manager.worker_id = "me"
+    await state_manager.acquire("t1", ttl=120)
+    await state_manager.acquire("t2", ttl=120)
+
+    assert await state_manager.release_many(["t1", "t2", "other", "missing"]) == 2
+    assert not await state_manager.is_locked("t1")
+    assert not await state_manager.is_locked("t2")
+    assert await state_manager.is_locked("other")
+    await clear_cache(state_manager)
+
+
 async def test_task_state_disappears_after_ttl(redis_state_manager, loop):
     state_manager = get_state_manager(loop)
     await state_manager.update("foo", {"state": "bar"}, ttl=2)
@@ -118,3 +144,191 @@ async def test_connection_reset_errors_are_retried(redis_state_manager, loop):
             await state_manager.get("foo")
 
         assert mocked.called == 4
+
+
+async def test_streams_are_capped_and_paged(configured_state_manager, loop):
+    state_manager = get_state_manager(loop)
+    for idx in range(5):
+        await state_manager.stream_append("stream", {"n": idx}, max_len=3, ttl=60)
+
+    entries = await state_manager.stream_range("stream")
+    # Redis trims approximately
+    assert [v["n"] for _, v in entries][-3:] == [2, 3, 4]
+    first, second = await state_manager.stream_range("stream", count=2)
+    assert [v for _, v in await state_manager.stream_range("stream", after=first[0])][
+        0
+    ] == second[1]
+
+    await state_manager.stream_append("stream", {"n": 5}, reset=True)
+    assert await state_manager.stream_length("stream") == 1
+    await clear_cache(state_manager)
+
+
+async def test_task_events_follow_the_task(configured_state_manager, loop):
+    state_manager = get_state_manager(loop)
+    task_id = "task-events"
+    await update_task_scheduled(state_manager, task_id)
+    await state_manager.stream_append(eventlog_key(task_id), ["date", "started"])
+
+    received = []
+
+    async def follow():
+        async for item in TaskState(task_id).events(keepalive=5):
+            received.append(item)
+
+    follower = asyncio.ensure_future(follow())
+    try:
+        await asyncio.sleep(0.2)
+        assert [(event, value) for _, event, value in received] == [
+            ("status", {"status": "scheduled"}),
+            ("eventlog", ["date", "started"]),
+        ]
+
+        await state_manager.stream_extend(
+            results_key(task_id), [1, 2], channel=events_channel(task_id)
+        )
+        await update_task_finished(state_manager, task_id)
+        # Stops once the task is finished
+        await asyncio.wait_for(follower, 5)
+    finally:
+        follower.cancel()
+    assert sorted(str(value) for _, _, value in received[2:]) == [
+        "1",
+        "2",
+        "{'status': 'finished'}",
+    ]
+
+    # Resume after the first result
+    cursor = [event_id for event_id, _, value in received if value == 1][0]
+    resumed = [item async for item in TaskState(task_id).events(cursor)]
+    assert 2 in [value for _, _, value in resumed]
+    assert 1 not in [value for _, _, value in resumed]
+    await clear_cache(state_manager)
+
+
+offloaded: Dict[str, bytes] = {}
+
+
+async def _offload(task_id, data):
+    offloaded[task_id] = data
+    return f"s3://results/{task_id}"
+
+
+async def test_results_are_stored_apart_from_the_state(configured_state_manager, loop):
+    state_manager = get_state_manager(loop)
+    await update_task_finished(state_manager, "small", result=[1, 2])
+    assert "result" not in await state_manager.get("small")
+    assert await TaskState("small").get_result() == [1, 2]
+    assert (await TaskState("small").join())["result"] == [1, 2]
+
+    big = ["x" * 100] * 100
+    await update_task_finished(state_manager, "big", result=big)
+    state = await state_manager.get("big")
+    assert state["result_info"]["compressed"]
+    assert state["result_info"]["size"] < 1000
+    assert await TaskState("big").get_result() == big
+
+    with patch.dict(app_settings["amqp"], {"result_compression_threshold": None}):
+        with patch.dict(app_settings["amqp"], {"result_max_size": 100}):
+            with pytest.raises(ResultTooLargeException):
+                await update_task_finished(state_manager, "too-big", result=big)
+            assert not await state_manager.get("too-big")
+
+            with patch.dict(
+                app_settings["amqp"],
+                {"result_offload": "guillotina_amqp.tests.test_state._offload"},
+            ):
+                await update_task_finished(state_manager, "offloaded", result=big)
+    assert await TaskState("offloaded").get_result() == "s3://results/offloaded"
+    assert offloaded["offloaded"] == json.dumps(big).encode()
+    await clear_cache(state_manager)
+
+
+async def test_counters_are_incremented_atomically(configured_state_manager, loop):
+    state_manager = get_state_manager(loop)
+    values = await asyncio.gather(
+        *(state_manager.incr_counter("counter", ttl=60) for _ in range(5))
+    )
+    assert sorted(values) == [1, 2, 3, 4, 5]
+    assert await state_manager.get_counter("counter") == 5
+    assert await state_manager.get_counter("missing") == 0
+    await clear_cache(state_manager)
+
+
+async def test_set_if_absent_only_sets_once(configured_state_manager, loop):
+    state_manager = get_state_manager(loop)
+    assert await state_manager.set_if_absent("dedupe", b"first", ttl=60)
+    assert not await state_manager.set_if_absent("dedupe", b"second", ttl=60)
+    assert await state_manager.get_value("dedupe") == b"first"
+
+    await state_manager.delete_value("dedupe")
+    assert await state_manager.set_if_absent("dedupe", b"second", ttl=60)
+    assert await state_manager.get_value("dedupe") == b"second"
+    await clear_cache(state_manager)
+
+
+async def test_values_are_only_deleted_if_they_match(configured_state_manager, loop):
+    state_manager = get_state_manager(loop)
+    await state_manager.set_value("dedupe", b"newer", ttl=60)
+    assert not await state_manager.delete_value_if("dedupe", b"older")
+    assert await state_manager.get_value("dedupe") == b"newer"
+
+    assert await state_manager.delete_value_if("dedupe", b"newer")
+    assert await state_manager.get_value("dedupe") is None
+    await clear_cache(state_manager)
+
+
+async def test_sets_add_and_remove_members(configured_state_manager, loop):
+    state_manager = get_state_manager(loop)
+    await asyncio.gather(
+        state_manager.add_to_set("functions", "foo", ttl=60),
+        state_manager.add_to_set("functions", "bar", ttl=60),
+    )
+    assert await state_manager.set_members("functions") == {"foo", "bar"}
+
+    await state_manager.remove_from_set("functions", ["foo"])
+    assert await state_manager.set_members("functions") == {"bar"}
+    await clear_cache(state_manager)
+
+
+async def test_values_are_replaced_and_popped(configured_state_manager, loop):
+    state_manager = get_state_manager(loop)
+    assert not await state_manager.replace_value("debounce", b"first", ttl=60)
+    await state_manager.set_value("debounce", b"first", ttl=60)
+    assert await state_manager.replace_value("debounce", b"second", ttl=60)
+
+    assert await state_manager.pop_value("debounce") == b"second"
+    assert await state_manager.pop_value("debounce") is None
+    await clear_cache(state_manager)
+
+
+async def test_update_many_keeps_existing_data(configured_state_manager, loop):
+    state_manager = get_state_manager(loop)
+    await state_manager.update("first", {"func": "foo"})
+    await state_manager.update_many(["first", "second"], {"status": "scheduled"})
+
+    assert await state_manager.get("first") == {"func": "foo", "status": "scheduled"}
+    assert await state_manager.get("second") == {"status": "scheduled"}
+    await clear_cache(state_manager)
+
+
+async def test_indexes_are_ranged_by_score(configured_state_manager, loop):
+    state_manager = get_state_manager(loop)
+    now = time.time()
+    await state_manager.add_to_indexes(
+        {"index": {"second": now + 2, "first": now + 1}, "other": {"third": now}},
+        ttl=60,
+    )
+    await state_manager.add_to_indexes({"index": {"third": now + 3}}, ttl=60)
+
+    assert await state_manager.index_range("index") == ["first", "second", "third"]
+    assert await state_manager.index_range("index", max_score=now + 2) == [
+        "first",
+        "second",
+    ]
+    assert await state_manager.index_range("index", offset=1, count=1) == ["second"]
+
+    await state_manager.cancel_many(["first", "third"])
+    assert await state_manager.is_canceled("first")
+    assert not await state_manager.is_canceled("second")
+    await clear_cache(state_manager)
@@ -1,13 +1,21 @@
 from guillotina import app_settings
+from guillotina_amqp.exceptions import DelayTaskException
+from guillotina_amqp.job import Job
 from guillotina_amqp.state import get_state_manager
 from guillotina_amqp.state import TaskStatus
+from guillotina_amqp.tests.mocks import MockAMQPProtocol
 from guillotina_amqp.tests.mocks import MockChannel
 from guillotina_amqp.tests.mocks import MockEnvelope
+from guillotina_amqp.worker import parse_queues
 from guillotina_amqp.worker import Worker
+from unittest.mock import AsyncMock
+from unittest.mock import MagicMock
 from unittest.mock import patch
 
+import asyncio
 import json
 import pytest
+import time
 
 
 async def test_instance_attributes_defaults(dummy_request):
@@ -108,3 +116,237 @@ async def test_worker_acks_already_acquired_tasks(dummy_request, metrics_registr
         )
         == 1.0
     )
+
+
+async def test_delayed_messages_are_published_after_the_delay(dummy_request):
+    worker = Worker()
+    worker.TTL_DELAYED = 60000
+    data = {"task_id": "foo", "func": "foo.bar", "published_at": 0}
+    message = json.loads(worker._delayed_message(data))
+    # Time back in the main queue does not count the delay
+    assert message["published_at"] > time.time() + 59
+    assert data["published_at"] == 0
+
+
+async def test_delayed_tasks_can_shorten_the_delay(dummy_request):
+    channel = MockChannel()
+    data = {"task_id": "foo", "func": "foo.bar", "req_data": {"user": "first"}}
+    task = MagicMock(_job=Job(None, data, channel, MockEnvelope("footag")))
+    exc = DelayTaskException(
+        delay=1.5, data={"req_data": {"user": "last"}}, status=TaskStatus.SCHEDULED
+    )
+    await Worker()._handle_send_to_delay_queue(task, "foo", exc)
+
+    # Waits in a queue of its own, not behind the retries
+    declared = channel.declared[0]["kwargs"]
+    assert declared["queue_name"] == "guillotina-delay-2s"
+    assert declared["arguments"]["x-message-ttl"] == 2000
+    assert declared["arguments"]["x-dead-letter-routing-key"] == "guillotina"
+    published = channel.published[0]
+    assert published["kwargs"]["routing_key"] == "guillotina-delay-2s"
+    message = json.loads(published["args"][0])
+    assert message["req_data"] == {"user": "last"}
+    assert message["published_at"] < time.time() + 3
+    assert (await get_state_manager().get("foo"))["status"] == TaskStatus.SCHEDULED
+    assert len(channel.acked) == 1
+
+    # Without delay left, it goes straight back to the queue
+    exc = DelayTaskException(delay=0, status=TaskStatus.SCHEDULED)
+    await Worker()._handle_send_to_delay_queue(task, "foo", exc)
+    assert channel.published[1]["kwargs"]["routing_key"] == "guillotina"
+    assert len(channel.declared) == 1
+
+
+async def test_messages_only_expire_at_the_head_of_the_queue(loop):
+    protocol = MockAMQPProtocol()
+    channel = await protocol.channel()
+    await channel.queue_declare(
+        "delay",
+        arguments={"x-dead-letter-routing-key": "main", "x-message-ttl": 300},
+    )
+    await channel.publish("retry", routing_key="delay")
+    await channel.publish("short", routing_key="delay", properties={"expiration": "50"})
+    await asyncio.sleep(0.15)
+    assert len(protocol.queues["delay"]) == 2
+
+    await asyncio.sleep(0.25)
+    assert [m["message"] for m in protocol.queues["main"]] == ["retry", "short"]
+
+
+def test_parse_queues():
+    assert parse_queues(None) == []
+
+    queues = parse_queues("default:3, reindex")
+    assert [(q.name, q.weight) for q in queues] == [("default", 3), ("reindex", 1)]
+
+    queues = parse_queues({"default": 2, "reindex": {"weight": 1, "prefetch": 4}})
+    assert [(q.name, q.weight, q.prefetch) for q in queues] == [
+        ("default", 2, None),
+        ("reindex", 1, 4),
+    ]
+
+    with pytest.raises(ValueError):
+        parse_queues("default:0")
+
+
+async def test_worker_consumes_the_configured_queue_by_default(dummy_request):
+    worker = Worker()
+    assert list(worker.queues) == ["guillotina"]
+    assert worker.QUEUE_DELAYED == "guillotina-delay"
+    assert worker.queues["guillotina"].concurrency == worker._max_running
+    assert worker.queues["guillotina"].connection == "default"
+
+
+async def test_worker_splits_concurrency_by_queue_weight(dummy_request):
+    worker = Worker(max_size=10, queues="default:3,reindex:1,other:1")
+    assert worker.QUEUE_MAIN == "default"
+    assert worker.QUEUE_ERRORED == "default-error"
+    assert {name: q.concurrency for name, q in worker.queues.items()} == {
+        "default": 6,
+        "reindex": 2,
+        "other": 2,
+    }
+    assert worker.queues["default"].connection == "default"
+    assert worker.queues["reindex"].connection == "consumer:reindex"
+
+
+async def test_worker_subscribes_again_when_a_queue_connection_closes(
+    dummy_request,
+):
+    worker = Worker(queues="default,reindex", check_activity=False)
+    await worker.start()
+    connections = app_settings["amqp"]["connections"]
+    try:
+        lost = connections["consumer:reindex"]["protocol"]
+        await lost.close()
+        await asyncio.sleep(0.2)
+
+        protocol = connections["consumer:reindex"]["protocol"]
+        assert protocol is not lost
+        assert len(protocol.channels[0].consumers) == 1
+        assert worker.queues["reindex"].consumer_tag is not None
+    finally:
+        worker.cancel()
+        for connection in list(connections.values()):
+            await connection["protocol"].close()
+        app_settings["amqp"]["connections"] = {}
+
+
+class _RunningTask:
+    def __init__(self, queue):
+        self._job = MagicMock(queue=queue)
+
+
+async def test_worker_lends_spare_capacity_between_queues(dummy_request):
+    worker = Worker(max_size=4, queues="default,reindex")
+    default, reindex = worker.queues["default"], worker.queues["reindex"]
+
+    # default uses its own share, and borrows the idle share of reindex
+    worker._running = [_RunningTask("default"), _RunningTask("default")]
+    assert worker.can_admit(default)
+    worker._running.append(_RunningTask("default"))
+    assert worker.can_admit(default)
+
+    # reindex has messages waiting for its share: nothing else is lent
+    reindex.waiting = 1
+    assert not worker.can_admit(default)
+    assert worker.can_admit(reindex)
+
+    # the worker never runs more than max_size tasks
+    worker._running.append(_RunningTask("default"))
+    assert not worker.can_admit(reindex)
+
+
+async def test_worker_delays_already_acquired_tasks_through_their_queue(
+    dummy_request,
+):
+    task_data = json.dumps({"task_id": "foo", "func": "foo.bar"})
+    state_manager = get_state_manager()
+    await state_manager.acquire("foo", 900)
+
+    channel = MockChannel()
+    worker = Worker(queues="default,reindex")
+    await worker.handle_queued_job(
+        channel, task_data, MockEnvelope("footag"), None, queue="reindex"
+    )
+
+    assert len(channel.published) == 1
+    assert channel.published[0]["kwargs"]["routing_key"] == "reindex-delay"
+    assert len(channel.acked) == 1
+
+
+async def test_worker_drain_requeues_tasks_running_after_timeout(dummy_request):
+    state_manager = get_state_manager()
+    await state_manager.acquire("slow", 900)
+
+    channel = MockChannel()
+    amqp_channel = MagicMock(basic_cancel=AsyncMock())
+    worker = Worker(max_size=2)
+    worker.queues[worker.QUEUE_MAIN].consumer_tag = "ctag"
+    task = asyncio.ensure_future(asyncio.sleep(10))
+    task._job = MagicMock(
+        data={"task_id": "slow"}, channel=channel, envelope=MockEnvelope("slowtag")
+    )
+    worker._running.append(task)
+
+    with patch(
+        "guillotina_amqp.amqp.get_connection",
+        new_callable=AsyncMock,
+        return_value=(amqp_channel, None, None),
+    ):
+        await worker.drain(timeout=0.2)
+
+    amqp_channel.basic_cancel.assert_awaited_once_with("ctag")
+    assert task.cancelled()
+    assert worker.num_running == 0
+    assert channel.nacked == [
+        {
+            "args": (),
+            "kwargs": {"delivery_tag": "slowtag", "multiple": False, "requeue": True},
+        }
+    ]
+    assert (await state_manager.get("slow"))["status"] == TaskStatus.SCHEDULED
+    assert not await state_manager.is_locked("slow")
+
+
+async def test_draining_worker_requeues_new_deliveries(dummy_request):
+    channel = MockChannel()
+    worker = Worker()
+    worker._draining = True
+    task_data = json.dumps({"task_id": "foo", "func": "foo.bar"})
+    await worker.handle_queued_job(channel, task_data, MockEnvelope("footag"), None)
+
+    assert channel.nacked[0]["kwargs"]["requeue"] is True
+    assert worker.num_running == 0
+
+
+async def test_worker_fails_fast_on_unknown_functions(dummy_request):
+    task_data = json.dumps(
+        {"task_id": "foo", "func": "guillotina_amqp.tests.package.missing"}
+    )
+    channel = MockChannel()
+    worker = Worker()
+    await worker.handle_queued_job(channel, task_data, MockEnvelope("footag"), None)
+
+    assert worker.num_running == 0
+    assert channel.nacked[0]["kwargs"]["requeue"] is False
+    state = await get_state_manager().get("foo")
+    assert state["status"] == TaskStatus.ERRORED
+    assert "missing" in state["error"]
+    assert not await get_state_manager().is_locked("foo")
+
+
+async def test_worker_errors_tasks_whose_result_is_too_big(dummy_request):
+    channel = MockChannel()
+    data = {"task_id": "foo", "func": "guillotina_amqp.tests.utils._test_func"}
+    job = Job(None, data, channel, MockEnvelope("footag"))
+    task = MagicMock(_job=job)
+    task.result.return_value = "x" * 1000
+    with patch.dict(app_settings["amqp"], {"result_max_size": 100}):
+        await Worker()._handle_successful(task)
+
+    assert len(channel.acked) == 1
+    state = await get_state_manager().get("foo")
+    assert state["status"] == TaskStatus.ERRORED
+    assert "result_max_size" in state["error"]
+    assert "result_info" not in state
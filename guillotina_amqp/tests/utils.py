@@ -59,3 +59,24 @@ async def _decorator_test_func_custom_queue(one, two):
 @object_task(dest_queue="custom-queue")
 async def _object_task_custom_queue(one, two):
     return one + two
+
+
+@task
+async def _test_sum(values, extra=0):
+    return sum(values) + extra
+
+
+@task
+def _test_square(value):
+    return value * value
+
+
+@object_task(debounce=0.2)
+async def _debounced_object_task(ob, value):
+    return value
+
+
+async def _test_allocate(size):
+    data = bytearray(size)
+    await asyncio.sleep(0)
+    return len(data)
@@ -1,5 +1,7 @@
 from .metrics import AMQP_TASK_DISPATCHED
+from .metrics import task_labels
 from .metrics import watch_amqp
+from functools import partial
 from guillotina import app_settings
 from guillotina import glogging
 from guillotina import task_vars
@@ -13,12 +15,23 @@ from guillotina.utils import navigate_to
 from guillotina.utils import resolve_dotted_name
 from guillotina.utils.misc import get_current_container
 from guillotina_amqp import amqp
+from guillotina_amqp import task_vars as amqp_task_vars
 from guillotina_amqp.exceptions import AMQPConfigurationNotFoundError
+from guillotina_amqp.exceptions import DelayTaskException
 from guillotina_amqp.exceptions import ObjectNotFoundException
+from guillotina_amqp.executors import map_in_executor
+from guillotina_amqp.executors import run_in_executor
+from guillotina_amqp.executors import THREAD
 from guillotina_amqp.interfaces import ITaskDefinition
+from guillotina_amqp.state import DONE_STATUSES
 from guillotina_amqp.state import get_state_manager
+from guillotina_amqp.state import task_index_key
 from guillotina_amqp.state import TaskState
-from guillotina_amqp.state import update_task_scheduled
+from guillotina_amqp.state import TaskStatus
+from guillotina_amqp.state import update_task_status
+from guillotina_amqp.state import update_tasks_scheduled
+from typing import Any
+from typing import Dict
 
 import aioamqp
 import asyncio
@@ -30,13 +43,38 @@ import uuid
 
 logger = glogging.getLogger("guillotina_amqp.utils")
 
-_OBJECT_TASK_WRAPPERS = frozenset(
+# Functions that run the task named by their first argument
+OBJECT_TASK_WRAPPERS = frozenset(
     {
         "guillotina_amqp.utils._run_object_task",
         "guillotina_amqp.utils._yield_object_task",
+        "guillotina_amqp.utils._run_chunk",
+        "guillotina_amqp.utils._run_object_chunk",
+        "guillotina_amqp.utils._run_debounced_object_task",
     }
 )
 
+# Task targets by dotted name: task definitions register themselves,
+# anything else is imported the first time it is used.
+_tasks: Dict[str, Any] = {}
+
+
+def register_task(target, dotted_name):
+    _tasks[dotted_name] = target
+
+
+def resolve_task(dotted_name):
+    """Returns the task target for dotted_name. Raises ImportError or
+    AttributeError if it does not exist.
+    """
+    try:
+        return _tasks[dotted_name]
+    except KeyError:
+        pass
+    target = resolve_dotted_name(dotted_name)
+    _tasks[dotted_name] = target
+    return target
+
 
 async def cancel_task(task_id):
     """It cancels a task by id. Returns wether it could be cancelled."""
@@ -45,6 +83,39 @@ async def cancel_task(task_id):
     return success
 
 
+async def cancel_tasks(function=None, status=None, created_before=None, batch_size=500):
+    """Cancels the tasks of the current container matching all the
+    filters: the function they run, their status (scheduled, running,
+    errored or sleeping) and scheduled before a timestamp. Tasks are found through the index
+    of the container, and canceled in batches of batch_size. Returns how
+    many were canceled.
+    """
+    db = task_vars.db.get()
+    container = task_vars.container.get()
+    key = task_index_key(db.id, container.id, function)
+    state_manager = get_state_manager()
+    canceled = 0
+    offset = 0
+    while True:
+        task_ids = await state_manager.index_range(
+            key, max_score=created_before, offset=offset, count=batch_size
+        )
+        if not task_ids:
+            return canceled
+        offset += len(task_ids)
+        states = await state_manager.get_many(task_ids)
+        matching = [
+            task_id
+            for task_id, state in zip(task_ids, states)
+            if state
+            and state.get("status") not in DONE_STATUSES
+            and (status is None or state.get("status") == status)
+        ]
+        if matching:
+            await state_manager.cancel_many(matching)
+            canceled += len(matching)
+
+
 def get_task_id_prefix():
     db = task_vars.db.get()
     container = task_vars.container.get()
@@ -58,21 +129,16 @@ def generate_task_id():
     return str(uuid.uuid4())
 
 
-async def add_task(
-    func, *args, _request=None, _retries=3, _task_id=None, dest_queue=None, **kwargs
-):
-    """Given a function and its arguments, it adds it as a task to be ran
-    by workers.
-    """
-    # Get the request and prepare request data
-    if _request is None:
-        _request = get_current_request()
+def get_request_data(request=None):
+    """Request data jobs are run with"""
+    if request is None:
+        request = get_current_request()
 
     req_data = {
-        "url": str(_request.url),
-        "headers": dict(_request.headers),
-        "method": _request.method,
-        "annotations": getattr(_request, "annotations", {}),
+        "url": str(request.url),
+        "headers": dict(request.headers),
+        "method": request.method,
+        "annotations": getattr(request, "annotations", {}),
     }
     user = get_authenticated_user()
     if user is not None:
@@ -83,7 +149,7 @@ async def add_task(
                     name for name, setting in user.roles.items() if setting == Allow
                 ],
                 "groups": user.groups,
-                "headers": dict(_request.headers),
+                "headers": dict(request.headers),
                 "data": getattr(user, "data", {}),
             }
         except AttributeError:
@@ -91,76 +157,192 @@ async def add_task(
 
     container = task_vars.container.get()
     if container is not None:
-        req_data["container_url"] = IAbsoluteURL(container, _request)()
+        req_data["container_url"] = IAbsoluteURL(container, request)()
+    return req_data
+
 
-    if _task_id is None:
+def build_task_data(func, args, kwargs, req_data, task_id=None):
+    """Data of the job running func in the current container"""
+    if task_id is None:
         task_id = generate_task_id()
-    else:
-        task_id = _task_id
+    db = task_vars.db.get()
+    container = task_vars.container.get()
+    return {
+        "func": get_dotted_name(func),
+        "args": args,
+        "kwargs": kwargs,
+        "db_id": getattr(db, "id", None),
+        "container_id": getattr(container, "id", None),
+        "req_data": req_data,
+        "task_id": task_id,
+    }
+
 
-    dotted_name = get_dotted_name(func)
+async def add_task(
+    func,
+    *args,
+    _request=None,
+    _retries=3,
+    _task_id=None,
+    _canvas=None,
+    dest_queue=None,
+    dedupe_key=None,
+    dedupe_window=None,
+    **kwargs,
+):
+    """Given a function and its arguments, it adds it as a task to be ran
+    by workers.
 
+    Tasks scheduled with the same dedupe_key in the same container are
+    only published once until the first one starts running, or for
+    dedupe_window seconds at most. Duplicates get the state of the
+    first one.
+    """
+    data = build_task_data(func, args, kwargs, get_request_data(_request), _task_id)
+    if _canvas is not None:
+        # What to schedule once the task finishes, see canvas.py
+        data["canvas"] = _canvas
+    if dedupe_key is None:
+        return await publish_task_data(data, dest_queue=dest_queue, _retries=_retries)
+
+    task_id = data["task_id"]
+    key = f"dedupe:{data['db_id']}-{data['container_id']}:{dedupe_key}"
+    if dedupe_window is None:
+        dedupe_window = app_settings["amqp"].get("dedupe_window", 60)
+    state_manager = get_state_manager()
+    if not await state_manager.set_if_absent(
+        key, task_id.encode("utf8"), ttl=dedupe_window
+    ):
+        existing = await state_manager.get_value(key)
+        if existing is not None:
+            logger.info(f"Skipping duplicate of task {existing}: {dedupe_key}")
+            return TaskState(existing.decode("utf8"))
+    data["dedupe_key"] = key
+    try:
+        state = await publish_task_data(data, dest_queue=dest_queue, _retries=_retries)
+    except Exception:
+        await state_manager.delete_value(key)
+        raise
+    if state is None:
+        await state_manager.delete_value(key)
+    return state
+
+
+def get_task_function(data):
+    """Name of the function the job runs, the object task for wrappers"""
+    if data["func"] in OBJECT_TASK_WRAPPERS and data["args"]:
+        return str(data["args"][0])
+    return data["func"]
+
+
+async def publish_task_data(data, dest_queue=None, _retries=3):
+    """Publishes the data of a job and marks the task as scheduled.
+    Workers use it to schedule tasks with the request data of the job
+    they run.
+    """
+    states = await publish_tasks_data([(data, dest_queue)], _retries=_retries)
+    return states[0] if states else None
+
+
+async def publish_tasks_data(jobs, _retries=3):
+    """Publishes the data of many jobs, as (data, dest_queue) pairs, on
+    the same channel, and marks their tasks as scheduled with a round
+    trip per batch. Returns their states.
+
+    Tasks are marked as scheduled before they are published, so workers
+    never find them without state, nor have their status overwritten.
+    Tasks that could not be published are marked as errored.
+    """
+    try:
+        await amqp.get_connection()
+    except AMQPConfigurationNotFoundError:
+        dotted_names = ", ".join(data["func"] for data, _ in jobs)
+        logger.warning(
+            f"Could not schedule {dotted_names}, AMQP settings not configured"
+        )
+        return []
+
+    # Update tasks's global state
+    state_manager = get_state_manager()
+    task_ids = [data["task_id"] for data, _ in jobs]
+    now = time.time()
+    await update_tasks_scheduled(state_manager, task_ids, updated=now)
+    await index_tasks(state_manager, [data for data, _ in jobs], now)
+
+    published = 0
     retries = 0
-    while True:
-        # Get the rabbitmq connection
-        try:
+    try:
+        while published < len(jobs):
+            # Get the rabbitmq connection
             channel, transport, protocol = await amqp.get_connection()
-        except AMQPConfigurationNotFoundError:
-            logger.warning(
-                f"Could not schedule {dotted_name}, AMQP settings not configured"
+            try:
+                for data, dest_queue in jobs[published:]:
+                    await _publish(channel, data, dest_queue)
+                    published += 1
+            except (aioamqp.AmqpClosedConnection, aioamqp.exceptions.ChannelClosed):
+                # Only the ones not published yet are retried
+                await amqp.remove_connection()
+                if retries >= _retries:
+                    raise
+                retries += 1
+    except Exception as exc:
+        for task_id in task_ids[published:]:
+            await update_task_status(
+                state_manager,
+                task_id,
+                TaskStatus.ERRORED,
+                error=f"Could not publish the task: {exc!r}",
             )
-            return
-        try:
-            state = TaskState(task_id)
-            db = task_vars.db.get()
-            logger.info(f"Scheduling task: {task_id}: {dotted_name}")
-            data = json.dumps(
-                {
-                    "func": dotted_name,
-                    "args": args,
-                    "kwargs": kwargs,
-                    "db_id": getattr(db, "id", None),
-                    "container_id": getattr(container, "id", None),
-                    "req_data": req_data,
-                    "task_id": task_id,
-                }
+        raise
+
+    for data, _ in jobs:
+        logger.info(f"Scheduled task: {data['task_id']}: {data['func']}")
+    return [TaskState(task_id) for task_id in task_ids]
+
+
+async def index_tasks(state_manager, jobs_data, score):
+    """Indexes tasks by container and function, for cancel_tasks"""
+    indexes: Dict[str, Dict[str, float]] = {}
+    for data in jobs_data:
+        if data.get("container_id") is None:
+            continue
+        for function in (None, get_task_function(data)):
+            key = task_index_key(data["db_id"], data["container_id"], function)
+            indexes.setdefault(key, {})[data["task_id"]] = score
+    if indexes:
+        await state_manager.add_to_indexes(
+            indexes, ttl=int(app_settings["amqp"]["state_ttl"])
+        )
+
+
+async def _publish(channel, data, dest_queue):
+    task_id = data["task_id"]
+    dotted_name = data["func"]
+    logger.info(f"Scheduling task: {task_id}: {dotted_name}")
+
+    # Publish task data on rabbitmq
+    dest_queue = app_settings["amqp"]["queue"] if dest_queue is None else dest_queue
+
+    # Workers measure the time tasks wait in the queue from it
+    data["published_at"] = time.time()
+    with watch_amqp("publish"):
+        await channel.publish(
+            json.dumps(data),
+            exchange_name=app_settings["amqp"]["exchange"],
+            routing_key=dest_queue,
+            properties={"delivery_mode": 2},
+        )
+
+    # per-container dispatch metric
+    if AMQP_TASK_DISPATCHED is not None:
+        _container_id = data.get("container_id") or "unknown"
+        AMQP_TASK_DISPATCHED.labels(
+            **task_labels(
+                container=_container_id,
+                function=get_task_function(data),
+                queue=dest_queue,
             )
-
-            # Publish task data on rabbitmq
-            dest_queue = (
-                app_settings["amqp"]["queue"] if dest_queue is None else dest_queue
-            )
-
-            with watch_amqp("publish"):
-                await channel.publish(
-                    data,
-                    exchange_name=app_settings["amqp"]["exchange"],
-                    routing_key=dest_queue,
-                    properties={"delivery_mode": 2},
-                )
-
-            # per-container dispatch metric
-            if AMQP_TASK_DISPATCHED is not None:
-                _container_id = getattr(container, "id", None) or "unknown"
-                _func_name = dotted_name
-                if dotted_name in _OBJECT_TASK_WRAPPERS and args:
-                    _func_name = str(args[0])
-                AMQP_TASK_DISPATCHED.labels(
-                    container=_container_id,
-                    function=_func_name,
-                    queue=dest_queue,
-                ).inc()
-
-            # Update tasks's global state
-            state_manager = get_state_manager()
-            await update_task_scheduled(state_manager, task_id, updated=time.time())
-            logger.info(f"Scheduled task: {task_id}: {dotted_name}")
-            return state
-        except (aioamqp.AmqpClosedConnection, aioamqp.exceptions.ChannelClosed):
-            await amqp.remove_connection()
-            if retries >= _retries:
-                raise
-            retries += 1
+        ).inc()
 
 
 async def _prepare_func(dotted_func, path, *args, **kwargs):
@@ -170,7 +352,7 @@ async def _prepare_func(dotted_func, path, *args, **kwargs):
     except KeyError:
         logger.warning(f"Object in {path} not found")
         raise ObjectNotFoundException
-    func = resolve_dotted_name(dotted_func)
+    func = resolve_task(dotted_func)
     if ITaskDefinition.providedBy(func):
         func = func.func
     return ob, func
@@ -178,6 +360,12 @@ async def _prepare_func(dotted_func, path, *args, **kwargs):
 
 async def _run_object_task(dotted_func, path, *args, **kwargs):
     ob, func = await _prepare_func(dotted_func, path, *args, **kwargs)
+    if not asyncio.iscoroutinefunction(func):
+        # Plain functions run in the thread pool
+        result = await run_in_executor(THREAD, func, (ob,) + args, kwargs)
+        if inspect.isawaitable(result):
+            result = await result
+        return result
     return await func(ob, *args, **kwargs)
 
 
@@ -187,17 +375,132 @@ async def _yield_object_task(dotted_func, path, *args, **kwargs):
         yield res
 
 
-async def add_object_task(
-    callable=None, ob=None, *args, _request=None, _retries=3, dest_queue=None, **kwargs
+async def _run_chunk(dotted_func, items):
+    """Runs the task once per item of a chunk of TaskDefinition.map"""
+    target = resolve_task(dotted_func)
+    func = target.func if ITaskDefinition.providedBy(target) else target
+    if asyncio.iscoroutinefunction(func):
+        return [await func(item) for item in items]
+    executor = getattr(target, "executor", None) or THREAD
+    return await map_in_executor(executor, func, items, dotted_name=dotted_func)
+
+
+async def _run_object_chunk(dotted_func, path, items):
+    ob, func = await _prepare_func(dotted_func, path)
+    if asyncio.iscoroutinefunction(func):
+        return [await func(ob, item) for item in items]
+    return await map_in_executor(THREAD, partial(func, ob), items)
+
+
+def debounce_key(dotted_func, path):
+    db = task_vars.db.get()
+    container = task_vars.container.get()
+    return "debounce:{}-{}:{}:{}".format(
+        getattr(db, "id", None), getattr(container, "id", None), dotted_func, path
+    )
+
+
+async def _run_debounced_object_task(dotted_func, path, key, debounce):
+    """Runs the task once it was not scheduled again for debounce
+    seconds, with the arguments and the request it was scheduled with
+    last. Until then, the job goes back through the delay queue, so it
+    does not hold a worker slot while it waits.
+    """
+    state_manager = get_state_manager()
+    data = await state_manager.get_value(key)
+    if data is None:
+        logger.warning(f"Debounced task {dotted_func} for {path} not found")
+        return None
+    value = json.loads(data)
+    wait = value["updated"] + debounce - time.time()
+    job = amqp_task_vars.amqp_job.get()
+    req_data = value.get("req_data")
+    if job is not None and req_data is not None:
+        # Runs with the request of the last caller
+        stale = job.data.get("req_data") != req_data
+    else:
+        stale = False
+    if wait > 0 or stale:
+        raise DelayTaskException(
+            delay=max(wait, 0),
+            data={"req_data": req_data} if stale else None,
+            status=TaskStatus.SCHEDULED,
+        )
+    # Tasks scheduled from now on are published again
+    data = await state_manager.pop_value(key)
+    if data is None:
+        return None
+    data = json.loads(data)
+    return await _run_object_task(dotted_func, path, *data["args"], **data["kwargs"])
+
+
+async def add_debounced_object_task(
+    callable, ob, *args, _debounce, _request=None, _retries=3, dest_queue=None, **kwargs
 ):
+    """Schedules an object task unless it is already scheduled for the
+    same object, in which case its arguments and request are replaced.
+    The task runs once it was not scheduled again for _debounce seconds.
+    """
+    dotted_func = get_dotted_name(callable)
+    path = get_content_path(ob)
+    key = debounce_key(dotted_func, path)
+    ttl = int(app_settings["amqp"]["state_ttl"])
+    state_manager = get_state_manager()
+    req_data = get_request_data(_request)
+    while True:
+        task_id = generate_task_id()
+        value = {
+            "task_id": task_id,
+            "args": args,
+            "kwargs": kwargs,
+            "req_data": req_data,
+            "updated": time.time(),
+        }
+        if await state_manager.set_if_absent(key, json.dumps(value).encode(), ttl):
+            break
+        existing = await state_manager.get_value(key)
+        if existing is None:
+            # It started running meanwhile
+            continue
+        value["task_id"] = json.loads(existing)["task_id"]
+        if await state_manager.replace_value(key, json.dumps(value).encode(), ttl):
+            return TaskState(value["task_id"])
+
+    try:
+        state = await add_task(
+            _run_debounced_object_task,
+            dotted_func,
+            path,
+            key,
+            _debounce,
+            _request=_request,
+            _retries=_retries,
+            _task_id=task_id,
+            dest_queue=dest_queue,
+        )
+    except Exception:
+        await state_manager.delete_value(key)
+        raise
+    if state is None:
+        await state_manager.delete_value(key)
+    return state
+
+
+def get_object_task_call(callable, ob, args):
+    """Function and arguments the job of an object task runs"""
     superfunc = _run_object_task
     if inspect.isasyncgenfunction(callable):
         # async generators need to be yielded from
         superfunc = _yield_object_task
+    return superfunc, (get_dotted_name(callable), get_content_path(ob)) + args
+
+
+async def add_object_task(
+    callable=None, ob=None, *args, _request=None, _retries=3, dest_queue=None, **kwargs
+):
+    superfunc, args = get_object_task_call(callable, ob, args)
     return await add_task(
         superfunc,
-        get_dotted_name(callable),
-        get_content_path(ob),
         *args,
         _request=_request,
         _retries=_retries,
@@ -206,6 +509,66 @@ async def add_object_task(
     )
 
 
+class TaskBatch:
+    """Tasks scheduled during a transaction, published together when
+    it commits. Tasks scheduled several times with the same arguments
+    are only published once.
+    """
+
+    def __init__(self, request=None):
+        self.request = request
+        self.published = False
+        # key -> (func, args, kwargs, dest_queue, retries)
+        self._tasks: Dict[Any, Any] = {}
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def add(self, func, args, kwargs, dest_queue=None, retries=3):
+        try:
+            key = json.dumps(
+                [get_dotted_name(func), args, kwargs, dest_queue], sort_keys=True
+            )
+        except TypeError:
+            # Fails when published, as it would without the batch
+            key = object()
+        if key not in self._tasks:
+            self._tasks[key] = (func, args, kwargs, dest_queue, retries)
+
+    async def publish(self, status=True):
+        """Publishes the tasks if the transaction committed (commit hooks
+        get whether it did). Returns their states.
+        """
+        self.published = True
+        tasks, self._tasks = list(self._tasks.values()), {}
+        if not status or not tasks:
+            return []
+        # Request data is the same for all of them
+        req_data = get_request_data(self.request)
+        jobs = [
+            (build_task_data(func, args, kwargs, req_data), dest_queue)
+            for func, args, kwargs, dest_queue, _ in tasks
+        ]
+        retries = max(retries for *_, retries in tasks)
+        return await publish_tasks_data(jobs, _retries=retries)
+
+
+def get_task_batch(txn, before_commit=False, request=None):
+    """Batch of the tasks scheduled after (or before) txn commits. It is
+    registered as a commit hook the first time.
+    """
+    name = "_amqp_before_commit_batch" if before_commit else "_amqp_after_commit_batch"
+    batch = getattr(txn, name, None)
+    if batch is None or batch.published:
+        batch = TaskBatch(request)
+        setattr(txn, name, batch)
+        if before_commit:
+            txn.add_before_commit_hook(batch.publish)
+        else:
+            txn.add_after_commit_hook(batch.publish)
+    return batch
+
+
 class TimeoutLock(object):
     """Implements a Lock that can be acquired for"""
 
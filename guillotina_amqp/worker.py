@@ -1,13 +1,25 @@
 from .metrics import AMQP_TASK_COMPLETED
 from .metrics import AMQP_TASK_DURATION
+from .metrics import label_value
+from .metrics import task_labels
+from .metrics import track_label
 from .metrics import watch_amqp
 from guillotina import app_settings
 from guillotina import glogging
 from guillotina_amqp import amqp
+from guillotina_amqp.canvas import on_task_failed
+from guillotina_amqp.canvas import on_task_finished
 from guillotina_amqp.exceptions import DelayTaskException
+from guillotina_amqp.exceptions import ResultTooLargeException
 from guillotina_amqp.exceptions import TaskNotFoundException
+from guillotina_amqp.executors import configure_executors
+from guillotina_amqp.executors import shutdown_executors
 from guillotina_amqp.interfaces import IStateManagerUtility
+from guillotina_amqp.job import ContainerCache
 from guillotina_amqp.job import Job
+from guillotina_amqp.job import RequestFactory
+from guillotina_amqp.job import Timeline
+from guillotina_amqp.profiling import refresh_profiled_functions
 from guillotina_amqp.state import get_state_manager
 from guillotina_amqp.state import TaskState
 from guillotina_amqp.state import TaskStatus
@@ -16,11 +28,16 @@ from guillotina_amqp.state import update_task_errored
 from guillotina_amqp.state import update_task_finished
 from guillotina_amqp.state import update_task_scheduled
 from guillotina_amqp.state import update_task_status
+from collections import Counter
+from functools import partial
+from typing import Dict
 from typing import List
+from typing import Optional
 
 import asyncio
 import guillotina_amqp
 import json
+import math
 import os
 import time
 
@@ -34,19 +51,115 @@ try:
         labelnames=["type", "status"],
     )
 
+    track_label("function", OPS, "type")
+
     def record_op_metric(type: str, status: str) -> None:
-        OPS.labels(type=type, status=status).inc()
+        OPS.labels(type=label_value("function", type), status=status).inc()
+
+    DRAINING = prometheus_client.Gauge(
+        "guillotina_amqp_worker_draining_tasks",
+        "Tasks still running while the worker drains",
+    )
+    DRAINED = prometheus_client.Counter(
+        "guillotina_amqp_worker_drained_tasks_total",
+        "Tasks running when the worker started draining, by outcome",
+        labelnames=["outcome"],
+    )
+
+    def record_drain_metric(
+        running: int, outcome: Optional[str] = None, count: int = 0
+    ) -> None:
+        DRAINING.set(running)
+        if outcome is not None and count:
+            DRAINED.labels(outcome=outcome).inc(count)
 
 except ImportError:
 
     def record_op_metric(type: str, status: str) -> None: ...
 
+    def record_drain_metric(
+        running: int, outcome: Optional[str] = None, count: int = 0
+    ) -> None: ...
+
 
 logger = glogging.getLogger("guillotina_amqp.worker")
 default_delayed = 1000 * 60 * 2  # 2 minutes
 default_errored = 1000 * 60 * 60 * 24 * 7 * 1  # 1 week
 
 
+class WorkerQueue:
+    """A queue consumed by the worker, together with its own delay and
+    error queues and its share of the worker running tasks.
+    """
+
+    def __init__(self, name, weight=1, prefetch=None):
+        if weight < 1:
+            raise ValueError(f"Queue {name} must have a positive weight")
+        self.name = name
+        self.weight = weight
+        self.prefetch = prefetch
+        self.errored = name + "-error"
+        self.delayed = name + "-delay"
+        # Assigned by the worker
+        self.concurrency = 1
+        self.connection = "default"
+        # Number of messages waiting for a free slot
+        self.waiting = 0
+        # Number of admitted messages whose task is not created yet
+        self.starting = 0
+        # Set once the worker subscribes to the queue
+        self.consumer_tag = None
+
+    def delayed_for(self, seconds):
+        """Delay queue of messages waiting exactly seconds"""
+        return f"{self.delayed}-{seconds}s"
+
+    def __repr__(self):
+        return f"<WorkerQueue {self.name} weight={self.weight}>"
+
+
+def _is_waiting(task):
+    """Whether the job only went back to wait to be scheduled, like
+    debounced tasks do, without running
+    """
+    if task.cancelled():
+        return False
+    exc = task.exception()
+    return isinstance(exc, DelayTaskException) and exc.status == TaskStatus.SCHEDULED
+
+
+def parse_queues(value) -> List[WorkerQueue]:
+    """Parses the queues a worker consumes from.
+
+    `value` can be a comma separated string or a list of `name[:weight]`
+    entries, or a mapping of queue names to either a weight or a dict
+    with `weight` and `prefetch` keys.
+    """
+    if not value:
+        return []
+    queues = []
+    if isinstance(value, dict):
+        for name, options in value.items():
+            if not isinstance(options, dict):
+                options = {"weight": options}
+            prefetch = options.get("prefetch")
+            queues.append(
+                WorkerQueue(
+                    name,
+                    weight=int(options.get("weight", 1)),
+                    prefetch=None if prefetch is None else int(prefetch),
+                )
+            )
+        return queues
+    if isinstance(value, str):
+        value = value.split(",")
+    for entry in value:
+        name, _, weight = entry.strip().partition(":")
+        if name:
+            queues.append(WorkerQueue(name, weight=int(weight or 1)))
+    return queues
+
+
 class Worker:
     """Workers hold an asyncio loop in which will run several tasks. It
     reads from RabbitMQ for new job descriptions and will run them in
@@ -62,8 +175,11 @@ class Worker:
     update_status_interval = 30
     total_run = 0
     total_errored = 0
+    drain_log_interval = 5
     _status_task = None
     _activity_task = None
+    _draining = False
+    _request_factory = None
 
     def __init__(
         self,
@@ -72,6 +188,9 @@ class Worker:
         max_size=None,
         check_activity=True,
         ignore_lock=False,
+        queues=None,
+        thread_pool_size=None,
+        process_pool_size=None,
     ):
         self.request = request
         self.loop = loop
@@ -88,19 +207,41 @@ class Worker:
             None if _max_task_retries is None else int(_max_task_retries)
         )
         self._closing = False
+        # Tasks watching the connection of each queue, by queue name
+        self._watchers: Dict[str, asyncio.Future] = {}
         self._state_manager = None
         self._state_ttl = int(app_settings["amqp"]["state_ttl"])
         self._check_activity = check_activity
         self._ignore_lock = ignore_lock
+        # Container layers, shared by all jobs
+        self.container_cache = ContainerCache()
+        # Pools synchronous task functions run in
+        configure_executors(thread_pool_size, process_pool_size)
+
+        # RabbitMQ queue names defined here. The first queue is the
+        # main one, and it is consumed through the default connection.
+        _queues = parse_queues(queues or app_settings["amqp"].get("queues"))
+        if not _queues:
+            _queues = [WorkerQueue(app_settings["amqp"]["queue"])]
+        self.queues: Dict[str, WorkerQueue] = {q.name: q for q in _queues}
+        for queue in _queues[1:]:
+            queue.connection = f"consumer:{queue.name}"
+        self._assign_concurrency()
 
-        # RabbitMQ queue names defined here
         self.MAIN_EXCHANGE = app_settings["amqp"]["exchange"]
-        self.QUEUE_MAIN = app_settings["amqp"]["queue"]
-        self.QUEUE_ERRORED = app_settings["amqp"]["queue"] + "-error"
-        self.QUEUE_DELAYED = app_settings["amqp"]["queue"] + "-delay"
+        self.QUEUE_MAIN = _queues[0].name
+        self.QUEUE_ERRORED = _queues[0].errored
+        self.QUEUE_DELAYED = _queues[0].delayed
         self.TTL_ERRORED = app_settings["amqp"].get("errored_ttl_ms", default_errored)
         self.TTL_DELAYED = app_settings["amqp"].get("delayed_ttl_ms", default_delayed)
 
+    @property
+    def request_factory(self):
+        """Shared by all the jobs of the worker"""
+        if self._request_factory is None:
+            self._request_factory = RequestFactory(self.request)
+        return self._request_factory
+
     @property
     def ignore_lock(self):
         return self._ignore_lock
@@ -116,17 +257,56 @@ class Worker:
         """Returns the number of currently running jobs"""
         return len(self._running)
 
-    async def handle_queued_job(self, channel, body, envelope, properties):
+    def _assign_concurrency(self):
+        """Splits the max running tasks between the queues, according
+        to their weights. Every queue gets at least one slot.
+        """
+        total = sum(q.weight for q in self.queues.values())
+        for queue in self.queues.values():
+            queue.concurrency = max(1, self._max_running * queue.weight // total)
+
+    def _running_by_queue(self):
+        running = Counter(task._job.queue for task in self._running)
+        for queue in self.queues.values():
+            running[queue.name] += queue.starting
+        return running
+
+    def can_admit(self, queue: WorkerQueue) -> bool:
+        """Whether a new task from queue fits in the worker.
+
+        Each queue can always use its own concurrency share. Spare
+        capacity is lent to busy queues, as long as no other queue has
+        messages waiting for its share.
+        """
+        running = self._running_by_queue()
+        if sum(running.values()) >= self._max_running:
+            return False
+        if running[queue.name] < queue.concurrency:
+            return True
+        return not any(
+            other.waiting and running[other.name] < other.concurrency
+            for other in self.queues.values()
+            if other is not queue
+        )
+
+    async def handle_queued_job(self, channel, body, envelope, properties, queue=None):
         """Callback triggered when there is a new job in the job channel (e.g:
         a new task in a rabbitmq queue)
 
         """
         logger.debug(f"Queued job {body}")
 
+        if self._draining:
+            # Delivered before the consumer was cancelled
+            return await self._requeue(channel, envelope)
+
         # Deserialize job description
         if not isinstance(body, str):
             body = body.decode("utf-8")
         data = json.loads(body)
+        _queue = self.queues[queue or self.QUEUE_MAIN]
+        timeline = Timeline(data.get("published_at"), _queue.name)
+        timeline.mark("received")
 
         # Set status to scheduled
         task_id = data["task_id"]
@@ -145,19 +325,49 @@ class Worker:
                 await channel.basic_client_ack(delivery_tag=envelope.delivery_tag)
             return
 
-        await update_task_scheduled(self.state_manager, task_id, eventlog=[])
+        await update_task_scheduled(self.state_manager, task_id)
 
         logger.info(f"Received task: {task_id}: {dotted_name}")
 
         # Block if we reached maximum number of running tasks
-        while len(self._running) >= self._max_running:
-            logger.info(f"Max running tasks reached: {self._max_running}")
-            await asyncio.sleep(self.sleep_interval)
-            self.last_activity = time.time()
+        _queue.waiting += 1
+        try:
+            while not self.can_admit(_queue):
+                if self._draining:
+                    return await self._requeue(channel, envelope)
+                logger.info(
+                    f"Max running tasks reached: {self._max_running} "
+                    f"({_queue.name}: {_queue.concurrency})"
+                )
+                await asyncio.sleep(self.sleep_interval)
+                self.last_activity = time.time()
+        finally:
+            _queue.waiting -= 1
+        timeline.mark("admitted")
+
+        _queue.starting += 1
+        try:
+            await self._start_job(_queue, channel, data, envelope, timeline)
+        finally:
+            _queue.starting -= 1
+
+    async def _start_job(self, queue, channel, data, envelope, timeline=None):
+        """Creates the job of an admitted message and starts running it"""
+        task_id = data["task_id"]
+        ts = TaskState(task_id)
 
         # Create job object
         self.last_activity = time.time()
-        job = Job(self.request, data, channel, envelope)
+        job = Job(
+            self.request,
+            data,
+            channel,
+            envelope,
+            queue=queue.name,
+            request_factory=self.request_factory,
+            container_cache=self.container_cache,
+            timeline=timeline,
+        )
         # Get the redis lock on the task so no other worker takes it
         _id = job.data["task_id"]
 
@@ -168,6 +378,7 @@ class Worker:
             # Ack so that canceled job is removed from main queue
             with watch_amqp("ack"):
                 await channel.basic_client_ack(delivery_tag=envelope.delivery_tag)
+            await self._fail_canvas(data, "canceled")
             return
 
         if not self.ignore_lock and not await ts.acquire():
@@ -178,14 +389,20 @@ class Worker:
             # queue, and simply ignore it if it's picked up again and finished.
             with watch_amqp("publish"):
                 await channel.publish(
-                    json.dumps(data),
+                    self._delayed_message(data),
                     exchange_name=self.MAIN_EXCHANGE,
-                    routing_key=self.QUEUE_DELAYED,
+                    routing_key=queue.delayed,
                     properties={"delivery_mode": 2},
                 )
             with watch_amqp("ack"):
                 await channel.basic_client_ack(delivery_tag=envelope.delivery_tag)
             return
+        job.timeline.mark("leased")
+
+        try:
+            job.check_function()
+        except (ImportError, AttributeError):
+            return await self._handle_unknown_function(job)
 
         # Record job's data into global state
         await self.state_manager.update(task_id, {"job_data": job.data})
@@ -201,6 +418,35 @@ class Worker:
         self._running.append(task)
         task.add_done_callback(self._task_done_callback)
 
+    async def _requeue(self, channel, envelope):
+        """Gives a message back to rabbitmq, for another worker to take it"""
+        with watch_amqp("nack"):
+            await channel.basic_client_nack(
+                delivery_tag=envelope.delivery_tag, multiple=False, requeue=True
+            )
+
+    async def _handle_unknown_function(self, job):
+        """The worker can not run the job: it is sent to the errored queue
+        without building its request
+        """
+        task_id = job.data["task_id"]
+        logger.error(f"Task {task_id}: unknown function {job.function_name}")
+        if not self.ignore_lock:
+            await self.state_manager.release(task_id)
+        with watch_amqp("nack"):
+            await job.channel.basic_client_nack(
+                delivery_tag=job.envelope.delivery_tag, multiple=False, requeue=False
+            )
+        await update_task_status(
+            self.state_manager,
+            task_id,
+            TaskStatus.ERRORED,
+            ttl=self._state_ttl,
+            error=f"Unknown function: {job.function_name}",
+        )
+        record_op_metric(job.function_name, "unknown")
+        await self._fail_canvas(job.data, f"Unknown function: {job.function_name}")
+
     async def _handle_canceled(self, task):
         task_id = task._job.data["task_id"]
         # ACK to main queue to it is not scheduled anymore
@@ -216,6 +462,7 @@ class Worker:
 
         record_op_metric(task._job.function_name, TaskStatus.CANCELED)
         await self._state_manager.clean_canceled(task_id)
+        await self._fail_canvas(task._job.data, "canceled")
 
     async def _handle_max_retries_reached(self, task):
         task_id = task._job.data["task_id"]
@@ -235,6 +482,9 @@ class Worker:
         )
 
         record_op_metric(task._job.function_name, TaskStatus.ERRORED)
+        await self._fail_canvas(
+            task._job.data, f"reached max {self.max_task_retries} retries"
+        )
 
     async def _handle_retry(self, task, current_retries):
         task_id = task._job.data["task_id"]
@@ -252,9 +502,9 @@ class Worker:
         # Publish task data to delay queue
         with watch_amqp("publish"):
             await channel.publish(
-                json.dumps(task._job.data),
+                self._delayed_message(task._job.data),
                 exchange_name=self.MAIN_EXCHANGE,
-                routing_key=self.QUEUE_DELAYED,
+                routing_key=self._delay_queue(task._job),
                 properties={"delivery_mode": 2},
             )
         # ACK to main queue so it doesn't timeout
@@ -264,21 +514,32 @@ class Worker:
 
         record_op_metric(task._job.function_name, "retried")
 
-    async def _handle_send_to_delay_queue(self, task, task_id):
+    async def _handle_send_to_delay_queue(self, task, task_id, exc=None):
         channel = task._job.channel
+        data = task._job.data
+        status = exc.status if exc is not None else TaskStatus.SLEEPING
+        delay = None
+        routing_key = self._delay_queue(task._job)
+        if exc is not None:
+            if exc.data:
+                data = dict(data, **exc.data)
+            if exc.delay is not None:
+                delay, routing_key = await self._queue_delayed_for(
+                    channel, task._job, exc.delay
+                )
         await update_task_status(
             self.state_manager,
             task_id,
-            TaskStatus.SLEEPING,
+            status,
             task=task,
             ttl=self._state_ttl,
         )
         # Publish task data to delay queue
         with watch_amqp("publish"):
             await channel.publish(
-                json.dumps(task._job.data),
+                self._delayed_message(data, delay),
                 exchange_name=self.MAIN_EXCHANGE,
-                routing_key=self.QUEUE_DELAYED,
+                routing_key=routing_key,
                 properties={"delivery_mode": 2},
             )
         # ACK to main queue so it doesn't timeout
@@ -286,7 +547,44 @@ class Worker:
             await channel.basic_client_ack(delivery_tag=task._job.envelope.delivery_tag)
         logger.info(f"Task {task_id} sent to delay queue")
 
-        record_op_metric(task._job.function_name, "sleep")
+        # Tasks waiting to be scheduled, like debounced ones, did not run
+        record_op_metric(
+            task._job.function_name,
+            TaskStatus.SCHEDULED if status == TaskStatus.SCHEDULED else "sleep",
+        )
+
+    async def _queue_delayed_for(self, channel, job, delay):
+        """Delay in seconds and routing key of a message delayed by delay
+        seconds, at most TTL_DELAYED. RabbitMQ only expires messages at
+        the head of a queue, so messages are not delayed with a per
+        message expiration in the shared delay queue, behind retries:
+        each delay, rounded up to seconds, has its own queue, which is
+        deleted once unused.
+        """
+        queue = self.queues.get(job.queue) or self.queues[self.QUEUE_MAIN]
+        seconds = math.ceil(min(max(delay, 0), self.TTL_DELAYED / 1000))
+        if seconds == 0:
+            return 0, queue.name
+        if seconds * 1000 >= self.TTL_DELAYED:
+            return None, queue.delayed
+        # Declared every time, as it may have expired meanwhile
+        routing_key = queue.delayed_for(seconds)
+        await channel.queue_declare(
+            queue_name=routing_key,
+            durable=True,
+            arguments={
+                "x-dead-letter-exchange": self.MAIN_EXCHANGE,
+                "x-dead-letter-routing-key": queue.name,
+                "x-message-ttl": seconds * 1000,
+                "x-expires": seconds * 1000 + self.TTL_DELAYED,
+            },
+        )
+        await channel.queue_bind(
+            exchange_name=self.MAIN_EXCHANGE,
+            queue_name=routing_key,
+            routing_key=routing_key,
+        )
+        return seconds, routing_key
 
     async def _handle_successful(self, task):
         task_id = task._job.data["task_id"]
@@ -297,19 +595,76 @@ class Worker:
             await task._job.channel.basic_client_ack(
                 delivery_tag=task._job.envelope.delivery_tag
             )
+        task._job.timeline.mark("acked")
 
         # Update status with result
-        await update_task_finished(
-            self.state_manager,
-            task_id,
-            task=task,
-            ttl=self._state_ttl,
-            result=task.result(),
-        )
+        extra = {}
+        if task._job.memory is not None:
+            extra["memory"] = task._job.memory
+        try:
+            await update_task_finished(
+                self.state_manager,
+                task_id,
+                task=task,
+                ttl=self._state_ttl,
+                result=task.result(),
+                result_ttl=getattr(task._job.get_task_definition(), "result_ttl", None),
+                timeline=task._job.timeline.times,
+                **extra,
+            )
+        except ResultTooLargeException as exc:
+            # Nothing stored: error the task instead of losing its result
+            logger.error(f"Task {task_id}: {exc}")
+            await update_task_status(
+                self.state_manager,
+                task_id,
+                TaskStatus.ERRORED,
+                ttl=self._state_ttl,
+                error=str(exc),
+                timeline=task._job.timeline.times,
+                **extra,
+            )
+            record_op_metric(task._job.function_name, TaskStatus.ERRORED)
+            await self._fail_canvas(task._job.data, str(exc))
+            return
         logger.info(f"Finished task: {task_id}: {dotted_name}")
 
+        if "canvas" in task._job.data:
+            try:
+                await on_task_finished(task._job.data, task.result())
+            except Exception:
+                logger.error(
+                    f"Error scheduling the tasks following {task_id}", exc_info=True
+                )
+
         record_op_metric(task._job.function_name, TaskStatus.FINISHED)
 
+    async def _fail_canvas(self, data, error):
+        """Errors the tasks following a task that failed for good"""
+        if "canvas" not in data:
+            return
+        try:
+            await on_task_failed(data, error)
+        except Exception:
+            logger.error(
+                f"Error failing the tasks following {data['task_id']}", exc_info=True
+            )
+
+    def _delayed_message(self, data, delay=None):
+        """Body of a message sent back through the delay queue. Its
+        publish time is when it is expected back in the main queue, so
+        the delay is not measured as time waiting for a worker.
+        """
+        if delay is None:
+            delay = self.TTL_DELAYED / 1000
+        data = dict(data, published_at=time.time() + delay)
+        return json.dumps(data)
+
+    def _delay_queue(self, job):
+        """Delay queue of the queue the job was consumed from"""
+        queue = self.queues.get(job.queue) or self.queues[self.QUEUE_MAIN]
+        return queue.delayed
+
     def _task_done_callback(self, task):
         # We can't pass coroutines to add_done_callback so we have to
         # place it inside an ensure_future
@@ -328,8 +683,12 @@ class Worker:
 
     async def _task_callback(self, task):
         """This is called when a job finishes execution"""
+        if getattr(task, "_drained", False):
+            # Interrupted by drain(), which requeues it
+            return
         task_id = task._job.data["task_id"]
-        self.total_run += 1
+        if not _is_waiting(task):
+            self.total_run += 1
         _status = "success"
         try:
             result = task.result()
@@ -344,10 +703,10 @@ class Worker:
                 "marked as such in the state manager."
             )
             return await self._handle_unexpected_error(task, task_id)
-        except DelayTaskException:
+        except DelayTaskException as exc:
             _status = "delayed"
             logger.warning(f"Sending task {task_id} to the delay queue")
-            return await self._handle_send_to_delay_queue(task, task_id)
+            return await self._handle_send_to_delay_queue(task, task_id, exc)
         except Exception:
             _status = "error"
             logger.error(f"Unhandled task exception: {task_id}")
@@ -362,13 +721,13 @@ class Worker:
                 await self.state_manager.release(task_id)
 
             # Record per-container completion metrics
-            if AMQP_TASK_COMPLETED is not None:
+            if AMQP_TASK_COMPLETED is not None and not _is_waiting(task):
                 _container_id = task._job.data.get("container_id") or "unknown"
                 _func = task._job.function_name
-                _labels = dict(
+                _labels = task_labels(
                     container=_container_id,
                     function=_func,
-                    queue=self.QUEUE_MAIN,
+                    queue=task._job.queue or self.QUEUE_MAIN,
                 )
                 AMQP_TASK_COMPLETED.labels(**_labels, status=_status).inc()
                 if AMQP_TASK_DURATION is not None:
@@ -380,14 +739,106 @@ class Worker:
 
     async def stop(self):
         self.cancel()
-        await amqp.remove_connection()
+        for queue in self.queues.values():
+            await amqp.remove_connection(queue.connection)
+
+    async def drain(self, timeout=None):
+        """Stops consuming and waits up to timeout seconds for the running
+        tasks to finish. Tasks still running after that are interrupted
+        and their messages requeued, so another worker picks them up.
+        """
+        if timeout is None:
+            timeout = app_settings["amqp"].get("drain_timeout", 60)
+        # Flag first: consumer callbacks waiting for a free slot requeue
+        # their message and return, which lets the connection process
+        # the cancel response.
+        self._draining = True
+        if self._activity_task is not None and not self._activity_task.done():
+            # Don't let the inactivity check kill the worker mid drain
+            self._activity_task.cancel()
+        for queue in self.queues.values():
+            if queue.consumer_tag is None:
+                continue
+            try:
+                channel, transport, protocol = await amqp.get_connection(
+                    queue.connection
+                )
+                await asyncio.wait_for(channel.basic_cancel(queue.consumer_tag), 10)
+            except Exception:
+                logger.warning(f"Could not stop consuming {queue.name}", exc_info=True)
+
+        total = len(self._running)
+        logger.warning(f"Draining worker: waiting {timeout}s for {total} tasks")
+        deadline = time.monotonic() + timeout
+        next_log = time.monotonic() + self.drain_log_interval
+        while self._running and time.monotonic() < deadline:
+            record_drain_metric(len(self._running))
+            if time.monotonic() >= next_log:
+                logger.warning(
+                    f"Draining worker: {len(self._running)}/{total} tasks running, "
+                    f"{int(deadline - time.monotonic())}s left"
+                )
+                next_log += self.drain_log_interval
+            await asyncio.sleep(self.sleep_interval)
+
+        pending = [task for task in self._running if not task.done()]
+        record_drain_metric(0, "finished", total - len(pending))
+        if pending:
+            logger.warning(f"Drain timeout reached: requeuing {len(pending)} tasks")
+            await self._requeue_running(pending)
+            record_drain_metric(0, "requeued", len(pending))
+        logger.warning("Worker drained")
+
+    async def _requeue_running(self, tasks):
+        for task in tasks:
+            task._drained = True
+            task.cancel()
+            if task in self._running:
+                self._running.remove(task)
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        task_ids = []
+        for task in tasks:
+            task_id = task._job.data["task_id"]
+            task_ids.append(task_id)
+            try:
+                await self._requeue(task._job.channel, task._job.envelope)
+                await update_task_scheduled(
+                    self.state_manager, task_id, ttl=self._state_ttl
+                )
+            except Exception:
+                logger.warning(f"Error requeuing task {task_id}", exc_info=True)
+            record_op_metric(task._job.function_name, "requeued")
+
+        if not self.ignore_lock:
+            # Let other workers take them straight away
+            await self.state_manager.release_many(task_ids)
 
     async def start(self):
         """Called on worker startup. Connects to the rabbitmq. Declares and
         configures the different queues.
 
+        Every queue is consumed through its own connection, so a queue
+        waiting for free slots does not hold back deliveries of the
+        others.
         """
-        channel, transport, protocol = await amqp.get_connection()
+        for queue in self.queues.values():
+            await self._subscribe(queue)
+
+        await refresh_profiled_functions()
+
+        # Start task that will update status periodically
+        self._status_task = asyncio.ensure_future(self.update_status())
+
+        # Start task that checks connection activity
+        self._activity_task = asyncio.ensure_future(self.check_activity())
+
+    async def _subscribe(self, queue):
+        """Declares the queues of queue on its connection and starts
+        consuming from it. The connection is watched, so the worker
+        subscribes again if it closes.
+        """
+        channel, transport, protocol = await amqp.get_connection(queue.connection)
 
         # Declare main exchange
         await channel.exchange_declare(
@@ -395,80 +846,110 @@ class Worker:
         )
 
         # Declare errored queue and bind it
-        await self.queue_errored(channel, passive=False)
+        await self.queue_errored(channel, passive=False, queue=queue)
 
         # Declare main queue and bind it
-        await self.queue_main(channel, passive=False)
+        await self.queue_main(channel, passive=False, queue=queue)
 
         # Declare delayed queue and bind it
-        await self.queue_delayed(channel, passive=False)
+        await self.queue_delayed(channel, passive=False, queue=queue)
 
-        await channel.basic_qos(prefetch_count=self._max_running)
+        # Queues can borrow the whole worker capacity by default
+        await channel.basic_qos(prefetch_count=queue.prefetch or self._max_running)
 
         # Configure task consume callback
-        await channel.basic_consume(self.handle_queued_job, queue_name=self.QUEUE_MAIN)
-
-        # Start task that will update status periodically
-        self._status_task = asyncio.ensure_future(self.update_status())
+        resp = await channel.basic_consume(
+            partial(self.handle_queued_job, queue=queue.name),
+            queue_name=queue.name,
+        )
+        queue.consumer_tag = (resp or {}).get("consumer_tag")
+        self._watchers[queue.name] = asyncio.ensure_future(
+            self._watch_connection(queue, protocol)
+        )
 
-        # Start task that checks connection activity
-        self._activity_task = asyncio.ensure_future(self.check_activity())
+        logger.warning(
+            f"Subscribed to queue: {queue.name} "
+            f"(max running tasks: {queue.concurrency})"
+        )
 
-        logger.warning(f"Subscribed to queue: {self.QUEUE_MAIN}")
+    async def _watch_connection(self, queue, protocol):
+        """Subscribes again to queue once its connection closes. Exits
+        the worker if that fails, so it gets restarted instead of
+        silently not consuming the queue anymore.
+        """
+        try:
+            await protocol.wait_closed()
+        except (Exception, GeneratorExit):
+            pass
+        if self._closing or self._draining:
+            return
+        logger.warning(f"Connection consuming {queue.name} closed, subscribing again")
+        queue.consumer_tag = None
+        await amqp.remove_connection(queue.connection, protocol)
+        try:
+            await self._subscribe(queue)
+        except Exception:
+            logger.error(
+                f"Could not subscribe again to {queue.name}. Exiting", exc_info=True
+            )
+            os._exit(0)
 
-    async def queue_main(self, channel, passive=True):
+    async def queue_main(self, channel, passive=True, queue=None):
         """Declares the main queue for task messages. NACKed messages are sent
         to the errored queue.
 
         If passie is False, will additionally bind the queue to the
         exchange
         """
+        queue = queue or self.queues[self.QUEUE_MAIN]
         resp = await channel.queue_declare(
-            queue_name=self.QUEUE_MAIN,
+            queue_name=queue.name,
             durable=True,
             passive=passive,
             arguments={
                 "x-dead-letter-exchange": self.MAIN_EXCHANGE,
-                "x-dead-letter-routing-key": self.QUEUE_ERRORED,
+                "x-dead-letter-routing-key": queue.errored,
             },
         )
         if not passive:
             await channel.queue_bind(
                 exchange_name=self.MAIN_EXCHANGE,
-                queue_name=self.QUEUE_MAIN,
-                routing_key=self.QUEUE_MAIN,
+                queue_name=queue.name,
+                routing_key=queue.name,
             )
         return resp
 
-    async def queue_delayed(self, channel, passive=True):
+    async def queue_delayed(self, channel, passive=True, queue=None):
         """Declares the queue for delayed tasks, which is used for failed
         tasks retrials. After self.TTL_DELAYED, tasks will be requeued
         to the main task queue.
         """
+        queue = queue or self.queues[self.QUEUE_MAIN]
         resp = await channel.queue_declare(
-            queue_name=self.QUEUE_DELAYED,
+            queue_name=queue.delayed,
             durable=True,
             passive=passive,
             arguments={
                 "x-dead-letter-exchange": self.MAIN_EXCHANGE,
-                "x-dead-letter-routing-key": self.QUEUE_MAIN,
+                "x-dead-letter-routing-key": queue.name,
                 "x-message-ttl": self.TTL_DELAYED,
             },
         )
         if not passive:
             await channel.queue_bind(
                 exchange_name=self.MAIN_EXCHANGE,
-                queue_name=self.QUEUE_DELAYED,
-                routing_key=self.QUEUE_DELAYED,
+                queue_name=queue.delayed,
+                routing_key=queue.delayed,
             )
         return resp
 
-    async def queue_errored(self, channel, passive=True):
+    async def queue_errored(self, channel, passive=True, queue=None):
         """Declares queue for errored tasks. Errored tasks will remain a
         limited period of time and then they will be lost.
         """
+        queue = queue or self.queues[self.QUEUE_MAIN]
         resp = await channel.queue_declare(
-            queue_name=self.QUEUE_ERRORED,
+            queue_name=queue.errored,
             durable=True,
             passive=passive,
             arguments={"x-message-ttl": self.TTL_ERRORED},
@@ -476,8 +957,8 @@ class Worker:
         if not passive:
             await channel.queue_bind(
                 exchange_name=self.MAIN_EXCHANGE,
-                queue_name=self.QUEUE_ERRORED,
-                routing_key=self.QUEUE_ERRORED,
+                queue_name=queue.errored,
+                routing_key=queue.errored,
             )
         return resp
 
@@ -485,15 +966,18 @@ class Worker:
         """
         Cancels the worker (i.e: all its running tasks)
         """
+        self._closing = True
         for task in self._running[:]:
             if not task.done():
                 task.cancel()
             self._running.remove(task)
 
-        for task in (self._status_task, self._activity_task):
+        for task in [self._status_task, self._activity_task, *self._watchers.values()]:
             if task is not None and not task.done():
                 task.cancel()
 
+        shutdown_executors()
+
     async def join(self):
         """
         Waits for all tasks to finish
@@ -547,6 +1031,11 @@ class Worker:
         while True:
             await asyncio.sleep(self.update_status_interval)
 
+            try:
+                await refresh_profiled_functions()
+            except Exception:
+                logger.warning("Error reading the profiled functions", exc_info=True)
+
             if not self.ignore_lock:
                 for task in self._running:
                     _id = task._job.data["task_id"]